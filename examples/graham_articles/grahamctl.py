@@ -1,8 +1,8 @@
 from sworkflow.ctl import cmdline, WorkflowControl
-from workflow import GrahamWorkflow
 
+# workflows are imported only when they are used
 workflows = {
-    'process_articles' : GrahamWorkflow,
+    'process_articles' : 'workflow:GrahamWorkflow',
 }
 
 workflowcontrol = WorkflowControl(workflows)
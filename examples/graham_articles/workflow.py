@@ -10,18 +10,25 @@ class DownloadArticles(PythonTask):
 
 class ParseArticles(PythonTask):
     execargs = ['parse_articles', '$download_html', '$parsed']
+    inputs = ['$download_html']
+    outputs = ['$parsed']
+    cache = True
     deps = [DownloadArticles]
 
 class ExportArticlesCSV(PythonTask):
     execargs = [
         'export_articles', 'csv', '$parsed', '$stage/articles.csv'
     ]
+    inputs = ['$parsed']
+    outputs = ['$stage/articles.csv']
     deps = [ParseArticles]
 
 class ExportArticlesXML(PythonTask):
     execargs = [
         'export_articles', 'xml', '$parsed', '$stage/articles.xml'
     ]
+    inputs = ['$parsed']
+    outputs = ['$stage/articles.xml']
     deps = [ParseArticles]
 
 class CommitData(FsActionTask):
@@ -0,0 +1,173 @@
+"""
+Content addressed cache of task output files.
+
+Entries are stored under the cache directory by key, every entry keeps a copy
+of the output files and directories of a task. Files are copied in and out of
+the cache rather than hardlinked, so tasks writing their inputs or outputs in
+place can't modify cached entries. Entries not used recently are evicted when the cache
+grows bigger than its maximum size.
+"""
+import os
+import shutil
+from tempfile import mkdtemp
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+MANIFEST = 'manifest.json'
+# default maximum size of the cache in bytes
+MAXSIZE = 10 * 1024 ** 3
+
+
+def default_cachedir():
+    statedir = os.environ.get('SWORKFLOW_STATEDIR',
+            os.path.expanduser('~/.sworkflow'))
+    return os.path.join(statedir, 'cache')
+
+
+class ResultCache(object):
+    """Cache of output files by key
+
+    >>> import tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> cache = ResultCache(os.path.join(tmp, 'cache'))
+    >>> output = os.path.join(tmp, 'output')
+    >>> open(output, 'w').write('result')
+    >>> cache.restore('k1', [output])
+    False
+    >>> cache.store('k1', [output])
+    >>> os.remove(output)
+    >>> cache.restore('k1', [output])
+    True
+    >>> open(output).read()
+    'result'
+    >>> cache.stats()['entries']
+    1
+    >>> shutil.rmtree(tmp)
+    """
+
+    def __init__(self, path=None, maxsize=None):
+        self.path = path or default_cachedir()
+        self.maxsize = MAXSIZE if maxsize is None else maxsize
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def restore(self, key, outputs):
+        """Restore outputs from the entry stored with key
+
+        Returns False if there is no such entry.
+        """
+        entry = self._entry(key)
+        manifest = os.path.join(entry, MANIFEST)
+        try:
+            paths = _load(manifest)
+        except (IOError, ValueError):
+            return False
+        if sorted(paths) != sorted(outputs):
+            return False
+        for i, path in enumerate(paths):
+            _copy(os.path.join(entry, str(i)), path)
+        # last use time of the entry, used to evict old entries
+        os.utime(manifest, None)
+        return True
+
+    def store(self, key, outputs):
+        """Store a copy of outputs in the entry for key"""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        tmpentry = mkdtemp(prefix='.tmp-', dir=self.path)
+        try:
+            for i, path in enumerate(outputs):
+                _copy(path, os.path.join(tmpentry, str(i)))
+            _dump(list(outputs), os.path.join(tmpentry, MANIFEST))
+            entry = self._entry(key)
+            if not os.path.isdir(os.path.dirname(entry)):
+                os.makedirs(os.path.dirname(entry))
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(tmpentry, entry)
+        except:
+            shutil.rmtree(tmpentry, ignore_errors=True)
+            raise
+        self.prune()
+
+    def entries(self):
+        """Returns a list of (lastused, size, entry path) sorted by last use"""
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for prefix in os.listdir(self.path):
+            prefixdir = os.path.join(self.path, prefix)
+            if prefix.startswith('.') or not os.path.isdir(prefixdir):
+                continue
+            for key in os.listdir(prefixdir):
+                entry = os.path.join(prefixdir, key)
+                try:
+                    lastused = os.path.getmtime(os.path.join(entry, MANIFEST))
+                except OSError:
+                    continue
+                size = _size(entry)
+                entries.append((lastused, size, entry))
+        entries.sort()
+        return entries
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            'path': self.path,
+            'entries': len(entries),
+            'size': sum(size for _, size, _ in entries),
+            'maxsize': self.maxsize,
+            'oldest': entries[0][0] if entries else None,
+            'newest': entries[-1][0] if entries else None,
+        }
+
+    def prune(self, maxsize=None):
+        """Evict least recently used entries until the cache fits in maxsize
+
+        Returns the number of evicted entries.
+        """
+        maxsize = self.maxsize if maxsize is None else maxsize
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, entry in entries:
+            if total <= maxsize:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            evicted += 1
+        return evicted
+
+
+def _copy(src, dst):
+    """Copy the file or directory src to dst, replacing dst"""
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        os.remove(dst)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
+def _size(path):
+    """Returns the size of the files under path"""
+    return sum(os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(path) for f in files)
+
+def _load(path):
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def _dump(obj, path):
+    f = open(path, 'w')
+    try:
+        json.dump(obj, f)
+    finally:
+        f.close()
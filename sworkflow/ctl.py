@@ -1,12 +1,27 @@
+import os
+import sys
+from datetime import datetime, timedelta
 from optparse import OptionParser
-from sworkflow.tasks.workflow import walk, taskid, find_redundant_deps
+# sworkflow modules are imported by the commands using them, so listing
+# workflows or running one doesn't import what other commands need
 
 
 class WorkflowControl(object):
-    """helper class for workflows"""
-
-    def __init__(self, workflows):
-        self.workflows = workflows
+    """helper class for workflows
+
+    workflows maps names to Workflow classes or to "package.module:Class"
+    references, imported only when the workflow is created. Workflows
+    registered as entry points of group are added to them, eg. with
+    entry_points={'sworkflow.workflows': ['name = package.module:Class']}
+    in setup.py and group='sworkflow.workflows'.
+    """
+
+    def __init__(self, workflows=None, group=None):
+        self.workflows = dict(workflows or {})
+        if group:
+            import pkg_resources
+            for ep in pkg_resources.iter_entry_points(group):
+                self.workflows.setdefault(ep.name, ep)
 
     def list(self):
         return self.workflows.keys()
@@ -16,11 +31,30 @@ class WorkflowControl(object):
             cls = self.workflows[name]
         except KeyError:
             raise ValueError("Workflow doesn't exist: %s" % name)
+        if not isinstance(cls, type):
+            cls = self.workflows[name] = _load(cls)
         return cls(**wfkwargs)
 
 
+def _load(ref):
+    """Returns the object a "package.module:name" reference or an entry
+    point refers to
+
+    >>> _load('os.path:join') is os.path.join
+    True
+    """
+    if not isinstance(ref, basestring):
+        return ref.load()
+    modname, _, attrs = ref.partition(':')
+    __import__(modname)
+    obj = sys.modules[modname]
+    for attr in attrs.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
 def _parser():
-    usage = "%prog [options] [run|list|list-tasks|draw] [workflow_name]"
+    usage = "%prog [options] [run|resume|list|list-tasks|plan|draw|cache] [workflow_name]"
     parser = OptionParser(usage=usage, description=__doc__)
     parser.add_option('--param', '-p', action='append', metavar='NAME=VALUE',
             help='Additional settings merged with workflow settings')
@@ -28,18 +62,52 @@ def _parser():
             help='Run the given task id and skip others')
     parser.add_option('--exclude-task', '-s', metavar='TASKID', action='append',
             help='Skip the given task id')
+    parser.add_option('--jobs', '-j', type='int', default=1, metavar='N',
+            help='Run up to N independent tasks at the same time')
+    parser.add_option('--statedir', metavar='PATH',
+            default=os.environ.get('SWORKFLOW_STATEDIR',
+                os.path.expanduser('~/.sworkflow')),
+            help='Directory where workflow state is kept between runs '
+                '(default: $SWORKFLOW_STATEDIR or ~/.sworkflow)')
+    parser.add_option('--cache-size', type='int', default=10240, metavar='MB',
+            help='Maximum size of the task result cache (default: 10240)')
+    parser.add_option('--webhdfs', metavar='URL',
+            help='Run HDFS operations through the WebHDFS API of the given '
+                'namenode, eg. http://namenode:50070 (default: $SWORKFLOW_WEBHDFS)')
+    parser.add_option('--hdfs-cache-ttl', type='int', default=60,
+            metavar='SECONDS', help='Cache HDFS metadata during runs for '
+                'SECONDS, 0 disables the cache (default: 60)')
+    parser.add_option('--execmode', choices=('spawn', 'fork', 'pool'),
+            help='Run python tasks in new interpreters (spawn), in forks of '
+                'the workflow (fork) or in a pool of warm workers (pool), '
+                'unless tasks set their execmode')
+    parser.add_option('--workers', type='int', metavar='N',
+            help='Number of worker processes running tasks in pool execmode '
+                '(default: 4)')
+    parser.add_option('--preload', metavar='MODULE', action='append',
+            help='Import MODULE in worker processes before they run tasks')
+    parser.add_option('--worker-max-tasks', type='int', metavar='N',
+            help='Replace workers after N tasks (default: 100)')
+    parser.add_option('--worker-max-rss', type='int', metavar='MB',
+            help='Replace workers once their resident memory grew above MB')
     parser.add_option('-o', '--output', metavar="PATH",
             help='Path when using a command that output a file. eg. draw')
     parser.add_option('-R', '--ignore-redundant-deps', action='store_true',
             help='Remove redundant dependencies from workflow tree representation')
     return parser
 
+def _pooled(workflow):
+    """Returns True if tasks of workflow run in the worker pool"""
+    return bool([t for _, t, skipped in workflow.tasks
+        if not skipped and getattr(t, 'execmode', None) == 'pool'])
+
 def draw_workflow(workflow, workflow_name, filename=None, remove_dependencies=True):
     try:
         import pygraphviz as pgv
     except ImportError:
         print "You need PyGraphviz to run this command."
         return
+    from sworkflow.tasks.workflow import walk, taskid, find_redundant_deps
 
     starttask = workflow.starttask
     redundant_deps = set(edge for edge, _  in find_redundant_deps(starttask))
@@ -66,6 +134,13 @@ def draw_workflow(workflow, workflow_name, filename=None, remove_dependencies=Tr
         print "clear. Use 'lint' command if you want to see them"
 
 
+def _timestamp(seconds):
+    return datetime.fromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S')
+
+def _duration(seconds):
+    return timedelta(seconds=int(round(seconds)))
+
+
 def cmdline(controller):
     """Provide a command line interface to sworkflow"""
 
@@ -75,19 +150,43 @@ def cmdline(controller):
         parser.error("please specify a command, or -h for help")
 
     params = dict(p.strip().split("=") for p in opts.param or ())
+    # tasks and spawned programs share the state directory (eg. cache)
+    os.environ['SWORKFLOW_STATEDIR'] = opts.statedir
+    if opts.webhdfs:
+        os.environ['SWORKFLOW_WEBHDFS'] = opts.webhdfs
+    if opts.execmode:
+        from sworkflow.tasks.pythontask import PythonTask
+        PythonTask.execmode = opts.execmode
 
     cmd = args[0]
     workflow = None
-    if cmd in ('run', 'list-tasks', 'draw', 'lint', 'list-settings',): # need workflow name
+    if cmd in ('run', 'resume', 'list-tasks', 'plan', 'draw', 'lint', 'list-settings',): # need workflow name
         try:
             name = args[1]
         except IndexError:
             parser.error("'%s' command needs the workflow name" % args[0])
 
         workflow = controller.create(name, params=params,
-                exclude_tasks=opts.exclude_task, include_tasks=opts.include_task)
-
-    if cmd == 'run':
+                exclude_tasks=opts.exclude_task, include_tasks=opts.include_task,
+                jobs=opts.jobs, statedir=opts.statedir,
+                resume=(cmd == 'resume'))
+
+    if cmd in ('run', 'resume'):
+        from sworkflow.tasks.pythontask import PythonTask
+        PythonTask.cachesize = opts.cache_size * 1024 ** 2
+        if opts.hdfs_cache_ttl > 0:
+            from sworkflow import hdfs
+            hdfs.enable_cache(ttl=opts.hdfs_cache_ttl)
+        pooloptions = dict((k, v) for k, v in (('size', opts.workers),
+            ('preload', opts.preload), ('maxtasks', opts.worker_max_tasks),
+            ('maxrss', opts.worker_max_rss)) if v is not None)
+        if pooloptions or opts.execmode == 'pool' or _pooled(workflow):
+            from sworkflow.tasks.workers import WorkerPool, set_pool
+            # fork the template process before the workflow starts threads,
+            # the pool lasts as long as this process
+            pool = WorkerPool(**pooloptions)
+            pool.start()
+            set_pool(pool)
         workflow.execute()
     elif cmd == 'list':
         for wf in controller.list():
@@ -95,10 +194,38 @@ def cmdline(controller):
     elif cmd == 'list-tasks':
         print " %3s | %-38s | %-9s | %s" % ('#', 'taskid', 'skipped?', 'name')
         print "-"*80
-        for i, task, skipped in workflow.tasks:
-            task_id = taskid(task)
-            print " %3d | %-38s | %-9s | %s" % (i, task_id, skipped, task)
+        for i, task_id, skipped, name, _ in workflow.outline():
+            print " %3d | %-38s | %-9s | %s" % (i, task_id, skipped, name)
+        print "-"*80
+    elif cmd == 'cache':
+        from sworkflow.cache import ResultCache
+        cachecmd = args[1:2] and args[1]
+        cache = ResultCache(os.path.join(opts.statedir, 'cache'),
+                maxsize=opts.cache_size * 1024 ** 2)
+        if cachecmd == 'stats':
+            stats = cache.stats()
+            print "Cache path:   %s" % stats['path']
+            print "Entries:      %d" % stats['entries']
+            print "Size:         %.1f MB of %.1f MB" % (
+                    stats['size'] / 1024.0 ** 2, stats['maxsize'] / 1024.0 ** 2)
+            if stats['entries']:
+                print "Oldest entry: last used %s" % _timestamp(stats['oldest'])
+                print "Newest entry: last used %s" % _timestamp(stats['newest'])
+        elif cachecmd == 'prune':
+            print "%d cache entries evicted" % cache.prune()
+        else:
+            parser.error("'cache' command needs 'stats' or 'prune'")
+    elif cmd == 'plan':
+        from sworkflow.tasks.workflow import taskid
+        path, seconds = workflow.plan()
+        print " %3s | %-38s | %s" % ('#', 'taskid', 'expected duration')
+        print "-"*80
+        for i, task, expected in path:
+            print " %3d | %-38s | %s" % (i, taskid(task), _duration(expected))
         print "-"*80
+        finish = datetime.now() + timedelta(seconds=seconds)
+        print "Expected duration: %s" % _duration(seconds)
+        print "Expected finish time: %s" % finish.strftime('%Y-%m-%d %H:%M:%S')
     elif cmd == 'lint':
         draw_workflow(workflow, name, filename=opts.output, remove_dependencies=False)
     elif cmd == 'draw':
@@ -1,12 +1,36 @@
 """
 Helper functions for working with Hadoop HDFS. Most function are simple
 wrappers around the "hadoop fs" command.
+
+Filesystem operations are sent to a backend, by default FsShell which runs
+"hadoop fs" for every call. Other backends are plugged with set_backend():
+
+    from sworkflow.webhdfs import WebHDFS
+    hdfs.set_backend(WebHDFS('http://namenode:50070', user='hadoop'))
+
+The WebHDFS backend is also used when $SWORKFLOW_WEBHDFS is set to the
+namenode url.
 """
 
+import io
+import os
+import re
 import sys
-from posixpath import join
+import zlib
+import glob
+import errno
+import struct
+from uuid import uuid4
+from fnmatch import fnmatchcase
+from posixpath import join, dirname, basename
+from Queue import Queue, Full, Empty
+from threading import Lock, Thread, Event
+from time import time
+from urlparse import urlsplit
 from subprocess import Popen, PIPE, call, check_call, CalledProcessError
 from tempfile import TemporaryFile
+from datetime import datetime
+from collections import namedtuple
 
 
 ## FsShell bindings
@@ -29,13 +53,20 @@ def ls(*paths, **options):
         'time': '17:28',
         'user': 'root'}]
 
+    Streaming output, FileStatus records parsed while the listing is read:
+    >> sum(s.size for s in hdfs.lsr('/dev/example', iterator=True))
+    7485
+
+    Streamed listings bypass the metadata cache, so they are never kept in
+    memory.
     """
-    cols = ('perms', 'replication', 'user', 'group', 'size', \
-            'date', 'time', 'path')
-    fscmd = '-lsr' if options.get('recursive') else '-ls'
-    extended = _hadoopfs_columns(cols, fscmd, *paths)
-    return list(extended) if options.get('extended') \
-            else [e['path'] for e in extended]
+    if options.get('iterator'):
+        return iter(_uncached().ls(paths,
+            recursive=options.get('recursive')))
+    statuses = get_backend().ls(paths, recursive=options.get('recursive'))
+    if options.get('extended'):
+        return [s.asdict() for s in statuses]
+    return [s.path for s in statuses]
 
 def lsr(*paths, **options):
     """Recursive ls for HDFS"""
@@ -48,96 +79,440 @@ def mv(dst, *src):
 
     When moving multiple files, the destination must be a directory.
     """
-    check_call(('hadoop', 'fs', '-mv') + src + (dst,))
+    get_backend().mv(dst, src)
+
+def rename(src, dst, overwrite=False):
+    """Rename src to dst, like mv when overwrite is False
+
+    With overwrite=True an existing dst is replaced. It is atomic only with
+    the WebHDFS backend on namenodes supporting rename options. Otherwise
+    dst is moved aside and deleted once src has taken its place, and it is
+    missing in between.
+    """
+    get_backend().rename(src, dst, overwrite=overwrite)
 
 def cp(dst, *src):
     """Copy files from source to destination
 
     This command allows multiple sources as well in which case the destination must be a directory
     """
-    check_call(('hadoop', 'fs', '-cp') + src + (dst,))
+    get_backend().cp(dst, src)
 
 def rm(*paths):
     """Delete files specified as args
 
     Only deletes non empty directory and files. Refer to rmr for recursive deletes
     """
-    check_call(('hadoop', 'fs', '-rm') + paths)
+    get_backend().rm(paths)
 
 def rmr(*paths):
     """Recursive version of delete"""
-    check_call(('hadoop', 'fs', '-rmr') + paths)
+    get_backend().rmr(paths)
 
 def put(dst, *src, **options):
     """Copy files from the local file system into hdfs"""
-    if options.get('overwrite') and path_exists(dst):
-        rmr(dst)
-    if 'stdin' in options:
-        check_call(('hadoop', 'fs', '-put', '-', dst), stdin=options['stdin'])
-    else:
-        check_call(('hadoop', 'fs', '-put') + src + (dst,))
+    if options.get('overwrite'):
+        rm_many([dst], recursive=True)
+    get_backend().put(dst, src, stdin=options.get('stdin'))
 
 def get(dst, *src):
     """Copy files from hdfs into the local file system"""
-    check_call(('hadoop', 'fs', '-get') + src + (dst,))
+    get_backend().get(dst, src)
 
 def cat(*paths):
     """Return a file-like object with the output of the given paths"""
-    return Popen(('hadoop', 'fs', '-cat') + paths, stdout=PIPE).stdout
+    return get_backend().cat(paths)
 
 def mkdir(*paths, **options):
     """Create a directory in the specified location"""
-    errbuf = TemporaryFile()
-    try:
-        check_call(('hadoop', 'fs', '-mkdir') + paths, stderr=errbuf)
-    except CalledProcessError, ex:
-        if options.get('fail_if_exists') or ex.returncode != 255:
-            errbuf.seek(0)
-            print >> sys.stderr, errbuf.read()
-            raise
+    get_backend().mkdir(paths, fail_if_exists=options.get('fail_if_exists'))
 
 def touchz(*paths):
     """Write a timestamp in yyyy-MM-dd HH:mm:ss format in a file at <path>.
 
     An error is returned if the file exists with non-zero length
     """
-    check_call(('hadoop', 'fs', '-touchz') + paths)
+    get_backend().touchz(paths)
 
-def du(*paths):
+def du(*paths, **options):
     """Show the amount of space, in bytes, used by the files
     that match the specified file pattern.
 
     Equivalent to the unix command "du -sb <path>/*" in case of
     a directory, and to "du -b <path>" in case of a file.
     The output is in the form name(full path) size (in bytes)
+
+    With iterator=True, DiskUsage records are returned as they are read,
+    bypassing the metadata cache.
     """
-    cols = ('usage', 'path')
-    return _hadoopfs_columns(cols, '-du', *paths)
+    if options.get('iterator'):
+        return iter(_uncached().du(paths))
+    return _usages(get_backend().du(paths))
 
-def dus(*paths):
+def dus(*paths, **options):
     """Show the amount of space, in bytes, used by the files
     that match the specified file pattern.
 
     Equivalent to the unix command "du -sb".
     The output is in the form name(full path) size (in bytes)
+
+    With iterator=True, DiskUsage records are returned as they are read,
+    bypassing the metadata cache.
     """
-    cols = ('path', 'usage')
-    return _hadoopfs_columns(cols, '-dus', *paths)
+    if options.get('iterator'):
+        return iter(_uncached().dus(paths))
+    return _usages(get_backend().dus(paths))
+
+def _usages(usages):
+    return [u.asdict() for u in usages]
 
 def distcp(dst, *src, **options):
     """Copy file or directories recursively"""
     options = tuple(hadoop_options(**options))
     check_call(('hadoop', 'distcp') + options + src + (dst,))
+    invalidate(dst)
+
+def mtime(path):
+    """Returns the modification time of path in seconds since the epoch,
+    or None if path doesn't exist on HDFS
+
+    The newest modification time is returned when path is a pattern that
+    match more than one file.
+    """
+    return get_backend().mtime(path)
 
 def path_exists(path):
     """
     Returns True if the path exist on HDFS, else False.
     """
-    cmd = ['hadoop', 'fs', '-test', '-e', path]
-    retcode = call(cmd)
-    if retcode > 1:
-        raise CalledProcessError(retcode, cmd)
-    return retcode == 0
+    return get_backend().exists(path)
+
+def stat_many(paths):
+    """Returns a dict with the FileStatus of every path, None for paths that
+    don't exist
+
+    The parent directories of paths are listed in a single backend call,
+    instead of asking for every path. Patterns get the status of their
+    first match.
+    """
+    return dict((path, matches[0] if matches else None)
+            for path, matches in _matches(paths).iteritems())
+
+def exists_many(paths):
+    """Returns a dict telling for every path if it exists, like path_exists
+    but listing the parent directories shared by several paths in a single
+    backend call
+
+    A path alone in its parent directory is checked with path_exists, as
+    listing a large directory for it would cost more.
+    """
+    siblings = {}
+    for path in paths:
+        siblings.setdefault(dirname(_norm(path)), []).append(path)
+    exists = dict((group[0], path_exists(group[0]))
+            for group in siblings.itervalues()
+            if len(group) == 1 and not _GLOB.search(group[0]))
+    exists.update((path, bool(matches)) for path, matches
+            in _matches([p for p in paths if p not in exists]).iteritems())
+    return exists
+
+def rm_many(paths, recursive=False):
+    """Remove the paths that exist with a single rm or rmr call
+
+    Missing paths are ignored. Returns the list of removed paths.
+    """
+    exists = exists_many(paths)
+    existing = [p for p in paths if exists[p]]
+    if existing:
+        (rmr if recursive else rm)(*existing)
+    return existing
+
+def mv_many(moves):
+    """Move every (src, dst) pair of moves
+
+    Moves into the same existing directory keeping the source name are made
+    with a single mv call.
+    """
+    moves = list(moves)
+    intodirs = {}
+    renames = []
+    isdir = dict((p, s is not None and s.isdir) for p, s in
+            stat_many(set(dirname(dst.rstrip('/')) for _, dst in moves))
+            .iteritems())
+    for src, dst in moves:
+        dst = dst.rstrip('/')
+        if basename(dst) == basename(src.rstrip('/')) and isdir[dirname(dst)]:
+            intodirs.setdefault(dirname(dst), []).append(src)
+        else:
+            renames.append((src, dst))
+    for dst, srcs in sorted(intodirs.iteritems()):
+        mv(dst, *srcs)
+    for src, dst in renames:
+        mv(dst, src)
+
+def _matches(paths):
+    """Returns a dict with the list of FileStatus matching every path,
+    listing their parent directories with a single ls call"""
+    matches = dict((path, []) for path in paths)
+    literals = {}
+    patterns = []
+    parents = set()
+    for path in matches:
+        norm = _norm(path)
+        if norm == '/':
+            if path_exists(path):
+                matches[path].append(FileStatus('drwxr-xr-x', None, '', '',
+                    0, datetime.fromtimestamp(0), path))
+            continue
+        parents.add(dirname(norm) or '.')
+        if _GLOB.search(norm) or not norm.startswith('/'):
+            patterns.append((norm, path))
+        else:
+            literals.setdefault(norm, []).append(path)
+    if not parents:
+        return matches
+    for status in get_backend().ls(sorted(parents)):
+        entry = _norm(status.path)
+        for path in literals.get(entry, ()):
+            matches[path].append(status)
+        for norm, path in patterns:
+            if norm.startswith('/'):
+                matched = _globmatch(norm, entry)
+            else:
+                # relative paths are listed from the home directory
+                depth = norm.count('/') + 1
+                matched = _globmatch(norm, '/'.join(entry.split('/')[-depth:]))
+            if matched:
+                matches[path].append(status)
+    return matches
+
+def get_many(dst, *srcs, **options):
+    """Copy files from hdfs into the local file system like get, copying up
+    to jobs files at the same time
+
+    Options:
+        jobs: number of files copied at the same time, 8 by default
+        retries: times a file failing to be copied is retried, 2 by default
+        progress: called with the bytes copied so far, the total and the
+            rate in bytes/s every time a file is copied
+    """
+    matches = _matches(srcs)
+    statuses = []
+    for src in srcs:
+        if not matches[src]:
+            raise IOError(errno.ENOENT, 'No such file or directory', src)
+        statuses.extend(matches[src])
+    intodir = os.path.isdir(dst) or len(statuses) > 1
+    if intodir and not os.path.isdir(dst):
+        os.makedirs(dst)
+    copies = []
+    for status in statuses:
+        target = os.path.join(dst, basename(_norm(status.path))) \
+                if intodir else dst
+        if not status.isdir:
+            copies.append((status.path, target, status.size))
+            continue
+        prefix = len(_norm(status.path)) + 1
+        os.makedirs(target)
+        for child in lsr(status.path, iterator=True):
+            local = os.path.join(target, _norm(child.path)[prefix:])
+            if child.isdir:
+                os.makedirs(local)
+            else:
+                copies.append((child.path, local, child.size))
+
+    def copy((src, target, size)):
+        get(target, src)
+
+    def cleanup((src, target, size)):
+        if os.path.exists(target):
+            os.remove(target)
+    _transfer(copy, copies, options, cleanup)
+
+def put_many(dst, *srcs, **options):
+    """Copy files from the local file system into hdfs like put, copying up
+    to jobs files at the same time
+
+    Takes the jobs, retries and progress options of get_many, and overwrite
+    to replace existing files.
+    """
+    paths = []
+    for src in srcs:
+        matches = sorted(glob.glob(src))
+        if not matches:
+            raise IOError(errno.ENOENT, 'No such file or directory', src)
+        paths.extend(matches)
+    status = stat_many([dst])[dst]
+    intodir = (status is not None and status.isdir) or len(paths) > 1
+    dirs = [dst] if intodir and status is None else []
+    copies = []
+    for path in paths:
+        target = join(dst, os.path.basename(path.rstrip('/'))) \
+                if intodir else dst
+        if not os.path.isdir(path):
+            copies.append((path, target, os.path.getsize(path)))
+            continue
+        dirs.append(target)
+        for root, subdirs, files in os.walk(path):
+            relpath = os.path.relpath(root, path)
+            remote = target if relpath == '.' else join(target, relpath)
+            dirs.extend(join(remote, d) for d in subdirs)
+            copies.extend((os.path.join(root, f), join(remote, f),
+                os.path.getsize(os.path.join(root, f))) for f in files)
+    if options.get('overwrite'):
+        rm_many([target for _, target, _ in copies], recursive=True)
+    if dirs:
+        mkdir(*dirs)
+
+    def copy((path, target, size)):
+        put(target, path)
+
+    def cleanup((path, target, size)):
+        rm_many([target])
+    _transfer(copy, copies, options, cleanup)
+
+def cat_parallel(*paths, **options):
+    """Yields (path, content) for every file matching paths, in order, while
+    the content of the next files is read in advance
+
+    Files of directories matching paths are read, and up to jobs files are
+    kept in memory. Takes the retries and progress options of get_many.
+    """
+    matches = _matches(paths)
+    files = []
+    for path in paths:
+        for status in matches[path]:
+            if status.isdir:
+                files.extend((s.path, s.size) for s in
+                        ls(status.path, iterator=True) if not s.isdir)
+            else:
+                files.append((status.path, status.size))
+
+    def read((path, size)):
+        return path, cat(path).read()
+    options.setdefault('jobs', 4)
+    return _transfers(read, files, options)
+
+def _transfer(func, items, options, cleanup=None):
+    for _ in _transfers(func, items, options, cleanup, ordered=False):
+        pass
+
+def _transfers(func, items, options, cleanup=None, ordered=True):
+    """Yields the results of func called on every (..., size) item by a
+    pool of threads, reporting progress. Failed calls are retried after
+    calling cleanup on their item. Results come in the order of items when
+    ordered, as calls finish otherwise."""
+    retries = options.get('retries', 2)
+    progress = _Progress(sum(i[-1] for i in items), options.get('progress'))
+
+    def transfer(item):
+        for attempt in xrange(retries + 1):
+            try:
+                result = func(item)
+                break
+            except (CalledProcessError, EnvironmentError):
+                if attempt == retries:
+                    raise
+                if cleanup is not None:
+                    cleanup(item)
+        progress.add(item[-1])
+        return result
+    parallel = _parallel if ordered else _unordered
+    return parallel(transfer, items, options.get('jobs', 8))
+
+def _parallel(func, items, jobs):
+    """Yields the results of func called on every item, in order, by up to
+    jobs threads. At most jobs results are computed ahead of the one
+    yielded. The error of a failed call is raised when its turn comes."""
+    items = list(items)
+    calls = [[Event(), None, None] for _ in items] # done, result, exc_info
+    pending = Queue()
+
+    def work():
+        for i in iter(pending.get, None):
+            call = calls[i]
+            try:
+                call[1] = func(items[i])
+            except:
+                call[2] = sys.exc_info()
+            call[0].set()
+    threads = [Thread(target=work) for _ in xrange(min(jobs, len(items)))]
+    for i, thread in enumerate(threads):
+        thread.setDaemon(True)
+        thread.start()
+        pending.put(i)
+    try:
+        for i in xrange(len(items)):
+            # a timeout keeps the main thread responsive to KeyboardInterrupt
+            calls[i][0].wait(86400 * 365)
+            done, result, exc_info = calls[i]
+            calls[i] = None
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if i + len(threads) < len(items):
+                pending.put(i + len(threads))
+            yield result
+    finally:
+        for _ in threads:
+            pending.put(None)
+
+def _unordered(func, items, jobs):
+    """Yields the results of func called on every item by up to jobs
+    threads, as calls finish. Threads take the next item as soon as they are
+    done with one. The error of a failed call is raised at once, and items
+    not started yet are dropped."""
+    items = list(items)
+    pending = Queue()
+    for item in items:
+        pending.put(item)
+    finished = Queue()
+    stopped = Event()
+
+    def work():
+        while not stopped.isSet():
+            try:
+                item = pending.get_nowait()
+            except Empty:
+                return
+            try:
+                finished.put((func(item), None))
+            except:
+                finished.put((None, sys.exc_info()))
+    for _ in xrange(min(jobs, len(items))):
+        thread = Thread(target=work)
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        for _ in items:
+            # a timeout keeps the main thread responsive to KeyboardInterrupt
+            result, exc_info = finished.get(True, 86400 * 365)
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield result
+    finally:
+        stopped.set()
+
+
+class _Progress(object):
+    """Reports the bytes transferred and the transfer rate to a callback"""
+
+    def __init__(self, total, callback=None):
+        self.total = total
+        self.callback = callback
+        self.done = 0
+        self.start = time()
+        self.lock = Lock()
+
+    def add(self, size):
+        self.lock.acquire()
+        try:
+            self.done += size
+            if self.callback is not None:
+                elapsed = max(time() - self.start, 1e-6)
+                self.callback(self.done, self.total, self.done / elapsed)
+        finally:
+            self.lock.release()
+
 
 def hadoop_options(**options):
     """Returns a list of single dashed arguments compatible with hadoop command line
@@ -159,71 +534,1028 @@ def hadoop_options(**options):
             args.extend(p for v in values for p in ['-'+k, v])
     return args
 
+
+## records
+
+class FileStatus(namedtuple('FileStatus',
+        'perms replication user group size mtime path')):
+    """A file of a listing. size is an integer, replication too except for
+    directories where it is None, and mtime is a datetime"""
+    __slots__ = ()
+
+    @property
+    def isdir(self):
+        return self.perms.startswith('d')
+
+    def asdict(self):
+        """Returns the row of strings of the extended ls output"""
+        return {
+            'perms': self.perms,
+            'replication': '-' if self.replication is None \
+                    else str(self.replication),
+            'user': self.user,
+            'group': self.group,
+            'size': str(self.size),
+            'date': self.mtime.strftime('%Y-%m-%d'),
+            'time': self.mtime.strftime('%H:%M'),
+            'path': self.path,
+        }
+
+
+class DiskUsage(namedtuple('DiskUsage', 'path usage')):
+    """Space used by path, in bytes"""
+    __slots__ = ()
+
+    def asdict(self):
+        return {'path': self.path, 'usage': str(self.usage)}
+
+
+## backends
+
+_backend = None
+
+def get_backend():
+    """Returns the backend used by the module functions"""
+    global _backend
+    if _backend is None:
+        if os.environ.get('SWORKFLOW_WEBHDFS'):
+            from sworkflow.webhdfs import WebHDFS
+            _backend = WebHDFS(os.environ['SWORKFLOW_WEBHDFS'])
+        else:
+            _backend = FsShell()
+    return _backend
+
+def set_backend(backend):
+    """Use backend for the module functions and return the previous one"""
+    global _backend
+    previous, _backend = _backend, backend
+    return previous
+
+def enable_cache(ttl=60):
+    """Cache metadata results of the current backend for ttl seconds"""
+    backend = get_backend()
+    if not isinstance(backend, MetadataCache):
+        set_backend(MetadataCache(backend, ttl))
+
+def disable_cache():
+    backend = get_backend()
+    if isinstance(backend, MetadataCache):
+        set_backend(backend.backend)
+
+def _uncached():
+    """Returns the backend, bypassing the metadata cache"""
+    backend = get_backend()
+    if isinstance(backend, MetadataCache):
+        return backend.backend
+    return backend
+
+def invalidate(path=None):
+    """Forget cached metadata about path, or about every path if None
+
+    It must be called after HDFS is modified by other processes, eg. by a
+    spawned job, so the cache doesn't answer with outdated results.
+    """
+    backend = get_backend()
+    if isinstance(backend, MetadataCache):
+        backend.invalidate(path)
+
+
+class FsShell(object):
+    """Backend running a "hadoop fs" command for every operation"""
+
+    def ls(self, paths, recursive=False):
+        fscmd = '-lsr' if recursive else '-ls'
+        return _hadoopfs_records(_lsparse, fscmd, *paths)
+
+    def du(self, paths):
+        return _hadoopfs_records(_duparse, '-du', *paths)
+
+    def dus(self, paths):
+        return _hadoopfs_records(_dusparse, '-dus', *paths)
+
+    def mv(self, dst, srcs):
+        check_call(('hadoop', 'fs', '-mv') + tuple(srcs) + (dst,))
+
+    def rename(self, src, dst, overwrite=False):
+        if overwrite and self.exists(dst):
+            # hadoop fs -mv never replaces an existing destination
+            _rename_aside(self, src, dst)
+        else:
+            self.mv(dst, [src])
+
+    def cp(self, dst, srcs):
+        check_call(('hadoop', 'fs', '-cp') + tuple(srcs) + (dst,))
+
+    def rm(self, paths):
+        check_call(('hadoop', 'fs', '-rm') + tuple(paths))
+
+    def rmr(self, paths):
+        check_call(('hadoop', 'fs', '-rmr') + tuple(paths))
+
+    def put(self, dst, srcs, stdin=None):
+        if stdin is not None:
+            check_call(('hadoop', 'fs', '-put', '-', dst), stdin=stdin)
+        else:
+            check_call(('hadoop', 'fs', '-put') + tuple(srcs) + (dst,))
+
+    def create(self, path, overwrite=False):
+        if overwrite and self.exists(path):
+            self.rmr([path])
+        return _CommandInput(('hadoop', 'fs', '-put', '-', path))
+
+    def get(self, dst, srcs):
+        check_call(('hadoop', 'fs', '-get') + tuple(srcs) + (dst,))
+
+    def cat(self, paths):
+        return io.BufferedReader(_PipeStream(('hadoop', 'fs', '-cat') +
+            tuple(paths)))
+
+    def mkdir(self, paths, fail_if_exists=False):
+        errbuf = TemporaryFile()
+        try:
+            check_call(('hadoop', 'fs', '-mkdir') + tuple(paths), stderr=errbuf)
+        except CalledProcessError, ex:
+            if fail_if_exists or ex.returncode != 255:
+                errbuf.seek(0)
+                print >> sys.stderr, errbuf.read()
+                raise
+
+    def touchz(self, paths):
+        check_call(('hadoop', 'fs', '-touchz') + tuple(paths))
+
+    def mtime(self, path):
+        cmd = ('hadoop', 'fs', '-stat', '%Y', path)
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout = proc.communicate()[0]
+        if proc.returncode:
+            if self.exists(path):
+                raise CalledProcessError(proc.returncode, cmd)
+            return None
+        return max(int(v) for v in stdout.split()) / 1000.0
+
+    def exists(self, path):
+        cmd = ['hadoop', 'fs', '-test', '-e', path]
+        retcode = call(cmd)
+        if retcode > 1:
+            raise CalledProcessError(retcode, cmd)
+        return retcode == 0
+
+
+class MetadataCache(object):
+    """Backend wrapper caching ls, du, dus, exists and mtime results
+
+    Recursive listings, which can be huge, are streamed from the backend
+    and never cached. Other results are kept for ttl seconds, and results
+    about paths modified by operations made through this backend are
+    forgotten immediately. Paths seen in cached listings are known to exist
+    without asking the backend.
+    Relative paths are cached as the absolute paths they stand for in the
+    home directory of the user.
+    """
+
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.home = join('/user', getattr(backend, 'user', None)
+                or os.environ.get('HADOOP_USER_NAME')
+                or os.environ.get('USER') or '')
+        self.lock = Lock()
+        self.results = {} # (op, paths, args) -> (expires, result)
+        self.known = {} # existing path -> expires
+        # bumped by invalidate(), results computed before aren't kept
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # operations not cached go straight to the backend
+        return getattr(self.backend, name)
+
+    def _abspath(self, path):
+        """Returns the absolute form of path used in cache keys"""
+        return join(self.home, _norm(path))
+
+    def _cached(self, key, func, *args):
+        self.lock.acquire()
+        try:
+            expires, result = self.results.get(key, (0, None))
+            if expires > time():
+                self.hits += 1
+                return result
+            self.misses += 1
+            generation = self.generation
+        finally:
+            self.lock.release()
+        result = func(*args)
+        self.lock.acquire()
+        try:
+            # paths may have changed while the backend was answering
+            if generation == self.generation:
+                self.results[key] = (time() + self.ttl, result)
+        finally:
+            self.lock.release()
+        return result
+
+    def _learn(self, paths, rows, generation):
+        """Remember that paths of rows and listed paths they show exist"""
+        expires = time() + self.ttl
+        found = set(self._abspath(row.path) for row in rows)
+        # a listed path exists when it was returned or one of its children
+        # was, rows of the other paths say nothing about it
+        shown = found | set(dirname(path) for path in found)
+        found.update([path for path in paths if path in shown])
+        self.lock.acquire()
+        try:
+            if generation != self.generation:
+                return
+            for path in found:
+                self.known[path] = expires
+        finally:
+            self.lock.release()
+
+    def ls(self, paths, recursive=False):
+        if recursive:
+            return self.backend.ls(paths, recursive)
+        key = tuple(self._abspath(p) for p in paths)
+        generation = self.generation
+        rows = self._cached(('ls', key, bool(recursive)),
+                _list, self.backend.ls, tuple(paths), recursive)
+        self._learn(key, rows, generation)
+        return list(rows)
+
+    def du(self, paths):
+        key = tuple(self._abspath(p) for p in paths)
+        return list(self._cached(('du', key), _list, self.backend.du,
+            tuple(paths)))
+
+    def dus(self, paths):
+        key = tuple(self._abspath(p) for p in paths)
+        return list(self._cached(('dus', key), _list, self.backend.dus,
+            tuple(paths)))
+
+    def mtime(self, path):
+        return self._cached(('mtime', (self._abspath(path),)),
+                self.backend.mtime, path)
+
+    def exists(self, path):
+        key = self._abspath(path)
+        if self.known.get(key, 0) > time():
+            self.hits += 1
+            return True
+        return self._cached(('exists', (key,)), self.backend.exists, path)
+
+    def invalidate(self, path=None):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            if path is None:
+                self.results.clear()
+                self.known.clear()
+                return
+            changed = _prefix(self._abspath(path))
+            overlap = lambda p: p.startswith(changed) or changed.startswith(p)
+            for key in self.results.keys():
+                if [p for p in key[1] if overlap(_prefix(p))]:
+                    del self.results[key]
+            for known in self.known.keys():
+                if known.startswith(changed):
+                    del self.known[known]
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.results)}
+
+    def mv(self, dst, srcs):
+        try:
+            self.backend.mv(dst, srcs)
+        finally:
+            self._invalidate([dst] + list(srcs))
+
+    def rename(self, src, dst, overwrite=False):
+        try:
+            self.backend.rename(src, dst, overwrite=overwrite)
+        finally:
+            self._invalidate([src, dst])
+
+    def cp(self, dst, srcs):
+        try:
+            self.backend.cp(dst, srcs)
+        finally:
+            self._invalidate([dst])
+
+    def rm(self, paths):
+        try:
+            self.backend.rm(paths)
+        finally:
+            self._invalidate(paths)
+
+    def rmr(self, paths):
+        try:
+            self.backend.rmr(paths)
+        finally:
+            self._invalidate(paths)
+
+    def put(self, dst, srcs, stdin=None):
+        try:
+            self.backend.put(dst, srcs, stdin=stdin)
+        finally:
+            self._invalidate([dst])
+
+    def create(self, path, overwrite=False):
+        self._invalidate([path])
+        return self.backend.create(path, overwrite=overwrite)
+
+    def mkdir(self, paths, fail_if_exists=False):
+        try:
+            self.backend.mkdir(paths, fail_if_exists=fail_if_exists)
+        finally:
+            self._invalidate(paths)
+
+    def touchz(self, paths):
+        try:
+            self.backend.touchz(paths)
+        finally:
+            self._invalidate(paths)
+
+    def _invalidate(self, paths):
+        for path in paths:
+            self.invalidate(path)
+
+
 ## helpers
-def _hadoopfs_columns(cols, *args):
-    stdout = Popen(('hadoop', 'fs') + args, stdout=PIPE).communicate()[0]
-    rows = (line.strip().split() for line in stdout.splitlines())
-    return [dict(zip(cols, row)) for row in rows if len(row) == len(cols)]
+_GLOB = re.compile(r'[*?[{]')
+
+def _norm(path):
+    """Returns path without scheme, authority and trailing slashes
+
+    >>> _norm('hdfs://namenode:9000/data/logs/')
+    '/data/logs'
+    """
+    if '://' in path:
+        path = urlsplit(path).path
+    elif path.startswith('hdfs:'):
+        path = path[len('hdfs:'):]
+    return path.rstrip('/') or '/'
+
+def _prefix(path):
+    """Returns the part of a path before any glob pattern
+
+    >>> _prefix('/data/logs_wip*')
+    '/data/logs_wip'
+    """
+    return _GLOB.split(_norm(path), 1)[0]
+
+_LSPERMS = re.compile(r'[d-][rwxstST-]{9}')
+
+def _list(func, *args):
+    return list(func(*args))
+
+def _hadoopfs_records(parse, *args):
+    """Yields the records parsed from the output of a "hadoop fs" command
+    while it runs, skipping the lines parse returns None for"""
+    proc = Popen(('hadoop', 'fs') + args, stdout=PIPE)
+    try:
+        for line in proc.stdout:
+            record = parse(line)
+            if record is not None:
+                yield record
+    finally:
+        # the command gets a broken pipe if the generator is closed early
+        proc.stdout.close()
+        proc.wait()
+
+def _lsparse(line):
+    """Returns the FileStatus of a line of "hadoop fs -ls" output
+
+    >>> _lsparse('-rw-r--r--   3 root supergroup       7485 '
+    ...     '2010-06-16 17:28 /data/a file.txt\\n') # doctest: +NORMALIZE_WHITESPACE
+    FileStatus(perms='-rw-r--r--', replication=3, user='root',
+        group='supergroup', size=7485,
+        mtime=datetime.datetime(2010, 6, 16, 17, 28), path='/data/a file.txt')
+    >>> _lsparse('drwxr-xr-x   - root supergroup 0 2010-06-16 17:28 /data').isdir
+    True
+    >>> _lsparse('Found 2 items\\n') is None
+    True
+    """
+    fields = line.rstrip('\r\n').split(None, 7)
+    if len(fields) != 8 or not _LSPERMS.match(fields[0]):
+        return None
+    perms, replication, user, group, size, date, hm, path = fields
+    return FileStatus(perms, None if replication == '-' else int(replication),
+            user, group, int(size), datetime(int(date[:4]), int(date[5:7]),
+                int(date[8:10]), int(hm[:2]), int(hm[3:5])), path)
+
+def _duparse(line):
+    """Returns the DiskUsage of a line of "hadoop fs -du" output
+
+    >>> _duparse('12          hdfs://namenode/data/logs/part-00000\\n')
+    DiskUsage(path='hdfs://namenode/data/logs/part-00000', usage=12)
+    """
+    fields = line.rstrip('\r\n').split(None, 1)
+    if len(fields) == 2 and fields[0].isdigit():
+        return DiskUsage(fields[1], int(fields[0]))
+
+def _dusparse(line):
+    """Returns the DiskUsage of a line of "hadoop fs -dus" output
+
+    >>> _dusparse('hdfs://namenode/data/logs\\t18\\n')
+    DiskUsage(path='hdfs://namenode/data/logs', usage=18)
+    """
+    fields = line.rsplit(None, 1)
+    if len(fields) == 2 and fields[1].isdigit():
+        return DiskUsage(fields[0], int(fields[1]))
+
+def _filestatus(path, status):
+    """Returns the FileStatus of path from a WebHDFS FileStatus JSON object
+
+    >>> status = _filestatus('/data/f', {'type': 'FILE', 'permission': '644',
+    ...     'replication': 3, 'owner': 'root', 'group': 'supergroup',
+    ...     'length': 7485, 'modificationTime': 0})
+    >>> status.perms, status.replication, status.size, status.path
+    ('-rw-r--r--', 3, 7485, '/data/f')
+    """
+    isdir = status['type'] == 'DIRECTORY'
+    return FileStatus(('d' if isdir else '-') + _perms(status['permission']),
+            None if isdir else status['replication'], status['owner'],
+            status['group'], status['length'],
+            datetime.fromtimestamp(status['modificationTime'] / 1000.0), path)
+
+def _braces(pattern):
+    """Expand {a,b} alternatives of a glob pattern
+
+    >>> _braces('part-{0001,0002}.gz')
+    ['part-0001.gz', 'part-0002.gz']
+    >>> _braces('part-*')
+    ['part-*']
+    """
+    match = re.search(r'\{([^{}]*)\}', pattern)
+    if not match:
+        return [pattern]
+    head, tail = pattern[:match.start()], pattern[match.end():]
+    return [p for alt in match.group(1).split(',')
+            for p in _braces(head + alt + tail)]
+
+def _globmatch(pattern, path):
+    """Returns True if path matches pattern, wildcards don't match slashes
+
+    >>> _globmatch('/data/logs_*/part-{0,1}', '/data/logs_wip/part-1')
+    True
+    >>> _globmatch('/data/*', '/data/logs/part-0')
+    False
+    """
+    parts, names = pattern.split('/'), path.split('/')
+    if len(parts) != len(names):
+        return False
+    for part, name in zip(parts, names):
+        if not [a for a in _braces(part) if fnmatchcase(name, a)]:
+            return False
+    return True
+
+def _tmpsibling(path, tag):
+    """Returns a new hidden path in the directory of path, hadoop input
+    formats ignore such paths
+
+    >>> _tmpsibling('/data/out.txt', 'tmp') # doctest: +ELLIPSIS
+    '/data/.out.txt.tmp-...'
+    """
+    path = path.rstrip('/')
+    return join(dirname(path), '.%s.%s-%s' % (basename(path), tag,
+        uuid4().hex[:12]))
+
+def _rename_aside(fs, src, dst):
+    """Replace dst by src on backends that only rename to new paths, dst is
+    moved aside and deleted once src has taken its place
+
+    Not atomic: dst is missing between the two renames.
+    """
+    aside = _tmpsibling(dst, 'old')
+    fs.mv(aside, [dst])
+    try:
+        fs.mv(dst, [src])
+    except:
+        fs.mv(dst, [aside])
+        raise
+    fs.rmr([aside])
+
+def _perms(octal):
+    """Returns the symbolic notation of octal permissions
+
+    >>> _perms('755')
+    'rwxr-xr-x'
+    >>> _perms('1777')
+    'rwxrwxrwx'
+    """
+    bits = int(octal, 8)
+    return ''.join(c if bits & (1 << (8 - i)) else '-'
+            for i, c in enumerate('rwxrwxrwx'))
 
 
 class HDFSOutputFile(object):
     """
     Helper to create a file on HDFS and write to it
+
+    The content is uploaded while it is written, to a hidden file next to
+    hdfspath which replaces hdfspath on close(), so readers never see a
+    partial file. The replacement is atomic only with the WebHDFS backend
+    on namenodes supporting rename with overwrite. With "hadoop fs", the
+    old hdfspath is moved aside first, and it is missing for a moment.
+    discard(), or an exception raised in a with statement, drops the new
+    content and leaves hdfspath as it was.
     """
     def __init__(self, hdfspath):
         self.hdfspath = hdfspath
-        self.buf = TemporaryFile()
-        self.write = self.buf.write
-        self.writelines = self.buf.writelines
+        self.tmppath = _tmpsibling(hdfspath, 'tmp')
+        self.stream = get_backend().create(self.tmppath)
+        self.write = self.stream.write
+        self.writelines = self.stream.writelines
+        self.closed = False
 
     def close(self):
-        self.buf.seek(0)
-        if path_exists(self.hdfspath):
-            # FIXME: removing and writing the new file should be made atomically
-            rmr(self.hdfspath)
-        check_call(['hadoop', 'fs', '-put', '-', self.hdfspath], stdin=self.buf)
-        self.buf.close()
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.stream.close()
+            rename(self.tmppath, self.hdfspath, overwrite=True)
+        except:
+            self._remove_tmp()
+            raise
+
+    def discard(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.stream.close()
+        finally:
+            self._remove_tmp()
+
+    def _remove_tmp(self):
+        if path_exists(self.tmppath):
+            rm(self.tmppath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
 
 class HDFSInputFile(object):
     """
     Helper to read from a HDFS file
+
+    The content is streamed while it is read, a thread fetching up to
+    readahead bytes in advance. Files are decompressed with compression set
+    to 'gzip' or 'snappy' (Hadoop SnappyCodec, needs python-snappy), or to
+    'auto' to guess it from the file extension. Seeking needs
+    seekable=True, the content read is then kept in a local temporary file.
     """
-    def __init__(self, hdfspath):
+    chunksize = 1024 * 1024
+
+    def __init__(self, hdfspath, readahead=4 * 1024 * 1024, compression=None,
+            seekable=False):
         self.hdfspath = hdfspath
-        self.buf = TemporaryFile()
-        check_call(['hadoop', 'fs', '-cat', self.hdfspath], stdout=self.buf)
-        self.buf.seek(0)
-        self.read = self.buf.read
-        self.readlines = self.buf.readlines
-        self.close = self.buf.close
+        stream = _ReadAhead(cat(hdfspath), self.chunksize,
+                max(1, readahead // self.chunksize))
+        decompressor = _decompressor(hdfspath, compression)
+        if decompressor is not None:
+            stream = _DecompressStream(stream, decompressor, self.chunksize)
+        if seekable:
+            stream = _SpooledStream(stream)
+        self.stream = io.BufferedReader(stream)
+        self.read = self.stream.read
+        self.readinto = self.stream.readinto
+        self.readline = self.stream.readline
+        self.readlines = self.stream.readlines
+        self.seek = self.stream.seek
+        self.tell = self.stream.tell
+        self.close = self.stream.close
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _PipeStream(io.RawIOBase):
+    """Raw stream with the output of a command, raising CalledProcessError
+    at the end of the output if the command failed"""
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = Popen(cmd, stdout=PIPE, close_fds=True)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = os.read(self.proc.stdout.fileno(), len(b))
+        if not data and self.proc.wait():
+            raise CalledProcessError(self.proc.returncode, self.cmd)
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            # the command gets a broken pipe if it didn't finish
+            self.proc.stdout.close()
+            self.proc.wait()
+        io.RawIOBase.close(self)
+
+
+class _CommandInput(object):
+    """File object writing to the input of a command, close() raises
+    CalledProcessError if the command failed"""
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = Popen(cmd, stdin=PIPE, bufsize=64 * 1024, close_fds=True)
+        self.write = self.proc.stdin.write
+        self.writelines = self.proc.stdin.writelines
+
+    def close(self):
+        if not self.proc.stdin.closed:
+            self.proc.stdin.close()
+        if self.proc.wait():
+            raise CalledProcessError(self.proc.returncode, self.cmd)
+
+    def abort(self):
+        """Kill the command before it gets the end of its input"""
+        if self.proc.poll() is None:
+            self.proc.kill()
+        if not self.proc.stdin.closed:
+            self.proc.stdin.close()
+        self.proc.wait()
+
+
+def _abort(stream):
+    """Give up writing a stream returned by create, if it can be"""
+    abort = getattr(getattr(stream, 'raw', stream), 'abort', None)
+    if abort is not None:
+        abort()
+
+
+class _ReadAhead(io.RawIOBase):
+    """Raw stream reading chunks of source in a thread, at most depth chunks
+    ahead of the reader. Errors of the source are raised to the reader."""
+
+    def __init__(self, source, chunksize, depth):
+        self.source = source
+        self.chunksize = chunksize
+        self.chunks = Queue(depth)
+        self.chunk = ''
+        self.offset = 0
+        self.eof = False
+        self.stopped = False
+        thread = Thread(target=self._fill)
+        thread.setDaemon(True)
+        thread.start()
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        try:
+            try:
+                while not self.stopped:
+                    data = self.source.read(self.chunksize)
+                    self._put(data)
+                    if not data:
+                        break
+            except:
+                self._put(sys.exc_info())
+        finally:
+            self.source.close()
+
+    def _put(self, item):
+        while not self.stopped:
+            try:
+                self.chunks.put(item, True, 0.1)
+                return
+            except Full:
+                pass
+
+    def readinto(self, b):
+        if self.offset == len(self.chunk):
+            if self.eof:
+                return 0
+            # a timeout keeps the main thread responsive to KeyboardInterrupt
+            item = self.chunks.get(True, 86400 * 365)
+            if isinstance(item, tuple):
+                self.eof = True
+                raise item[0], item[1], item[2]
+            if not item:
+                self.eof = True
+                return 0
+            self.chunk, self.offset = item, 0
+        n = min(len(b), len(self.chunk) - self.offset)
+        b[:n] = buffer(self.chunk, self.offset, n)
+        self.offset += n
+        return n
+
+    def close(self):
+        # the thread closes the source when it sees it is stopped
+        self.stopped = True
+        io.RawIOBase.close(self)
+
+
+class _DecompressStream(io.RawIOBase):
+    """Raw stream with the decompressed content of a raw stream"""
+
+    def __init__(self, raw, decompressor, chunksize):
+        self.raw = raw
+        self.decompressor = decompressor
+        self.chunksize = chunksize
+        self.data = ''
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.offset == len(self.data):
+            compressed = self.raw.read(self.chunksize)
+            if not compressed:
+                return 0
+            self.data, self.offset = self.decompressor.decompress(compressed), 0
+        n = min(len(b), len(self.data) - self.offset)
+        b[:n] = buffer(self.data, self.offset, n)
+        self.offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        io.RawIOBase.close(self)
+
+
+class _SpooledStream(io.RawIOBase):
+    """Seekable raw stream keeping what is read from a raw stream in a local
+    temporary file"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.spool = TemporaryFile()
+        self.size = 0 # bytes spooled
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _fetch(self, size):
+        data = self.raw.read(size)
+        self.spool.seek(self.size)
+        self.spool.write(data)
+        self.size += len(data)
+        return data
+
+    def readinto(self, b):
+        if self.pos < self.size:
+            self.spool.seek(self.pos)
+            data = self.spool.read(min(len(b), self.size - self.pos))
+        else:
+            while self.size < self.pos and self._fetch(self.pos - self.size):
+                pass
+            data = self._fetch(len(b)) if self.size == self.pos else ''
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            while self._fetch(HDFSInputFile.chunksize):
+                pass
+            offset += self.size
+        if offset < 0:
+            raise IOError('negative seek position %d' % offset)
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+            self.spool.close()
+        io.RawIOBase.close(self)
+
+
+def _decompressor(path, compression):
+    """Returns a decompressor object for the compression of path
+
+    >>> _decompressor('/data/part-00000.gz', 'auto') # doctest: +ELLIPSIS
+    <sworkflow.hdfs._GzipDecompressor object at ...>
+    >>> _decompressor('/data/part-00000', 'auto') is None
+    True
+    """
+    if compression == 'auto':
+        compression = {'.gz': 'gzip', '.snappy': 'snappy'}.get(
+                os.path.splitext(path)[1])
+    if compression == 'gzip':
+        return _GzipDecompressor()
+    elif compression == 'snappy':
+        return _SnappyDecompressor()
+    elif compression is not None:
+        raise ValueError('Unknown compression %r' % compression)
+
+
+class _GzipDecompressor(object):
+    """Decompressor of gzip data, including concatenated gzip members"""
+
+    def __init__(self):
+        self.zobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        parts = []
+        while data:
+            parts.append(self.zobj.decompress(data))
+            data = self.zobj.unused_data
+            if data:
+                self.zobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return ''.join(parts)
+
+
+class _SnappyDecompressor(object):
+    """Decompressor of the block format of Hadoop SnappyCodec: blocks start
+    with their uncompressed length followed by compressed chunks, every
+    length being a 4 bytes big endian integer
+
+    >>> d = _SnappyDecompressor(uncompress=lambda chunk: chunk.upper())
+    >>> d.decompress('\\0\\0\\0\\x05\\0\\0\\0\\x03abc\\0\\0')
+    'ABC'
+    >>> d.decompress('\\0\\x02de')
+    'DE'
+    """
+
+    def __init__(self, uncompress=None):
+        if uncompress is None:
+            import snappy
+            uncompress = snappy.uncompress
+        self.uncompress = uncompress
+        self.buf = ''
+        self.remaining = 0 # uncompressed bytes left in the current block
+
+    def decompress(self, data):
+        buf = self.buf + data
+        parts = []
+        offset = 0
+        while len(buf) - offset >= 4:
+            length = struct.unpack('>I', buf[offset:offset + 4])[0]
+            if not self.remaining:
+                self.remaining = length
+                offset += 4
+                continue
+            if len(buf) - offset - 4 < length:
+                break
+            chunk = self.uncompress(buf[offset + 4:offset + 4 + length])
+            self.remaining -= len(chunk)
+            parts.append(chunk)
+            offset += 4 + length
+        self.buf = buf[offset:]
+        return ''.join(parts)
 
 
 class HDFSWriter(object):
     """
     Helper to write a file on HDFS but using part-XXXXX format.
+
+    A new part is started every partsize lines, or once partbytes bytes
+    (before compression) were written to the current part. partsize is
+    100000 lines by default, and unlimited when only partbytes is given.
+    Parts are uploaded by threads, up to uploads of them at the same time.
+    With compression='gzip' the threads compress the parts, named
+    part-XXXXX.gz then.
     """
-    def __init__(self, path, partsize=100000):
+    batchsize = 64 * 1024
+
+    def __init__(self, path, partsize=None, partbytes=None, uploads=1,
+            compression=None):
         assert path not in ('/', ''), "Cannot create HDFSWriter on %r" % path
+        assert compression in (None, 'gzip'), \
+                "Unknown compression %r" % compression
         self.path = path
         if path_exists(path):
             rmr(path)
+        if partsize is None and partbytes is None:
+            partsize = 100000
         self.partsize = partsize
+        self.partbytes = partbytes
+        self.uploads = max(1, uploads)
+        self.compression = compression
         self.part = 0
         self.count = 0
-        self.hadoop = None
+        self.size = 0
+        self.upload = None
+        self.inflight = []
+        self.batch = []
+        self.batchlen = 0
 
     def write(self, line):
-        if self.count % self.partsize == 0:
-            if self.hadoop:
-                self.hadoop.communicate()
-            path = join(self.path, "part-%05d" % self.part)
-            self.hadoop = Popen(['hadoop', 'fs', '-put', '-', path], \
-                stdin=PIPE, close_fds=True)
-            self.part += 1
-        self.hadoop.stdin.write(line)
+        if self.upload is None or self.count == self.partsize or \
+                (self.partbytes and self.size >= self.partbytes):
+            self._roll()
+        self.batch.append(line)
+        self.batchlen += len(line)
         self.count += 1
+        self.size += len(line)
+        if self.batchlen >= self.batchsize:
+            self._flush()
+
+    def _flush(self):
+        if self.batch:
+            self.upload.put(''.join(self.batch))
+            self.batch = []
+            self.batchlen = 0
+
+    def _roll(self):
+        if self.upload is not None:
+            self._flush()
+            self.upload.finish()
+            self.inflight.append(self.upload)
+        while len(self.inflight) >= self.uploads:
+            self.inflight.pop(0).wait()
+        name = "part-%05d" % self.part
+        if self.compression == 'gzip':
+            name += '.gz'
+        self.upload = _PartUpload(join(self.path, name), self.compression)
+        self.part += 1
+        self.count = 0
+        self.size = 0
 
     def complete(self):
-        if self.hadoop and self.hadoop.poll() is None:
-            self.hadoop.communicate()
+        if self.upload is not None:
+            self._flush()
+            self.upload.finish()
+            self.inflight.append(self.upload)
+            self.upload = None
+        inflight, self.inflight = self.inflight, []
+        for upload in inflight:
+            upload.wait()
+
+
+class _PartUpload(object):
+    """Upload of a part fed with blocks of data, compressed and written to
+    HDFS by a thread"""
+
+    def __init__(self, path, compression, depth=16):
+        self.path = path
+        self.compression = compression
+        self.blocks = Queue(depth)
+        self.exc_info = None
+        self.thread = Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self):
+        stream = None
+        finished = False # the end of the blocks was taken
+        try:
+            stream = get_backend().create(self.path)
+            compressor = None
+            if self.compression == 'gzip':
+                compressor = zlib.compressobj(6, zlib.DEFLATED,
+                        16 + zlib.MAX_WBITS)
+            for block in iter(self.blocks.get, None):
+                stream.write(compressor.compress(block) if compressor
+                        else block)
+            finished = True
+            if compressor:
+                stream.write(compressor.flush())
+            stream.close()
+        except:
+            self.exc_info = sys.exc_info()
+            if stream is not None:
+                _abort(stream)
+            if not finished:
+                # consume what is left so the writer isn't blocked
+                for _ in iter(self.blocks.get, None):
+                    pass
+
+    def put(self, block):
+        self.blocks.put(block)
+
+    def finish(self):
+        self.blocks.put(None)
+
+    def wait(self):
+        """Wait for the upload to end, raising its error if it failed"""
+        # a timeout keeps the main thread responsive to KeyboardInterrupt
+        self.thread.join(86400 * 365)
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
 
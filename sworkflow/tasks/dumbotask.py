@@ -1,34 +1,77 @@
 from time import sleep
+from posixpath import join
 from sworkflow import hdfs
 from .pythontask import PythonTask
 
-def job_succeeded(output_dir, _ls=hdfs.ls, allow_empty=False):
+def job_succeeded(output_dir, _ls=hdfs.ls, allow_empty=False,
+        _exists=hdfs.path_exists):
     """Check if dumbo job succeed looking at output dir content
 
     dumbo has not a nice way to detect when a hadoop job failed,
-    this function looks for incosistent data in output_dir.
+    hadoop marks successful jobs with a _SUCCESS file in output_dir.
+    Without this marker, this function looks for incosistent data in
+    output_dir.
 
     it checks:
     * output_dir must be non-empty (except if allow_empty=True)
     * _temporary subdir shouldn't be present
 
     >>> testls = lambda *a, **kw: paths
+    >>> testexists = lambda path: path in paths
+    >>> paths = ['/output_dir/_SUCCESS']
+    >>> job_succeeded('/output_dir/', _ls=None, _exists=testexists)
+    True
     >>> paths = ['/outputdir/part-000']
-    >>> job_succeeded('/output_dir/', _ls=testls)
+    >>> job_succeeded('/output_dir/', _ls=testls, _exists=testexists)
     True
     >>> paths = []
-    >>> job_succeeded('/output_dir/', _ls=testls)
+    >>> job_succeeded('/output_dir/', _ls=testls, _exists=testexists)
     False
     >>> paths = ['/output_dir/something', '/dev/output_dir/_temporary']
-    >>> job_succeeded('/output_dir/', _ls=testls)
+    >>> job_succeeded('/output_dir/', _ls=testls, _exists=testexists)
     False
     >>> paths = []
-    >>> job_succeeded('/output_dir/', _ls=testls, allow_empty=True)
+    >>> job_succeeded('/output_dir/', _ls=testls, allow_empty=True,
+    ...     _exists=testexists)
     True
     """
+    if _exists(join(output_dir, '_SUCCESS')):
+        return True
     paths = _ls(output_dir)
     return bool(paths or allow_empty) and all('_temporary' not in p for p in paths)
 
+def any_matches(pattern):
+    """Returns True if paths match pattern on HDFS
+
+    Unlike path_exists, patterns are expanded on every backend and the
+    backend is asked every time, bypassing the metadata cache.
+    """
+    for _ in hdfs.dus(pattern, iterator=True):
+        return True
+    return False
+
+def wait_removed(path, timeout=60, _exists=any_matches, _sleep=sleep):
+    """Wait until no path matches path, polling with an exponential backoff
+
+    Returns False if path still exists after about timeout seconds.
+
+    >>> polls = [True, True, False]
+    >>> delays = []
+    >>> wait_removed('/output_wip*', _exists=lambda p: polls.pop(0),
+    ...     _sleep=delays.append)
+    True
+    >>> delays
+    [0.1, 0.2]
+    """
+    delay, waited = 0.1, 0
+    while _exists(path):
+        if waited >= timeout:
+            return False
+        _sleep(delay)
+        waited += delay
+        delay = min(delay * 2, 5)
+    return True
+
 def dumbo_args(prog, **options):
     """Returns a list of args suitable to execute as indexer job
 
@@ -67,7 +110,10 @@ class DumboTask(PythonTask):
         if hdfs.dus(wip + '*'):
             self.log('Removing intermediate outputs found under %s*', wip)
             hdfs.rmr(wip + '*')
-            sleep(3) # give hdfs a chance to remove dir before job recreate it
+            # give hdfs a chance to remove dir before job recreate it
+            if not wait_removed(wip + '*'):
+                raise RuntimeError('Intermediate outputs still found under '
+                        '%s*' % wip)
 
         # Compute dumbo args and execute dumbo program
         self.execargs = self._execargs(output=wip)
@@ -0,0 +1,45 @@
+"""
+Run the modules of a chain of PythonTasks one after the other in a single
+interpreter
+
+    python -m sworkflow.tasks.fused '[{"execargs": [...], "env": null,
+        "cwd": null}, ...]'
+
+Each module runs as python -m would run it, the process state it changed is
+restored before the next one. The start and the exit status of every module
+are written to stdout between its output, the first module failing stops
+the chain and its status is the status of the process.
+"""
+import os
+import sys
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from sworkflow.tasks.workers import _run_restoring, _decode
+
+# prefix of the lines reporting the progress of the chain
+STEP = '\0sworkflow-step '
+
+
+def main():
+    steps = json.loads(sys.argv[1])
+    status = 0
+    for k, step in enumerate(steps):
+        _report('%d start' % k)
+        starttime = time.time()
+        status = _run_restoring(*_decode(step))
+        _report('%d exit %d %f' % (k, status, time.time() - starttime))
+        if status:
+            break
+    return status
+
+def _report(event):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.write(sys.stdout.fileno(), '%s%s\n' % (STEP, event))
+
+if __name__ == '__main__':
+    sys.exit(main())
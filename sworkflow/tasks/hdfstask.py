@@ -61,8 +61,9 @@ class HDFSActionTask(FsActionTask):
         elif cmd == 'rmr':
             hdfs.rmr(*self.paths)
         elif cmd == 'path_exists':
-            for path in self.paths:
-                assert hdfs.path_exists(path), 'path does not exists %s' % path
+            exists = hdfs.exists_many(self.paths)
+            missing = [p for p in self.paths if not exists[p]]
+            assert not missing, 'path does not exists %s' % ', '.join(missing)
         elif cmd == 'distcp':
             hdfs.distcp(self.dest, *self.paths, **options)
         else:
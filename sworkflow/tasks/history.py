@@ -0,0 +1,52 @@
+"""
+Task duration history
+
+Keeps the durations of the last runs of every task of a workflow, so the
+engine can estimate how long each task is going to take.
+"""
+from .state import load_json, save_json
+
+
+class TaskHistory(object):
+    """Durations in seconds of the last runs of each task id
+
+    >>> h = TaskHistory()
+    >>> h.add('T1', 10)
+    >>> h.add('T1', 20)
+    >>> h.estimate('T1')
+    15.0
+    >>> h.estimate('T2') is None
+    True
+    >>> h.estimate('T2', default=3)
+    3
+    """
+    # number of durations kept for each task
+    keep = 10
+
+    def __init__(self, path=None):
+        self.path = path
+        self.durations = load_json(path, {})
+
+    def add(self, tid, seconds):
+        durations = self.durations.setdefault(tid, [])
+        durations.append(seconds)
+        del durations[:-self.keep]
+
+    def estimate(self, tid, default=None):
+        """Returns the expected duration of tid or default if never run"""
+        durations = self.durations.get(tid)
+        if not durations:
+            return default
+        return float(sum(durations)) / len(durations)
+
+    def mean(self, default=None):
+        """Returns the average expected duration of the known tasks"""
+        estimates = [self.estimate(tid) for tid in self.durations]
+        estimates = [e for e in estimates if e is not None]
+        if not estimates:
+            return default
+        return sum(estimates) / len(estimates)
+
+    def save(self):
+        if self.path:
+            save_json(self.path, self.durations)
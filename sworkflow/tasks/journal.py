@@ -0,0 +1,72 @@
+"""
+Workflow run journal
+
+An append-only file where every workflow run records which tasks succeeded,
+so a failed run can be resumed without executing them again.
+"""
+import os
+from datetime import datetime
+from threading import Lock
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class RunJournal(object):
+    """Records task completions of the runs of a workflow in a JSON lines file
+
+    Entries are keyed by the expanded settings of the run, so completions of
+    runs with different settings are never mixed.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.lock = Lock()
+
+    def record(self, event, **fields):
+        if not self.path:
+            return
+        fields.update(key=self.key, event=event,
+                time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        line = json.dumps(fields) + '\n'
+        self.lock.acquire()
+        try:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            f = open(self.path, 'a')
+            try:
+                f.write(line)
+            finally:
+                f.close()
+        finally:
+            self.lock.release()
+
+    def entries(self):
+        """Yield the entries recorded under this journal key"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        f = open(self.path)
+        try:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # truncated line from an interrupted write
+                if entry.get('key') == self.key:
+                    yield entry
+        finally:
+            f.close()
+
+    def completed(self):
+        """Returns the set of (i, taskid) that succeeded since the last
+        successful run of the workflow"""
+        completed = set()
+        for entry in self.entries():
+            if entry['event'] == 'workflow' and entry['status'] == 'succeed':
+                completed.clear()
+            elif entry['event'] == 'task' and entry['status'] == 'succeed':
+                completed.add((entry['index'], entry['taskid']))
+        return completed
@@ -0,0 +1,76 @@
+"""
+Workflow plan cache
+
+Keeps the task order, skip flags and expanded settings of the last plan of
+a workflow, so commands like list-tasks don't have to walk its tasks again
+as long as the source files of the workflow and its tasks don't change.
+"""
+import os
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from .state import load_json, save_json
+
+
+class PlanCache(object):
+    """The plan of a workflow for a key, valid while its source files keep
+    their size and modification time
+
+    >>> cache = PlanCache()
+    >>> cache.store('key', {'tasks': []}, [__file__])
+    >>> cache.load('key') is None
+    True
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def load(self, key):
+        """Returns the plan stored for key or None"""
+        data = load_json(self.path)
+        if not data or data.get('key') != key:
+            return None
+        for path, signature in data['sources'].iteritems():
+            if _signature(path) != signature:
+                return None
+        return _bytes(data['plan'])
+
+    def store(self, key, plan, sources):
+        """Keep plan for key, sources are the files it was computed from"""
+        if not self.path:
+            return
+        data = {'key': key, 'plan': plan,
+                'sources': dict((p, _signature(p)) for p in sources)}
+        try:
+            content = json.dumps(data)
+        except (TypeError, ValueError):
+            # settings that can't be serialized
+            return
+        if _bytes(json.loads(content)['plan']) != plan:
+            return
+        save_json(self.path, data)
+
+
+def _signature(path):
+    """Returns the modification time and size of a file, or None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+def _bytes(value):
+    """Returns a decoded JSON value with byte strings
+
+    >>> _bytes({u'a': [u'b', 1, {u'c': None}]})
+    {'a': ['b', 1, {'c': None}]}
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [_bytes(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((_bytes(k), _bytes(v)) for k, v in value.iteritems())
+    return value
@@ -1,8 +1,30 @@
+import os
 import sys
-from subprocess import check_call, CalledProcessError
+import imp
+import atexit
+import logging
+from Queue import Queue, Empty
+from hashlib import sha1
+from subprocess import CalledProcessError, STDOUT
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
+from sworkflow import hdfs
+from sworkflow.cache import ResultCache
 from .task import Task
 from .workflow import ExitWorkflow
+from .stamps import is_hdfs, filehash
+from .workers import run_module, waitpid, get_pool
+from .supervisor import get_supervisor
+from .fused import STEP
+
+# runs sworkflow.tasks.fused wherever the workflow found sworkflow
+_FUSED = 'import sys; sys.path.insert(0, %r); ' \
+        'from sworkflow.tasks.fused import main; sys.exit(main())' % \
+        os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
 
 
 class PythonTask(Task):
@@ -10,23 +32,276 @@ class PythonTask(Task):
 
     class SampleProg(PythonTask):
         execargs = ['mymodule', '-arg', '1', '-arg2=3']
+
+    When cache is enabled, outputs are restored from a local cache instead of
+    running the module again if execargs, the module source and the content
+    of inputs didn't change since outputs were stored. Only tasks with local
+    inputs and outputs can be cached. The key covers the source of the
+    module run and not of the modules it imports: changing an imported
+    module doesn't invalidate the cached outputs, clear the cache then.
+
+    Spawned interpreters run under the supervisor of
+    sworkflow.tasks.supervisor, their output is sent to the task logger
+    unless logoutput is False, and they are terminated after timeout seconds
+    when it is set.
+
+    A task with streaminput = True reads the output of its single
+    dependency, another PythonTask, from stdin: the workflow runs both of
+    them at the same time with the stdout of the dependency connected to
+    the stdin of the task by a pipe, and no other task can depend on the
+    dependency. Both run in spawned interpreters whatever their execmode.
+
+    Tasks with fuse = True forming a chain, each of them the only dependent
+    of the previous one, are run by the workflow one after the other in a
+    single interpreter, paying its startup and imports once. Each task is
+    still logged, timed and checked on its own. The chain runs in a spawned
+    interpreter whatever the execmode of its tasks.
+
+    With execmode = 'fork' the module runs in a forked child of the workflow
+    process instead of a new interpreter, saving the interpreter startup
+    and the imports already made by the workflow. The child inherits the
+    locks other threads of the workflow hold when it forks, and may
+    deadlock on them, so workflows running more than one job at a time
+    refuse fork tasks: use execmode = 'pool' there. With execmode = 'pool'
+    the module runs in a warm worker process of sworkflow.tasks.workers,
+    with modules preloaded. python_interpreter, timeout and logoutput are
+    ignored in both modes, the module writes to the stdout and stderr of
+    the workflow.
     """
     python_interpreter = sys.executable
     execargs = ()
     execenv = None
     execcwd = None
+    execmode = 'spawn'
+    timeout = None
+    logoutput = True
+    streaminput = False
+    fuse = False
     cancelworkflow_retcode = ExitWorkflow.EXIT_CANCELLED
+    cache = False
+    cachedir = None
+    cachesize = None
 
     def _run(self):
         assert self.execargs, 'missing execargs'
+        if self.execmode == 'fork':
+            return self._fork()
+        if self.execmode == 'pool':
+            return self._pooled()
+        self._spawn().check()
+
+    def _spawn(self, **options):
+        """Start the interpreter running the module and return its
+        supervised child"""
         args = (self.python_interpreter, '-m') + tuple(self.execargs)
         self.log('Running %s', ' '.join(args))
-        check_call(args, env=self.execenv, cwd=self.execcwd)
+        return get_supervisor().spawn(args, env=self.execenv,
+                cwd=self.execcwd, log=self.logoutput and self._logline or None,
+                timeout=self.timeout, **options)
+
+    def _logline(self, line):
+        self.log('%s', line)
+
+    def _fork(self):
+        args = tuple(self.execargs)
+        self.log('Running %s in a forked process', ' '.join(args))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                # run the exit functions of the module, not the workflow ones
+                del atexit._exithandlers[:]
+                status = run_module(args, self.execenv, self.execcwd)
+                try:
+                    atexit._run_exitfuncs()
+                except:
+                    # already reported, python -m ignores them too
+                    pass
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+        retcode = waitpid(pid)
+        if retcode:
+            raise CalledProcessError(retcode, args)
+
+    def _pooled(self):
+        args = tuple(self.execargs)
+        self.log('Running %s in a worker process', ' '.join(args))
+        retcode = get_pool().run(args, self.execenv, self.execcwd)
+        if retcode:
+            raise CalledProcessError(retcode, args)
 
     def execute(self):
+        cachekey = self.cache and self._cachekey()
+        if cachekey:
+            cache = ResultCache(self.cachedir, maxsize=self.cachesize)
+            try:
+                if cache.restore(cachekey, self.outputs):
+                    self.log('Outputs restored from cache %s', cachekey)
+                    return
+            except EnvironmentError, exc:
+                # the program writes the outputs again
+                self.log('Outputs not restored from cache %s: %s', cachekey,
+                        exc, level=logging.WARNING)
         try:
             self._run()
         except CalledProcessError, exc:
             if ExitWorkflow.is_status(exc.returncode):
                 raise ExitWorkflow(str(self), exc.returncode)
             raise
+        finally:
+            # the program may have changed anything on HDFS
+            hdfs.invalidate()
+        if cachekey:
+            try:
+                cache.store(cachekey, self.outputs)
+            except EnvironmentError, exc:
+                self.log('Outputs not stored in cache %s: %s', cachekey, exc,
+                        level=logging.WARNING)
+
+    def execute_streamed(self, producer):
+        """Execute the task reading the stdout of producer from stdin and
+        return the seconds each of them ran"""
+        for task in (producer, self):
+            assert task.execargs, 'missing execargs'
+        pipein, pipeout = os.pipe()
+        try:
+            children = [producer._spawn(stdout=pipeout),
+                    self._spawn(stdin=pipein)]
+        finally:
+            os.close(pipein)
+            os.close(pipeout)
+        try:
+            for child in children:
+                child.wait()
+            # the first one failing makes the other one fail too, eg. the
+            # producer writing to the pipe closed by the consumer
+            failed = sorted((c.endtime, t, c) for t, c in
+                    zip((producer, self), children) if c.returncode)
+            for _, task, child in failed[:1]:
+                try:
+                    child.check()
+                except CalledProcessError, exc:
+                    if ExitWorkflow.is_status(exc.returncode):
+                        raise ExitWorkflow(str(task), exc.returncode)
+                    raise
+        finally:
+            hdfs.invalidate()
+        return [c.endtime - c.starttime for c in children]
+
+    def fusible(self, dep):
+        """Returns True if the task can run in the interpreter of dep"""
+        return bool(self.fuse and getattr(dep, 'fuse', False)
+                and isinstance(dep, PythonTask)
+                and not (self.streaminput or dep.streaminput)
+                and not (self.cache or dep.cache)
+                and self.python_interpreter == dep.python_interpreter)
+
+    def execute_fused(self, chain, started, succeeded):
+        """Execute the tasks of chain and then this task in one interpreter
+
+        started(k) and succeeded(k, seconds) are called when the k-th task
+        starts and succeeds, the error of the task failing is raised.
+        """
+        tasks = list(chain) + [self]
+        for task in tasks:
+            assert task.execargs, 'missing execargs'
+        steps = [{'execargs': list(t.execargs), 'env': t.execenv,
+            'cwd': t.execcwd} for t in tasks]
+        timeouts = [t.timeout for t in tasks]
+        timeout = None not in timeouts and sum(timeouts) or None
+        events = Queue()
+        running = [0]
+
+        def log(line):
+            pos = line.find(STEP)
+            if pos >= 0:
+                event = line[pos + len(STEP):].split()
+                if event[1] == 'start':
+                    running[0] = int(event[0])
+                events.put(event)
+                line = line[:pos]
+                if not line:
+                    return
+            task = tasks[running[0]]
+            if task.logoutput:
+                task._logline(line)
+            else:
+                print line
+
+        self.log('Running %s in a single interpreter',
+                ', '.join(' '.join(t.execargs) for t in tasks))
+        child = get_supervisor().spawn((self.python_interpreter, '-c',
+            _FUSED, json.dumps(steps)), log=log, timeout=timeout,
+            stderr=STDOUT)
+        try:
+            failure = None
+            while True:
+                try:
+                    event = events.get(True, 0.1)
+                except Empty:
+                    # output is read before the exit of the child is known
+                    if child.done.isSet() and events.empty():
+                        break
+                    continue
+                k = int(event[0])
+                if event[1] == 'start':
+                    started(k)
+                elif int(event[2]):
+                    failure = k, int(event[2])
+                else:
+                    succeeded(k, float(event[3]))
+            try:
+                if failure:
+                    k, status = failure
+                    raise CalledProcessError(status, tasks[k].execargs,
+                            '\n'.join(l for l in child.lines if STEP not in l))
+                k = running[0]
+                child.check()
+            except CalledProcessError, exc:
+                if ExitWorkflow.is_status(exc.returncode):
+                    raise ExitWorkflow(str(tasks[k]), exc.returncode)
+                raise
+        finally:
+            hdfs.invalidate()
+
+    def _cachekey(self):
+        """Returns the key of task outputs in cache or None if the task
+        can't be cached"""
+        if not self.outputs or [p for p in self.outputs if is_hdfs(p)]:
+            return None
+        if [p for p in self.inputs if is_hdfs(p) or not os.path.isfile(p)]:
+            return None
+        try:
+            modfile = _module_file(self.execargs[0], self.execcwd)
+        except ImportError:
+            return None
+        if not os.path.isfile(modfile):
+            return None
+        digest = sha1(repr((self.python_interpreter, tuple(self.execargs),
+            sorted((self.execenv or {}).items()), self.execcwd)))
+        for path in [modfile] + list(self.inputs):
+            digest.update(filehash(path))
+        return digest.hexdigest()
+
+
+def _module_file(modname, cwd=None):
+    """Returns the file that python -m would run for modname
+
+    >>> _module_file('sworkflow.tasks.pythontask').rstrip('c')[-13:]
+    'pythontask.py'
+    """
+    path = [cwd or os.getcwd()] + sys.path
+    for name in modname.split('.'):
+        f, filename, (_, _, kind) = imp.find_module(name, path)
+        if f:
+            f.close()
+        path = [filename]
+    if kind == imp.PKG_DIRECTORY:
+        f, filename, _ = imp.find_module('__main__', path)
+        if f:
+            f.close()
+    return filename
@@ -0,0 +1,106 @@
+"""
+Task input and output stamps
+
+Tasks declaring their inputs and outputs are up to date, and don't need to be
+executed again, when all their outputs exist and are newer than their
+inputs. Local inputs that are newer than the outputs but whose content didn't
+change since the task last succeeded don't make the task out of date.
+
+Paths starting with hdfs: are looked up on HDFS, any other path is local.
+"""
+import os
+from hashlib import sha1
+
+from sworkflow import hdfs
+from .state import load_json, save_json
+
+
+def is_hdfs(path):
+    return path.startswith('hdfs:')
+
+def mtime(path):
+    """Returns path modification time or None if it doesn't exist"""
+    if is_hdfs(path):
+        return hdfs.mtime(path)
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def filehash(path, blocksize=1 << 20):
+    """Returns the content hash of a local file"""
+    digest = sha1()
+    f = open(path, 'rb')
+    try:
+        for block in iter(lambda: f.read(blocksize), ''):
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+class TaskStamps(object):
+    """Content hashes of the local inputs of every task, recorded each time
+    the task succeeded
+
+    Hashes are kept by task id and outputs, instances of a task class
+    writing different outputs have their own hashes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hashes = load_json(path, {})
+
+    def uptodate(self, tid, task):
+        """Returns True if the outputs of task are up to date"""
+        inputs, outputs = _paths(task.inputs), _paths(task.outputs)
+        if not outputs:
+            return False
+        omtimes = [mtime(p) for p in outputs]
+        if None in omtimes:
+            return False
+        imtimes = [mtime(p) for p in inputs]
+        if None in imtimes:
+            return False
+        oldest = min(omtimes)
+        stale = [p for p, m in zip(inputs, imtimes) if m > oldest]
+        if not stale:
+            return True
+        hashes = self.hashes.get(_key(tid, outputs), {})
+        for path in stale:
+            if is_hdfs(path) or not os.path.isfile(path):
+                return False
+            if hashes.get(path) != filehash(path):
+                return False
+        return True
+
+    def update(self, tid, task):
+        """Record the content of the local inputs of a succeeded task"""
+        key = _key(tid, _paths(task.outputs))
+        self.hashes[key] = dict((p, filehash(p)) for p in _paths(task.inputs)
+                if not is_hdfs(p) and os.path.isfile(p))
+
+    def save(self):
+        if self.path:
+            save_json(self.path, self.hashes)
+
+
+def _key(tid, outputs):
+    """Returns the key of the hashes of a task
+
+    >>> _key('T1', ['/tmp/b', '/tmp/a'])
+    'T1 /tmp/a /tmp/b'
+    """
+    return ' '.join([tid] + sorted(outputs))
+
+def _paths(paths):
+    """Accept a single path as well as a list of paths
+
+    >>> _paths('/tmp/file')
+    ['/tmp/file']
+    >>> _paths(('/tmp/a', '/tmp/b'))
+    ['/tmp/a', '/tmp/b']
+    """
+    if isinstance(paths, basestring):
+        return [paths]
+    return list(paths or ())
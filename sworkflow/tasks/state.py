@@ -0,0 +1,44 @@
+"""
+Workflow state files
+
+JSON files kept by workflows between runs, like task durations, input
+stamps and plans. Files are replaced in a single rename, and a file left
+truncated or corrupt by an earlier run is read as missing.
+"""
+import os
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+def load_json(path, default=None):
+    """Returns the value stored in path, or default if there is none
+
+    >>> load_json('/nonexistent/state.json', {})
+    {}
+    """
+    if not path or not os.path.exists(path):
+        return default
+    f = open(path)
+    try:
+        try:
+            return json.load(f)
+        except ValueError:
+            # truncated or corrupt, start over
+            return default
+    finally:
+        f.close()
+
+def save_json(path, value):
+    """Store value in path, replacing its previous content at once"""
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    f = open(tmppath, 'w')
+    try:
+        json.dump(value, f)
+    finally:
+        f.close()
+    os.rename(tmppath, path)
@@ -0,0 +1,297 @@
+"""
+Supervision of the programs spawned by tasks
+
+A Supervisor runs the programs spawned by PythonTask and DumboTask and waits
+for all of them in a single thread polling their pipes with select(), so
+that running dozens of programs doesn't take threads to read their output.
+Output lines are sent to a log function, lines longer than maxline bytes
+are split and only the last lines of a program are kept for the error
+raised when it fails.
+
+Programs running longer than their timeout are terminated, and cancel()
+terminates every running program, as the workflow does once a task stops
+it with ExitWorkflow. Programs still running grace seconds after SIGTERM
+are killed.
+"""
+import os
+import time
+import errno
+import fcntl
+import signal
+import select
+import atexit
+import traceback
+from collections import deque
+from threading import Lock, Thread, Event
+from subprocess import Popen, PIPE, CalledProcessError
+
+
+class ProcessTimeout(CalledProcessError):
+    """A program was terminated because it ran longer than its timeout"""
+
+    def __init__(self, returncode, cmd, timeout, output=None):
+        CalledProcessError.__init__(self, returncode, cmd, output)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '%s' timed out after %s seconds" % (self.cmd,
+                self.timeout)
+
+
+class ProcessCancelled(CalledProcessError):
+    """A program was terminated by Supervisor.cancel()"""
+
+    def __str__(self):
+        return "Command '%s' was cancelled" % (self.cmd,)
+
+
+class Supervisor(object):
+    """Spawn programs and wait for them in a single thread"""
+
+    def __init__(self, maxline=8192, tail=20, grace=10):
+        self.maxline = maxline
+        self.tail = tail
+        self.grace = grace
+        self.children = set()
+        self.outputs = {}
+        self.thread = None
+        self.lock = Lock()
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            _setflag(fd, fcntl.F_GETFD, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            _setflag(fd, fcntl.F_GETFL, fcntl.F_SETFL, os.O_NONBLOCK)
+
+    def spawn(self, args, env=None, cwd=None, log=None, timeout=None,
+            stdin=None, stdout=None, stderr=None):
+        """Start a program and return its _Child
+
+        When log is given, it is called with every line the program
+        writes to stdout and stderr, otherwise the program writes to the
+        stdout and stderr of the workflow. stdin, stdout and stderr are
+        passed to Popen to connect the program elsewhere, eg. to pipes
+        between programs.
+        """
+        pipe = log and PIPE or None
+        process = Popen(args, env=env, cwd=cwd, stdin=stdin,
+                stdout=stdout or pipe, stderr=stderr or pipe, close_fds=True)
+        child = _Child(process, args, timeout, self.tail)
+        self.lock.acquire()
+        try:
+            self.children.add(child)
+            for f in (process.stdout, process.stderr):
+                if f is not None:
+                    _setflag(f.fileno(), fcntl.F_GETFL, fcntl.F_SETFL,
+                            os.O_NONBLOCK)
+                    self.outputs[f.fileno()] = _Output(child, f, log,
+                            self.maxline)
+            if self.thread is None:
+                self.thread = Thread(target=self._loop)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+        self._wake()
+        return child
+
+    def call(self, args, **options):
+        """Run a program and raise CalledProcessError if it fails, same
+        arguments as spawn()"""
+        self.spawn(args, **options).check()
+
+    def cancel(self):
+        """Terminate every running program"""
+        self.lock.acquire()
+        try:
+            for child in self.children:
+                self._terminate(child, 'cancelled')
+        finally:
+            self.lock.release()
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self.wakeup[1], '.')
+        except OSError, exc:
+            # the loop has enough wakeups to read already
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def _terminate(self, child, reason):
+        if child.reason is None and child.process.returncode is None:
+            child.reason = reason
+            child.killtime = time.time() + self.grace
+            _kill(child.process.pid, signal.SIGTERM)
+
+    def _loop(self):
+        while True:
+            self.lock.acquire()
+            try:
+                timeout = self._poll()
+                if not self.children:
+                    self.thread = None
+                    return
+                fds = list(self.outputs)
+            finally:
+                self.lock.release()
+            try:
+                readable = select.select(fds + [self.wakeup[0]], [], [],
+                        timeout)[0]
+            except select.error, exc:
+                if exc.args[0] != errno.EINTR:
+                    raise
+                continue
+            self.lock.acquire()
+            try:
+                for fd in readable:
+                    if fd == self.wakeup[0]:
+                        os.read(fd, 4096)
+                    elif self.outputs[fd].read() is False:
+                        del self.outputs[fd]
+            finally:
+                self.lock.release()
+
+    def _poll(self):
+        """Reap exited children, enforce timeouts and return the seconds to
+        wait for the next check"""
+        now = time.time()
+        timeout = 1.0
+        for child in list(self.children):
+            returncode = child.process.poll()
+            if returncode is not None:
+                self._finish(child)
+                continue
+            if child.deadline is not None and now >= child.deadline:
+                self._terminate(child, 'timeout')
+            if child.killtime is not None and now >= child.killtime:
+                _kill(child.process.pid, signal.SIGKILL)
+                child.killtime = None
+            for t in (child.deadline, child.killtime):
+                if t is not None and t > now:
+                    timeout = min(timeout, t - now)
+            if not [o for o in self.outputs.values() if o.child is child]:
+                # output closed, the program must be about to exit
+                timeout = min(timeout, 0.05)
+        return timeout
+
+    def _finish(self, child):
+        for fd, output in self.outputs.items():
+            if output.child is child:
+                # output written before the program exited
+                while output.read():
+                    pass
+                output.close()
+                del self.outputs[fd]
+        self.children.discard(child)
+        child.returncode = child.process.returncode
+        child.endtime = time.time()
+        child.done.set()
+
+
+class _Child(object):
+    """A program started by the supervisor"""
+
+    def __init__(self, process, args, timeout, tail):
+        self.process = process
+        self.pid = process.pid
+        self.args = args
+        self.timeout = timeout
+        self.starttime = time.time()
+        self.endtime = None
+        self.deadline = timeout and self.starttime + timeout or None
+        self.killtime = None
+        # why the supervisor terminated the program: timeout or cancelled
+        self.reason = None
+        self.returncode = None
+        self.lines = deque(maxlen=tail)
+        self.done = Event()
+
+    def wait(self):
+        """Wait for the program to exit and return its exit status"""
+        self.done.wait()
+        return self.returncode
+
+    def check(self):
+        """Wait for the program and raise CalledProcessError if it failed"""
+        returncode = self.wait()
+        output = '\n'.join(self.lines)
+        if self.reason == 'timeout':
+            raise ProcessTimeout(returncode, self.args, self.timeout, output)
+        if self.reason == 'cancelled':
+            raise ProcessCancelled(returncode, self.args, output)
+        if returncode:
+            raise CalledProcessError(returncode, self.args, output)
+
+
+class _Output(object):
+    """Line buffer of stdout or stderr of a program"""
+
+    def __init__(self, child, f, log, maxline):
+        self.child = child
+        self.file = f
+        self.log = log
+        self.maxline = maxline
+        self.partial = ''
+
+    def read(self):
+        """Read available output, returns None when there is nothing to
+        read yet and False at end of file"""
+        try:
+            data = os.read(self.file.fileno(), 65536)
+        except OSError, exc:
+            if exc.errno == errno.EAGAIN:
+                return None
+            raise
+        if not data:
+            self.close()
+            return False
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._emit(line)
+        while len(self.partial) > self.maxline:
+            self._emit(self.partial[:self.maxline])
+            self.partial = self.partial[self.maxline:]
+        return True
+
+    def close(self):
+        if self.partial:
+            self._emit(self.partial)
+            self.partial = ''
+        self.file.close()
+
+    def _emit(self, line):
+        for i in xrange(0, max(len(line), 1), self.maxline):
+            chunk = line[i:i + self.maxline].rstrip('\r')
+            self.child.lines.append(chunk)
+            try:
+                self.log(chunk)
+            except Exception:
+                traceback.print_exc()
+
+
+def _setflag(fd, getcmd, setcmd, flag):
+    fcntl.fcntl(fd, setcmd, fcntl.fcntl(fd, getcmd) | flag)
+
+def _kill(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except OSError, exc:
+        if exc.errno != errno.ESRCH:
+            raise
+
+
+_supervisor = None
+_supervisor_lock = Lock()
+
+def get_supervisor():
+    """Returns the supervisor of the programs spawned by tasks"""
+    global _supervisor
+    _supervisor_lock.acquire()
+    try:
+        if _supervisor is None:
+            _supervisor = Supervisor()
+            # don't leave programs running once the workflow exits
+            atexit.register(_supervisor.cancel)
+        return _supervisor
+    finally:
+        _supervisor_lock.release()
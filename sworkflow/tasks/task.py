@@ -9,6 +9,11 @@ import logging
 
 class Task(object):
     deps = ()
+    # paths read and written by the task, when outputs are declared the
+    # workflow skips the task if they are newer than inputs.
+    # HDFS paths must start with hdfs:
+    inputs = ()
+    outputs = ()
     logger = logging.getLogger('sworkflow')
 
     def __init__(self, **kwargs):
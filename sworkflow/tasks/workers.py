@@ -0,0 +1,341 @@
+"""
+Running python modules in processes of the workflow instead of new
+interpreters.
+
+A WorkerPool keeps worker processes with modules already imported, ready to
+run modules of PythonTasks. Workers are forked by a template process started
+once with the preloaded modules, so workers never inherit the threads of the
+workflow process. A worker runs tasks one after the other in its own
+process, restoring cwd, environment, sys.argv and sys.path after each of
+them, and it is replaced after maxtasks tasks or once its resident memory
+grew above maxrss MB.
+"""
+import os
+import sys
+import errno
+import runpy
+import socket
+import atexit
+import shutil
+import resource
+import traceback
+from tempfile import mkdtemp
+from threading import Lock, Semaphore
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+def run_module(execargs, env=None, cwd=None):
+    """Run a module with its arguments like python -m does, in the current
+    process, and return the exit status python would return"""
+    try:
+        if cwd:
+            os.chdir(cwd)
+        if env is not None:
+            os.environ.clear()
+            os.environ.update(env)
+        sys.argv = list(execargs)
+        sys.path.insert(0, '')
+        runpy.run_module(execargs[0], run_name='__main__', alter_sys=True)
+    except SystemExit, exc:
+        return _exit_status(exc.code)
+    except:
+        traceback.print_exc()
+        return 1
+    return 0
+
+def waitpid(pid):
+    """Wait for a child process and return its status like Popen.returncode"""
+    while True:
+        try:
+            status = os.waitpid(pid, 0)[1]
+            break
+        except OSError, exc:
+            if exc.errno != errno.EINTR:
+                raise
+    return _returncode(status)
+
+
+class WorkerPool(object):
+    """Pool of up to size worker processes running python modules"""
+
+    def __init__(self, size=4, preload=(), maxtasks=100, maxrss=None):
+        self.size = size
+        self.preload = list(preload)
+        self.maxtasks = maxtasks
+        self.maxrss = maxrss
+        self.template = None
+        self.idle = []
+        self.slots = Semaphore(size)
+        self.lock = Lock()
+
+    def start(self):
+        """Start the template process, forking it before the workflow
+        starts threads is safer"""
+        self.lock.acquire()
+        try:
+            if self.template is None:
+                self.template = _Template(self.preload, self.maxtasks,
+                        self.maxrss)
+                atexit.register(self.close)
+        finally:
+            self.lock.release()
+
+    def run(self, execargs, env=None, cwd=None):
+        """Run a module in a worker and return its exit status"""
+        self.start()
+        self.slots.acquire()
+        try:
+            worker = self._worker()
+            try:
+                status, retire = worker.run(execargs, env, cwd)
+            except EnvironmentError:
+                # the worker died running the module, eg. calling os._exit
+                worker.close()
+                return self.template.status(worker.pid)
+            if retire:
+                worker.close()
+            else:
+                self.lock.acquire()
+                self.idle.append(worker)
+                self.lock.release()
+            return status
+        finally:
+            self.slots.release()
+
+    def _worker(self):
+        self.lock.acquire()
+        try:
+            if self.idle:
+                return self.idle.pop()
+            return self.template.spawn()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for worker in self.idle:
+                worker.close()
+            self.idle = []
+            if self.template is not None:
+                self.template.close()
+                self.template = None
+        finally:
+            self.lock.release()
+
+
+_pool = None
+
+def get_pool():
+    """Returns the pool used by PythonTasks with execmode = 'pool'"""
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool()
+    return _pool
+
+def set_pool(pool):
+    """Use pool for PythonTasks and return the previous one"""
+    global _pool
+    previous, _pool = _pool, pool
+    return previous
+
+
+class _Template(object):
+    """Process with the preloaded modules forking workers on request
+
+    Workers connect to a unix socket the pool listens on. The template
+    answers "spawn" requests with the pid of the new worker and "status
+    <pid>" requests with the exit status of a worker.
+    """
+
+    def __init__(self, preload, maxtasks, maxrss):
+        self.lock = Lock()
+        self.tmpdir = mkdtemp(prefix='sworkflow-workers-')
+        self.address = os.path.join(self.tmpdir, 'socket')
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.address)
+        self.listener.listen(16)
+        self.listener.settimeout(60)
+        cmdr, cmdw = os.pipe()
+        replyr, replyw = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if not self.pid:
+            status = 1
+            try:
+                self.listener.close()
+                os.close(cmdw)
+                os.close(replyr)
+                self._serve(os.fdopen(cmdr), os.fdopen(replyw, 'w'), preload,
+                        maxtasks, maxrss)
+                status = 0
+            finally:
+                os._exit(status)
+        os.close(cmdr)
+        os.close(replyw)
+        self.commands = os.fdopen(cmdw, 'w')
+        self.replies = os.fdopen(replyr)
+
+    def _serve(self, commands, replies, preload, maxtasks, maxrss):
+        for name in preload:
+            try:
+                __import__(name)
+            except Exception:
+                traceback.print_exc()
+        exits = {}
+        for line in iter(commands.readline, ''):
+            args = line.split()
+            if args[0] == 'spawn':
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if not pid:
+                    status = 1
+                    try:
+                        commands.close()
+                        replies.close()
+                        _work(self.address, maxtasks, maxrss)
+                        status = 0
+                    finally:
+                        os._exit(status)
+                replies.write('%d\n' % pid)
+            elif args[0] == 'status':
+                pid = int(args[1])
+                replies.write('%d\n' % (exits.pop(pid) if pid in exits
+                    else waitpid(pid)))
+            replies.flush()
+            # reap workers that retired
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError:
+                    break
+                if not pid:
+                    break
+                exits[pid] = _returncode(status)
+
+    def _request(self, line):
+        self.commands.write(line + '\n')
+        self.commands.flush()
+        return int(self.replies.readline())
+
+    def spawn(self):
+        self.lock.acquire()
+        try:
+            pid = self._request('spawn')
+            conn = self.listener.accept()[0]
+        finally:
+            self.lock.release()
+        conn.settimeout(None)
+        return _Worker(pid, conn)
+
+    def status(self, pid):
+        self.lock.acquire()
+        try:
+            return self._request('status %d' % pid)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.commands.close()
+        waitpid(self.pid)
+        self.replies.close()
+        self.listener.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class _Worker(object):
+    """Connection of the pool to a worker process"""
+
+    def __init__(self, pid, conn):
+        self.pid = pid
+        self.conn = conn
+        self.rfile = conn.makefile('rb')
+        self.wfile = conn.makefile('wb')
+
+    def run(self, execargs, env, cwd):
+        """Returns the exit status of the module and if the worker retired"""
+        self.wfile.write(json.dumps({'execargs': list(execargs), 'env': env,
+            'cwd': cwd}) + '\n')
+        self.wfile.flush()
+        line = self.rfile.readline()
+        if not line:
+            raise IOError(errno.EPIPE, 'worker %d exited' % self.pid)
+        reply = json.loads(line)
+        return reply['status'], reply['retire']
+
+    def close(self):
+        for f in (self.rfile, self.wfile, self.conn):
+            try:
+                f.close()
+            except EnvironmentError:
+                pass
+
+
+def _work(address, maxtasks, maxrss):
+    """Main loop of worker processes"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(address)
+    rfile, wfile = conn.makefile('rb'), conn.makefile('wb')
+    tasks = 0
+    for line in iter(rfile.readline, ''):
+        execargs, env, cwd = _decode(json.loads(line))
+        status = _run_restoring(execargs, env, cwd)
+        tasks += 1
+        retire = tasks >= maxtasks or bool(maxrss and _rss() > maxrss)
+        wfile.write(json.dumps({'status': status, 'retire': retire}) + '\n')
+        wfile.flush()
+        if retire:
+            break
+
+def _decode(request):
+    """Returns the arguments of a request with byte strings, as the module
+    would get them running in a new interpreter"""
+    encode = lambda s: s.encode('utf-8')
+    env = request['env']
+    if env is not None:
+        env = dict((encode(k), encode(v)) for k, v in env.items())
+    cwd = request['cwd'] and encode(request['cwd'])
+    return map(encode, request['execargs']), env, cwd
+
+def _run_restoring(execargs, env, cwd):
+    """run_module restoring the process state changed to run the module"""
+    saved = os.getcwd(), dict(os.environ), sys.argv, list(sys.path)
+    try:
+        return run_module(execargs, env, cwd)
+    finally:
+        os.chdir(saved[0])
+        os.environ.clear()
+        os.environ.update(saved[1])
+        sys.argv = saved[2]
+        sys.path[:] = saved[3]
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+def _rss():
+    """Returns the maximum resident memory of the process in MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on darwin, kilobytes elsewhere
+    return rss / 1024.0 ** (2 if sys.platform == 'darwin' else 1)
+
+def _returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def _exit_status(code):
+    """Returns the exit status of the interpreter for a SystemExit code
+
+    >>> _exit_status(None), _exit_status(75), _exit_status(True)
+    (0, 75, 1)
+    """
+    if code is None:
+        return 0
+    if isinstance(code, (int, long)):
+        return code & 0xff
+    print >> sys.stderr, code
+    return 1
@@ -1,12 +1,24 @@
 """
 A simple workflow engine
 """
+import os
+import sys
 import logging
+from inspect import getmro
+from hashlib import sha1
+from Queue import Queue
+from heapq import heappush, heappop
+from threading import Thread
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 from string import Template
 
 from .task import Task
+from .history import TaskHistory
+from .journal import RunJournal
+from .stamps import TaskStamps
+from .plans import PlanCache
+from .supervisor import get_supervisor
 
 
 class ExitWorkflow(Exception):
@@ -46,18 +58,101 @@ class Workflow(Task):
     include_tasks = ()
     exclude_tasks = ()
     settings = ()
+    # number of tasks allowed to run at the same time
+    jobs = 1
+    # directory where state is kept between runs (eg. task durations)
+    statedir = None
+    # skip tasks that succeeded in the last unfinished run
+    resume = False
 
     def __init__(self, **kwargs):
         params = kwargs.pop('params', {})
         Task.__init__(self, **kwargs)
         self.settings = dict(self.settings, **params)
-        self.tasks = list(self._tasks())
+        # tasks are walked on first use, see _graph()
+        self._tasklist = None
+        self._plan = None
+        self.history = TaskHistory(self._statepath('history', 'json'))
+        self.stamps = TaskStamps(self._statepath('stamps', 'json'))
+
+    def _statepath(self, kind, ext):
+        if self.statedir:
+            filename = '%s.%s' % (taskid(self), ext)
+            return os.path.join(self.statedir, kind, filename)
+
+    @property
+    def tasks(self):
+        """List of (i, task, skipped) in execution order"""
+        self._graph()
+        return self._tasklist
+
+    @property
+    def taskdeps(self):
+        """The list of task instances each task depends on"""
+        self._graph()
+        return self._taskdeps
+
+    @property
+    def streams(self):
+        self._graph()
+        return self._streammap
+
+    @property
+    def fusions(self):
+        self._graph()
+        return self._fusionmap
+
+    def _graph(self):
+        """Walk the tasks of the workflow the first time they are needed"""
+        if self._tasklist is None:
+            self._taskdeps = {}
+            self._tasklist = list(self._tasks())
+            try:
+                self._streammap = self._streams()
+                self._fusionmap = self._fusions()
+            except:
+                self._tasklist = None
+                raise
+
+    def outline(self):
+        """Returns the (i, taskid, skipped, name, deps) of every task in
+        execution order, deps being the indexes of the tasks it depends on
+
+        Plans are kept in the state directory and read back without
+        walking the tasks while the sources of the workflow and its tasks
+        don't change.
+        """
+        return [tuple(entry) for entry in self._cachedplan()['tasks']]
+
+    def _cachedplan(self):
+        if self._plan is None:
+            cache = PlanCache(self._statepath('plans', 'json'))
+            key = self._plankey()
+            self._plan = cache.load(key)
+            if self._plan is None:
+                index = dict((t, i) for i, t, _ in self.tasks)
+                self._plan = {'settings': _tsettings(self.settings),
+                    'tasks': [[i, taskid(t), s, str(t),
+                        [index[d] for d in self.taskdeps[t]]]
+                        for i, t, s in self.tasks]}
+                tasks = [self] + [t for _, t, _ in self.tasks]
+                cache.store(key, self._plan, _sources(tasks))
+        return self._plan
+
+    def _plankey(self):
+        """Returns the key of the plan, changing with the parameters of the
+        workflow"""
+        return sha1(repr((type(self).__module__, taskid(self),
+            taskid(self.starttask), sorted(self.settings.items()),
+            sorted(self.include_tasks or ()), sorted(self.exclude_tasks or ()),
+            ))).hexdigest()
 
     def _tasks(self):
-        tasks = walk(self.starttask)
+        tasks = _walk(self.starttask)
         exclude = self.exclude_tasks or ()
         include = self.include_tasks or ()
-        for i, task in enumerate(tasks):
+        for i, (task, deps) in enumerate(tasks):
+            self._taskdeps[task] = deps
             taskid = task.__class__.__name__
             if include:
                 skipped = (taskid not in include) and (str(i) not in include)
@@ -67,25 +162,286 @@ class Workflow(Task):
                 skipped = False
             yield i, task, skipped
 
-    def _execute(self):
-        esettings = _tsettings(self.settings)
+    def _streams(self):
+        """Returns the (i, task, skipped) of the task each producer streams
+        its output to, see PythonTask.streaminput"""
+        dependents = self._dependents()
+        streams = {}
         for i, task, skipped in self.tasks:
-            if skipped:
-                self.log('Task skipped: %i-%s', i, task)
+            if not getattr(task, 'streaminput', False):
                 continue
+            deps = self.taskdeps[task]
+            assert len(deps) == 1, \
+                    'Task %s must have a single dependency to stream' % task
+            consumers = [t for _, t, _ in dependents[deps[0]]]
+            assert consumers == [task], 'Task %s streams its output to %s, ' \
+                    'no other task can depend on it' % (deps[0], task)
+            streams[deps[0]] = (i, task, skipped)
+        return streams
+
+    def _fusions(self):
+        """Returns the (i, task, skipped) of the task each task of a chain
+        runs before in the same interpreter, see PythonTask.fuse"""
+        dependents = self._dependents()
+        fusions = {}
+        for i, task, skipped in self.tasks:
+            deps = self.taskdeps[task]
+            if len(deps) != 1 or dependents[deps[0]] != [(i, task, skipped)]:
+                continue
+            # a producer is deferred until its consumer runs, a chain ending
+            # with it would never run
+            if task in self.streams:
+                continue
+            fusible = getattr(task, 'fusible', None)
+            if fusible and fusible(deps[0]):
+                fusions[deps[0]] = (i, task, skipped)
+        return fusions
 
-            _texpand(task, esettings)
-            starttime = datetime.now()
-            self.log('Task started: %i-%s', i, task)
-            try:
-                task.execute()
-            except Exception:
-                self.log('Task failed: %i-%s in %s', i, task, \
-                        datetime.now() - starttime, level=logging.ERROR)
-                raise
+    def _execute(self):
+        esettings = dict(self._cachedplan()['settings'])
+        # producers waiting for the task they stream their output to
+        self.deferred = {}
+        # tasks of a chain waiting for its last task
+        self.chained = {}
+        settingskey = sha1(repr(sorted(esettings.items()))).hexdigest()
+        self.journal = RunJournal(self._statepath('journal', 'jsonl'),
+                settingskey)
+        self.completed = self.journal.completed() if self.resume else set()
+        self.journal.record('workflow', status='started')
+        try:
+            if (self.jobs or 1) > 1:
+                self._execute_parallel(esettings)
             else:
-                self.log('Task succeed: %i-%s in %s', i, task, \
-                        datetime.now() - starttime)
+                for i, task, skipped in self.tasks:
+                    self._execute_task(i, task, skipped, esettings)
+        finally:
+            self.history.save()
+            self.stamps.save()
+        self.journal.record('workflow', status='succeed')
+
+    def _execute_parallel(self, esettings):
+        """Execute each task in a pool of threads as soon as its deps finish
+
+        Ready tasks starting the longest chains of remaining work are
+        executed first. Once a task fails no more tasks are started, running
+        ones are waited for and the first failure is raised as sequential
+        execution does. Programs spawned by running tasks are terminated
+        when a task stops the workflow with ExitWorkflow.
+        """
+        waiting = self._waiting()
+        dependents = self._dependents()
+        priorities = self._priorities()
+        bypriority = lambda (i, task, skipped): (-priorities[task], i)
+        ready = [(i, t, s) for i, t, s in self.tasks if not waiting[t]]
+        # streamed and fused tasks always run spawned
+        skipped = dict((t, s) for _, t, s in self.tasks)
+        spawned = set()
+        for dep, (_, task, s) in self.streams.items() + self.fusions.items():
+            if not (s or skipped[dep]):
+                spawned.update((dep, task))
+        forked = [t for _, t, s in self.tasks if not s and t not in spawned
+                and getattr(t, 'execmode', None) == 'fork']
+        if forked:
+            # forked children would inherit locks held by the other threads
+            raise ValueError('Task %s forks the workflow process, it cannot '
+                    'run with jobs > 1' % forked[0])
+        pool = _ThreadPool(self.jobs)
+        running = 0
+        failure = None
+        try:
+            while True:
+                ready.sort(key=bypriority)
+                while ready and running < self.jobs and not failure:
+                    i, task, skipped = ready.pop(0)
+                    if skipped:
+                        self._execute_task(i, task, skipped, esettings)
+                        ready.extend(_release(task, waiting, dependents))
+                        ready.sort(key=bypriority)
+                    else:
+                        pool.submit(task, self._execute_task, i, task,
+                                skipped, esettings)
+                        running += 1
+                if not running:
+                    break
+                finished, exc_info = pool.result()
+                running -= 1
+                if exc_info:
+                    if not failure and issubclass(exc_info[0], ExitWorkflow) \
+                            and running:
+                        self.log('Cancelling %d running tasks', running)
+                        get_supervisor().cancel()
+                    failure = failure or exc_info
+                elif not failure:
+                    ready.extend(_release(finished, waiting, dependents))
+        finally:
+            pool.close()
+        if failure:
+            raise failure[0], failure[1], failure[2]
+
+    def _waiting(self):
+        """Returns the set of deps each task is waiting for"""
+        return dict((t, set(self.taskdeps[t])) for _, t, _ in self.tasks)
+
+    def _dependents(self):
+        """Returns the list of (i, task, skipped) depending on each task"""
+        dependents = defaultdict(list)
+        for i, task, skipped in self.tasks:
+            for dep in set(self.taskdeps[task]):
+                dependents[dep].append((i, task, skipped))
+        return dependents
+
+    def _estimates(self):
+        """Returns the expected duration in seconds of each task
+
+        Tasks never run before are expected to take the average time of the
+        known tasks, skipped tasks take no time.
+        """
+        default = self.history.mean(default=1.0)
+        return dict((task, 0 if skipped else \
+                self.history.estimate(taskid(task), default))
+                for _, task, skipped in self.tasks)
+
+    def _priorities(self):
+        """Returns the expected time from the start of each task to the end
+        of the longest chain of tasks depending on it"""
+        estimates = self._estimates()
+        dependents = self._dependents()
+        priorities = {}
+        for _, task, _ in reversed(self.tasks):
+            downstream = [priorities[t] for _, t, _ in dependents[task]]
+            priorities[task] = estimates[task] + max(downstream or [0])
+        return priorities
+
+    def plan(self):
+        """Predict the execution of the workflow from past task durations
+
+        Returns the critical path as a list of (i, task, seconds) and the
+        expected duration in seconds of the whole workflow when executed
+        with self.jobs tasks at the same time.
+        """
+        estimates = self._estimates()
+        priorities = self._priorities()
+        waiting = self._waiting()
+        dependents = self._dependents()
+        bypriority = lambda (i, task, skipped): (-priorities[task], i)
+
+        ready = [(i, t, s) for i, t, s in self.tasks if not waiting[t]]
+        roots = list(ready)
+        running = []
+        now = 0
+        while ready or running:
+            ready.sort(key=bypriority)
+            while ready and len(running) < (self.jobs or 1):
+                i, task, _ = ready.pop(0)
+                heappush(running, (now + estimates[task], i, task))
+            now, i, task = heappop(running)
+            ready.extend(_release(task, waiting, dependents))
+
+        path = []
+        candidates = roots
+        while candidates:
+            i, task, _ = min(candidates, key=bypriority)
+            path.append((i, task, estimates[task]))
+            candidates = dependents[task]
+        return path, now
+
+    def _execute_task(self, i, task, skipped, esettings):
+        if skipped:
+            self.log('Task skipped: %i-%s', i, task)
+            return
+        tid = taskid(task)
+        if (i, tid) in self.completed:
+            self.log('Task skipped, completed in a previous run: %i-%s', i, task)
+            return
+
+        _texpand(task, esettings)
+        if task in self.streams:
+            ci, consumer, cskipped = self.streams[task]
+            if not cskipped and (ci, taskid(consumer)) not in self.completed:
+                self.log('Task deferred, streams its output to %i-%s: %i-%s',
+                        ci, consumer, i, task)
+                self.deferred[consumer] = (i, task)
+                return
+        chain = self.chained.pop(task, [])
+        if task in self.fusions:
+            ni, nexttask, nskipped = self.fusions[task]
+            if not nskipped and (ni, taskid(nexttask)) not in self.completed:
+                self.log('Task deferred, runs with %i-%s in a single '
+                        'interpreter: %i-%s', ni, nexttask, i, task)
+                self.chained[nexttask] = chain + [(i, task)]
+                return
+        # once a task of the chain runs the following ones have to run
+        while chain and self.stamps.uptodate(taskid(chain[0][1]), chain[0][1]):
+            self.log('Task skipped, outputs are up to date: %i-%s',
+                    *chain.pop(0))
+        if chain:
+            return self._execute_fused(chain + [(i, task)])
+        producer = self.deferred.pop(task, None)
+        if self.stamps.uptodate(tid, task):
+            self.log('Task skipped, outputs are up to date: %i-%s', i, task)
+            return
+        if producer:
+            return self._execute_streamed(producer, (i, task))
+        assert not getattr(task, 'streaminput', False), \
+                'Task %s streams the output of a task that did not run' % task
+
+        starttime = datetime.now()
+        self.log('Task started: %i-%s', i, task)
+        try:
+            task.execute()
+        except Exception:
+            self._task_failed(i, task, datetime.now() - starttime)
+            raise
+        else:
+            self._task_succeed(i, task, datetime.now() - starttime)
+
+    def _execute_streamed(self, producer, consumer):
+        """Execute consumer reading the output of producer from a pipe"""
+        starttime = datetime.now()
+        for i, task in (producer, consumer):
+            self.log('Task started: %i-%s', i, task)
+        try:
+            seconds = consumer[1].execute_streamed(producer[1])
+        except Exception:
+            # the stream is lost, both tasks must run again
+            for i, task in (producer, consumer):
+                self._task_failed(i, task, datetime.now() - starttime)
+            raise
+        for (i, task), s in zip((producer, consumer), seconds):
+            self._task_succeed(i, task, timedelta(seconds=s))
+
+    def _execute_fused(self, steps):
+        """Execute a chain of tasks in a single interpreter"""
+        starttimes = {}
+        def started(k):
+            starttimes[k] = datetime.now()
+            self.log('Task started: %i-%s', *steps[k])
+        def succeeded(k, seconds):
+            i, task = steps[k]
+            self._task_succeed(i, task, timedelta(seconds=seconds))
+        tasks = [task for _, task in steps]
+        try:
+            tasks[-1].execute_fused(tasks[:-1], started, succeeded)
+        except Exception:
+            k = max(starttimes or [0])
+            i, task = steps[k]
+            starttime = starttimes.get(k) or datetime.now()
+            self._task_failed(i, task, datetime.now() - starttime)
+            raise
+
+    def _task_failed(self, i, task, elapsed):
+        self.log('Task failed: %i-%s in %s', i, task, elapsed,
+                level=logging.ERROR)
+        self.journal.record('task', index=i, taskid=taskid(task),
+                status='failed')
+
+    def _task_succeed(self, i, task, elapsed):
+        tid = taskid(task)
+        self.history.add(tid, _seconds(elapsed))
+        if task.outputs:
+            self.stamps.update(tid, task)
+        self.journal.record('task', index=i, taskid=tid, status='succeed')
+        self.log('Task succeed: %i-%s in %s', i, task, elapsed)
 
     def execute(self):
         starttime = datetime.now()
@@ -116,6 +472,11 @@ class Workflow(Task):
 def walk(starttask):
     """Walk starttask and build ordered list of subtasks to execute
 
+    Every task is yielded after all of its dependencies, and dependencies are
+    visited from the last declared to the first one. Each task is visited only
+    once, so walking is linear in the number of tasks and dependencies no
+    matter how many paths lead to a shared dependency.
+
     >>> t1 = Task(taskname='T1')
     >>> t2 = Task(taskname='T2', deps=[t1])
     >>> t3 = Task(taskname='T3', deps=[t2])
@@ -124,7 +485,13 @@ def walk(starttask):
     ['T1', 'T2', 'T3', 'T4']
 
     """
-    clsmap = {} 
+    for task, _ in _walk(starttask):
+        yield task
+
+def _walk(starttask):
+    """Same as walk() but yield (task, deps) pairs, where deps is the list of
+    task instances the task depends on"""
+    clsmap = {}
     def _n(task):
         if type(task) is type:
             # task referenced by its class is instanciated once
@@ -133,19 +500,29 @@ def walk(starttask):
                 'Require a Task instance, got %s' % type(task)
         return task
 
-    def _dfs(task, ttl=500):
-        assert ttl, 'DFS reached depth limit, check for cyclic dependencies'
-        yield task
-        for dep in map(_n, task.deps):
-            yield dep
-            for subdep in _dfs(dep, ttl-1):
-                yield subdep
+    def _deps(task):
+        deps = map(_n, task.deps)
+        return deps, iter(reversed(deps))
 
+    start = _n(starttask)
+    stack = [(start, _deps(start))]
+    onstack = set([start])
     seen = set()
-    for t in reversed(list(_dfs(_n(starttask)))):
-        if t not in seen:
-            seen.add(t)
-            yield t
+    while stack:
+        task, (deps, pending) = stack[-1]
+        for dep in pending:
+            if dep in seen:
+                continue
+            assert dep not in onstack, \
+                    'Cyclic dependency found on %s' % taskid(dep)
+            onstack.add(dep)
+            stack.append((dep, _deps(dep)))
+            break
+        else:
+            stack.pop()
+            onstack.remove(task)
+            seen.add(task)
+            yield task, deps
 
 def find_redundant_deps(starttask):
     """Returns a list of of tuples of the form (task, dep, seen_in) where:
@@ -175,10 +552,75 @@ def find_redundant_deps(starttask):
                 yield (tid, depid), seenin
             seen[depid].add(tid)
 
+def _sources(objects):
+    """Returns the source files of the classes of objects and their bases
+
+    >>> _sources([Task()])[0].rstrip('c')[-7:]
+    'task.py'
+    """
+    paths = set()
+    for cls in set(type(o) for o in objects):
+        for base in getmro(cls):
+            module = sys.modules.get(base.__module__)
+            path = getattr(module, '__file__', None)
+            if path:
+                if path.endswith(('.pyc', '.pyo')):
+                    path = path[:-1]
+                paths.add(os.path.abspath(path))
+    return sorted(paths)
+
 def taskid(task):
     """Returns the task id"""
     return task.__name__ if type(task) is type else task.__class__.__name__
 
+def _release(finished, waiting, dependents):
+    """Yield tasks that become ready to execute once finished is done"""
+    for i, task, skipped in dependents[finished]:
+        waiting[task].discard(finished)
+        if not waiting[task]:
+            yield i, task, skipped
+
+def _seconds(delta):
+    """Returns the total seconds of a timedelta
+
+    >>> from datetime import timedelta
+    >>> _seconds(timedelta(days=1, seconds=2, microseconds=500000))
+    86402.5
+    """
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+class _ThreadPool(object):
+    """Call functions in a fixed number of daemon threads"""
+
+    def __init__(self, size):
+        self.inqueue = Queue()
+        self.outqueue = Queue()
+        self.threads = [Thread(target=self._work) for _ in xrange(size)]
+        for thread in self.threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def _work(self):
+        for key, func, args in iter(self.inqueue.get, None):
+            try:
+                func(*args)
+            except:
+                self.outqueue.put((key, sys.exc_info()))
+            else:
+                self.outqueue.put((key, None))
+
+    def submit(self, key, func, *args):
+        self.inqueue.put((key, func, args))
+
+    def result(self):
+        """Wait for the next call to finish and return its key and exc_info"""
+        # a timeout keeps the main thread responsive to KeyboardInterrupt
+        return self.outqueue.get(True, 86400 * 365)
+
+    def close(self):
+        for _ in self.threads:
+            self.inqueue.put(None)
+
 def _texpand(task, settings):
     """Expand templates found in task attributes
 
@@ -194,25 +636,62 @@ def _texpand(task, settings):
     >>> _texpand(t, settings)
     >>> t.output
     '/tmp/path/tmp/dir'
+
+    Class attributes without templates are left shared
+    >>> class T(Task):
+    ...     deps = [Task]
+    ...     inputs = ['$prefix/input']
+    >>> t = T()
+    >>> _texpand(t, settings)
+    >>> t.inputs, t.deps is T.deps, T.inputs
+    (['/tmp/input'], True, ['$prefix/input'])
     """
-    for attr in dir(task):
-        if attr.startswith("_"):
-            continue
+    attrs = set(_tplan(type(task)))
+    attrs.update(a for a in task.__dict__ if not a.startswith('_'))
+    for attr in attrs:
         v = getattr(task, attr)
-        if not callable(v):
-            nv = _titem(v, settings)
+        if callable(v):
+            continue
+        nv = _titem(v, settings)
+        if nv is not v:
             try:
                 setattr(task, attr, nv)
             except AttributeError:
                 # it may happen that the attribute is a property
                 pass
 
+def _tplan(cls):
+    """Returns the public class attributes of a task class holding
+    templates, found once for each class"""
+    plan = _tplans.get(cls)
+    if plan is None:
+        plan = _tplans[cls] = [a for a in dir(cls) if not a.startswith('_')
+                and _thas(getattr(cls, a))]
+    return plan
+
+_tplans = {}
+
+def _thas(v):
+    """Returns True if a value holds templates to expand"""
+    if isinstance(v, basestring):
+        return '$' in v
+    elif isinstance(v, (list, tuple)):
+        return any(_thas(i) for i in v)
+    elif isinstance(v, dict):
+        return any(_thas(i) for i in v.itervalues())
+    return False
+
 def _tsettings(settings):
     """Returns expanded settings
 
+    Settings are expanded once each, after the settings they reference, and
+    the result is cached for settings with the same content.
+
     Expand same template used twice in same value
     >>> _tsettings(dict(prefix='/tmp', path='$prefix/path$prefix'))
     {'path': '/tmp/path/tmp', 'prefix': '/tmp'}
+    >>> _tsettings(dict(a='$b/a', b='${c}b', c='c', d='$$c $unknown'))
+    {'a': 'cb/a', 'c': 'c', 'b': 'cb', 'd': '$c $unknown'}
 
     Looping expansion must fail
     >>> try:
@@ -229,22 +708,93 @@ def _tsettings(settings):
     ...         raise
     ... else:
     ...     raise AssertionError('loopvar expansion ignored')
+    >>> try:
+    ...     _tsettings(dict(a='$b', b='x/$c', c='$b', d='$a'))
+    ... except AssertionError, ex:
+    ...     print ex
+    Recursive value found during expansion: b -> c -> b
 
     """
+    try:
+        key = frozenset(settings.items())
+    except TypeError:
+        key = None
+    tvars = _tsettings_cache.get(key)
+    if tvars is None:
+        tvars = _texpandall(settings)
+        if key is not None:
+            if len(_tsettings_cache) >= 64:
+                _tsettings_cache.clear()
+            _tsettings_cache[key] = tvars
+    return dict(tvars)
+
+_tsettings_cache = {}
+
+def _texpandall(settings):
+    """Expand settings in the order of the references between them"""
+    tmpls = dict((k, _tcompile(v)) for k, v in settings.iteritems()
+            if isinstance(v, basestring) and '$' in v)
+    refs = lambda name: [p[0] for p in tmpls[name]
+            if isinstance(p, tuple) and p[0] in tmpls]
     tvars = dict(settings)
-    modified = True
-    while modified:
-        modified = False
-        for k, v in tvars.items():
-            if isinstance(v, basestring) and '$' in v:
-                assert k not in v or v == _tsub(v, {k: ''}), \
-                    "Recursive value found during expansion: %r" % v
-                nv = _tsub(v, tvars)
-                if nv != v:
-                    tvars[k] = nv
-                    modified = True
+    done = set()
+    for start in sorted(tmpls):
+        if start in done:
+            continue
+        path, pending = [start], [iter(refs(start))]
+        while path:
+            for ref in pending[-1]:
+                if ref in done:
+                    continue
+                assert ref not in path, \
+                        'Recursive value found during expansion: %s' % \
+                        ' -> '.join(path[path.index(ref):] + [ref])
+                path.append(ref)
+                pending.append(iter(refs(ref)))
+                break
+            else:
+                name = path.pop()
+                pending.pop()
+                tvars[name] = _trender(tmpls[name], tvars)
+                done.add(name)
     return tvars
 
+def _tcompile(tmpl):
+    """Returns a template as a list of literal strings and (name, text)
+    placeholders, compiled once for each template
+
+    >>> _tcompile('$a/${b}$$c$')
+    [('a', '$a'), '/', ('b', '${b}'), '$', 'c', '$']
+    """
+    parts = _tcompiled.get(tmpl)
+    if parts is None:
+        parts = []
+        pos = 0
+        for mo in Template.pattern.finditer(tmpl):
+            if mo.start() > pos:
+                parts.append(tmpl[pos:mo.start()])
+            name = mo.group('named') or mo.group('braced')
+            if name is not None:
+                parts.append((name, mo.group()))
+            elif mo.group('escaped') is not None:
+                parts.append(Template.delimiter)
+            else:
+                parts.append(mo.group())
+            pos = mo.end()
+        if pos < len(tmpl):
+            parts.append(tmpl[pos:])
+        if len(_tcompiled) >= 10000:
+            _tcompiled.clear()
+        _tcompiled[tmpl] = parts
+    return parts
+
+_tcompiled = {}
+
+def _trender(parts, tvars):
+    """Substitute a compiled template as Template.safe_substitute does"""
+    return ''.join(p if not isinstance(p, tuple) else
+            ('%s' % (tvars[p[0]],) if p[0] in tvars else p[1]) for p in parts)
+
 def _titem(v, tvars):
     """Replace templates
 
@@ -259,22 +809,23 @@ def _titem(v, tvars):
     ['1', 1, {'c': 2, 'r': '1'}, '2']
     >>> _titem(('$a', 1, '$b'), tvars)
     ('1', 1, '2')
+    >>> _titem('$empty', dict(empty=''))
+    ''
+
     >>> deps = [object(), object()]
-    >>> _titem(deps, tvars) == deps
+    >>> _titem(deps, tvars) is deps
     True
 
     """
-    if isinstance(v, list):
-        return [_titem(v, tvars) for v in v]
-    elif isinstance(v, tuple):
-        return tuple(_titem(v, tvars) for v in v)
+    if isinstance(v, basestring):
+        return _trender(_tcompile(v), tvars) if '$' in v else v
+    elif isinstance(v, (list, tuple)):
+        items = [_titem(i, tvars) for i in v]
+        if [i for i, ni in zip(v, items) if i is not ni]:
+            return tuple(items) if isinstance(v, tuple) else items
     elif isinstance(v, dict):
-        return dict((k, _titem(v, tvars)) for k, v in v.iteritems())
-    elif isinstance(v, basestring) and '$' in v:
-        return _tsub(v, tvars)
-    else:
-        return v
-
-def _tsub(tmpl, *args, **kwargs):
-    return Template(tmpl).safe_substitute(*args, **kwargs)
+        items = dict((k, _titem(i, tvars)) for k, i in v.iteritems())
+        if [k for k in v if v[k] is not items[k]]:
+            return items
+    return v
 
@@ -0,0 +1,667 @@
+import os
+import sys
+import json
+import socket
+from time import time
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread, Event
+from subprocess import CalledProcessError
+from posixpath import dirname, basename
+from urlparse import urlsplit, parse_qsl
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase
+from gzip import GzipFile
+from StringIO import StringIO
+
+from sworkflow import hdfs
+from sworkflow.webhdfs import WebHDFS, WebHDFSError
+from sworkflow.tasks import HDFSActionTask
+from sworkflow.tasks.dumbotask import any_matches
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass # clients closing their connections
+
+
+class FakeWebHDFS(object):
+    """In-memory WebHDFS namenode and datanode served on a local port"""
+
+    def __init__(self):
+        self.files = {'/': None} # path -> content, None for directories
+        self.mtimes = {'/': 0}
+        self.requests = []
+        self.connections = 0
+        self.sockets = []
+        self.renameoptions = True
+        self.failures = {} # (op, path) -> number of requests to fail
+        fake = self
+
+        class Handler(WebHDFSHandler):
+            fs = fake
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        # datanodes are reached through other connections than the namenode
+        self.datanode = 'http://localhost:%d' % self.server.server_address[1]
+        thread = Thread(target=self.server.serve_forever, args=(0.01,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def add(self, path, content=None):
+        """Add a file, or a directory when content is None, and its parents"""
+        if dirname(path) not in self.files:
+            self.add(dirname(path))
+        self.files[path] = content
+        self.mtimes[path] = int(time() * 1000)
+
+    def children(self, path):
+        return sorted(p for p in self.files
+                if p != '/' and dirname(p) == path)
+
+    def subtree(self, path):
+        prefix = path.rstrip('/') + '/'
+        return [p for p in self.files if p == path or p.startswith(prefix)]
+
+    def status(self, path, suffix=''):
+        content = self.files[path]
+        return {
+            'pathSuffix': suffix,
+            'type': 'DIRECTORY' if content is None else 'FILE',
+            'length': len(content or ''),
+            'owner': 'hadoop',
+            'group': 'supergroup',
+            'permission': '755' if content is None else '644',
+            'replication': 0 if content is None else 3,
+            'modificationTime': self.mtimes[path],
+        }
+
+
+class WebHDFSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    fs = None
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.fs.connections += 1
+        self.fs.sockets.append(self.connection)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_op()
+
+    do_PUT = do_DELETE = do_GET
+
+    def reply(self, status, obj=None, data=None, headers=()):
+        if obj is not None:
+            data = json.dumps(obj)
+        data = data or ''
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def error(self, status, exception, message):
+        self.reply(status, {'RemoteException': {
+            'exception': exception, 'message': message}})
+
+    def body(self):
+        if self.headers.get('transfer-encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    return ''.join(chunks)
+        return self.rfile.read(int(self.headers.get('content-length', 0)))
+
+    def handle_op(self):
+        url = urlsplit(self.path)
+        path = url.path[len('/webhdfs/v1'):].rstrip('/') or '/'
+        query = dict(parse_qsl(url.query))
+        op = query['op']
+        fs = self.fs
+        fs.requests.append((self.command, op, path))
+        exists = path in fs.files
+        if fs.failures.get((op, path)):
+            fs.failures[(op, path)] -= 1
+            return self.error(500, 'IOException', 'Failed %s' % op)
+
+        if op in ('OPEN', 'CREATE') and 'datanode' not in query:
+            location = '%s%s&datanode=true' % (fs.datanode, self.path)
+            return self.reply(307, headers=[('Location', location)])
+        if op not in ('MKDIRS', 'CREATE', 'DELETE') and not exists:
+            return self.error(404, 'FileNotFoundException',
+                    'File does not exist: %s' % path)
+
+        if op == 'GETFILESTATUS':
+            self.reply(200, {'FileStatus': fs.status(path)})
+        elif op == 'LISTSTATUS':
+            if fs.files[path] is None:
+                statuses = [fs.status(p, basename(p))
+                        for p in fs.children(path)]
+            else:
+                statuses = [fs.status(path)]
+            self.reply(200, {'FileStatuses': {'FileStatus': statuses}})
+        elif op == 'GETCONTENTSUMMARY':
+            length = sum(len(fs.files[p] or '') for p in fs.subtree(path))
+            self.reply(200, {'ContentSummary': {'length': length}})
+        elif op == 'MKDIRS':
+            if not exists:
+                fs.add(path)
+            self.reply(200, {'boolean': True})
+        elif op == 'DELETE':
+            if not exists:
+                return self.reply(200, {'boolean': False})
+            if query.get('recursive') != 'true' and fs.children(path):
+                return self.error(403, 'IOException',
+                        '%s is non empty' % path)
+            for p in fs.subtree(path):
+                del fs.files[p]
+            self.reply(200, {'boolean': True})
+        elif op == 'RENAME':
+            dst = query['destination']
+            overwrite = fs.renameoptions and \
+                    query.get('renameoptions') == 'OVERWRITE'
+            if overwrite and fs.files.get(dst, '') is not None:
+                fs.files.pop(dst, None)
+            if dst in fs.files or dirname(dst) not in fs.files:
+                return self.reply(200, {'boolean': False})
+            for p in fs.subtree(path):
+                fs.files[dst + p[len(path):]] = fs.files.pop(p)
+                fs.mtimes[dst + p[len(path):]] = fs.mtimes[p]
+            self.reply(200, {'boolean': True})
+        elif op == 'CREATE':
+            data = self.body()
+            if exists and query.get('overwrite') != 'true':
+                return self.error(403, 'FileAlreadyExistsException',
+                        '%s already exists' % path)
+            fs.add(path, data)
+            self.reply(201)
+        elif op == 'OPEN':
+            self.reply(200, data=fs.files[path])
+        else:
+            self.error(400, 'IllegalArgumentException', 'Invalid op %s' % op)
+
+
+class WebHDFSTestCase(TestCase):
+
+    def setUp(self):
+        self.fs = FakeWebHDFS()
+        self.fs.add('/data/logs/part-00000', 'line1\nline2\n')
+        self.fs.add('/data/logs/part-00001', 'line3\n')
+        self.fs.add('/data/logs_wip/part-00000', 'wip\n')
+        self.previous = hdfs.set_backend(WebHDFS(self.fs.url, user='test'))
+        self.tmp = mkdtemp()
+
+    def tearDown(self):
+        hdfs.set_backend(self.previous)
+        self.fs.shutdown()
+        rmtree(self.tmp)
+
+    def test_ls(self):
+        self.assertEqual(hdfs.ls('/data/logs'),
+                ['/data/logs/part-00000', '/data/logs/part-00001'])
+        self.assertEqual(hdfs.ls('/data/logs/part-0000[1-2]'),
+                ['/data/logs/part-00001'])
+        self.assertEqual(hdfs.ls('/data/logs/missing'), [])
+        self.assertEqual(hdfs.lsr('/data/*_wip'), ['/data/logs_wip/part-00000'])
+        self.assertEqual(hdfs.lsr('/data'), ['/data/logs',
+            '/data/logs/part-00000', '/data/logs/part-00001',
+            '/data/logs_wip', '/data/logs_wip/part-00000'])
+
+        rows = hdfs.ls('/data', extended=True)
+        self.assertEqual([(r['perms'], r['replication'], r['size'])
+            for r in rows], [('drwxr-xr-x', '-', '0')] * 2)
+        self.assertEqual(sorted(rows[0]), ['date', 'group', 'path', 'perms',
+            'replication', 'size', 'time', 'user'])
+
+        statuses = hdfs.lsr('/data/logs', iterator=True)
+        self.assertFalse(isinstance(statuses, list))
+        self.assertEqual([(s.path, s.size, s.isdir) for s in statuses], [
+            ('/data/logs/part-00000', 12, False),
+            ('/data/logs/part-00001', 6, False)])
+
+    def test_du(self):
+        self.assertEqual(hdfs.dus('/data/logs*'), [
+            {'path': '/data/logs', 'usage': '18'},
+            {'path': '/data/logs_wip', 'usage': '4'}])
+        self.assertEqual(hdfs.du('/data/logs'), [
+            {'path': '/data/logs/part-00000', 'usage': '12'},
+            {'path': '/data/logs/part-00001', 'usage': '6'}])
+        self.assertEqual(hdfs.dus('/data/missing*'), [])
+        self.assertEqual(sum(u.usage for u in hdfs.du('/data/logs*',
+            iterator=True)), 22)
+
+    def test_exists(self):
+        self.assertTrue(hdfs.path_exists('/data/logs'))
+        self.assertTrue(hdfs.path_exists('hdfs://namenode:9000/data/logs/'))
+        self.assertTrue(hdfs.path_exists('/data/logs/part-*'))
+        self.assertFalse(hdfs.path_exists('/data/missing'))
+        self.assertEqual(hdfs.mtime('/data/missing'), None)
+        self.assertAlmostEqual(hdfs.mtime('/data/logs'), time(), -1)
+
+    def test_operations(self):
+        hdfs.mkdir('/data/new/dir')
+        hdfs.mkdir('/data/new/dir')
+        self.assertRaises(CalledProcessError, hdfs.mkdir, '/data/new/dir',
+                fail_if_exists=True)
+        hdfs.mv('/data/new/dir', '/data/logs/part-*')
+        self.assertEqual(hdfs.ls('/data/new/dir'),
+                ['/data/new/dir/part-00000', '/data/new/dir/part-00001'])
+        hdfs.mv('/data/logs_done', '/data/logs_wip')
+        self.assertTrue(hdfs.path_exists('/data/logs_done/part-00000'))
+        self.assertRaises(CalledProcessError, hdfs.rm, '/data/new')
+        hdfs.rm('/data/new/dir/part-00000')
+        hdfs.rmr('/data/new')
+        self.assertFalse(hdfs.path_exists('/data/new'))
+        self.assertRaises(CalledProcessError, hdfs.rmr, '/data/new')
+        hdfs.touchz('/data/empty')
+        self.assertEqual(hdfs.dus('/data/empty')[0]['usage'], '0')
+        self.assertRaises(CalledProcessError, hdfs.touchz, '/data/logs_done/part-00000')
+
+    def test_transfer(self):
+        self.assertEqual(hdfs.cat('/data/logs/part-*').readlines(),
+                ['line1\n', 'line2\n', 'line3\n'])
+        hdfs.get(self.tmp, '/data/logs/part-00001')
+        local = os.path.join(self.tmp, 'part-00001')
+        self.assertEqual(open(local).read(), 'line3\n')
+        hdfs.put('/data/copy', local)
+        self.assertEqual(self.fs.files['/data/copy'], 'line3\n')
+        self.assertRaises(CalledProcessError, hdfs.put, '/data/copy', local)
+        del self.fs.requests[:]
+        hdfs.put('/data/copy', local, overwrite=True)
+        # a single path is checked, not found in a listing of its parent
+        self.assertEqual([r for r in self.fs.requests if r[1] == 'LISTSTATUS'],
+                [])
+
+        out = hdfs.HDFSOutputFile('/data/copy')
+        out.write('new content')
+        out.close()
+        self.assertEqual(hdfs.HDFSInputFile('/data/copy').read(), 'new content')
+
+    def test_output_file(self):
+        self.fs.add('/data/out', 'old')
+        out = hdfs.HDFSOutputFile('/data/out')
+        out.writelines(['line %d\n' % i for i in xrange(20000)])
+        self.assertEqual(self.fs.files['/data/out'], 'old')
+        out.close()
+        self.assertEqual(self.fs.files['/data/out'].count('\n'), 20000)
+        self.assertEqual(hdfs.ls('/data/out*'), ['/data/out'])
+        self.assertTrue([r for r in self.fs.requests if r[1] == 'RENAME'])
+
+        try:
+            with hdfs.HDFSOutputFile('/data/out') as out:
+                out.write('partial')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.fs.children('/data'),
+                ['/data/logs', '/data/logs_wip', '/data/out'])
+        self.assertEqual(self.fs.files['/data/out'][:7], 'line 0\n')
+
+        # namenodes without rename options
+        self.fs.renameoptions = False
+        with hdfs.HDFSOutputFile('/data/out') as out:
+            out.write('new')
+        self.assertEqual(self.fs.files['/data/out'], 'new')
+        self.assertEqual(self.fs.children('/data'),
+                ['/data/logs', '/data/logs_wip', '/data/out'])
+
+    def test_input_file(self):
+        content = ''.join('line %d\n' % i for i in xrange(50000))
+        self.fs.add('/data/big', content)
+        f = hdfs.HDFSInputFile('/data/big', readahead=1)
+        self.assertEqual(f.readline(), 'line 0\n')
+        buf = bytearray(10)
+        self.assertEqual(f.readinto(buf), 10)
+        self.assertEqual(str(buf), 'line 1\nlin')
+        self.assertEqual(sum(1 for _ in f), 49998)
+        f.close()
+
+        compressed = StringIO()
+        for part in (content[:1000], content[1000:]):
+            gz = GzipFile(fileobj=compressed, mode='wb')
+            gz.write(part)
+            gz.close()
+        self.fs.add('/data/big.gz', compressed.getvalue())
+        f = hdfs.HDFSInputFile('/data/big.gz', compression='auto')
+        self.assertEqual(f.read(), content)
+        f.close()
+
+        f = hdfs.HDFSInputFile('/data/big.gz', compression='gzip',
+                seekable=True)
+        self.assertEqual(f.read(7), 'line 0\n')
+        f.seek(-8, 2)
+        self.assertEqual(f.read(), 'e 49999\n')
+        f.seek(1)
+        self.assertEqual(f.readline(), 'ine 0\n')
+        self.assertEqual(f.tell(), 7)
+        f.close()
+        self.assertRaises(IOError, hdfs.HDFSInputFile('/data/big').seek, 0)
+
+    def test_writer(self):
+        lines = ['line %d\n' % i for i in xrange(100)]
+        writer = hdfs.HDFSWriter('/data/export', partsize=40)
+        for line in lines:
+            writer.write(line)
+        writer.complete()
+        self.assertEqual(hdfs.ls('/data/export'), ['/data/export/part-00000',
+            '/data/export/part-00001', '/data/export/part-00002'])
+        self.assertEqual(self.fs.files['/data/export/part-00002'],
+                ''.join(lines[80:]))
+
+        writer = hdfs.HDFSWriter('/data/export', partbytes=300,
+                uploads=3, compression='gzip')
+        writer.batchsize = 100
+        for line in lines:
+            writer.write(line)
+        writer.complete()
+        parts = hdfs.ls('/data/export')
+        self.assertEqual(len(parts), 3)
+        self.assertEqual(parts[-1], '/data/export/part-00002.gz')
+        content = [GzipFile(fileobj=StringIO(self.fs.files[p])).read()
+                for p in parts]
+        self.assertEqual(''.join(content), ''.join(lines))
+        self.assertTrue(len(content[0]) >= 300)
+
+        # a part failing when it is completed is raised, not waited for
+        writer = hdfs.HDFSWriter('/data/export')
+        self.fs.add('/data/export/part-00000', 'taken')
+        for line in lines:
+            writer.write(line)
+        self.assertRaises(WebHDFSError, writer.complete)
+        self.assertEqual(self.fs.files['/data/export/part-00000'], 'taken')
+
+    def test_batch_operations(self):
+        partitions = ['/data/logs/part-%05d' % i for i in xrange(100)]
+        for path in partitions[2:]:
+            self.fs.add(path, 'x')
+        del self.fs.requests[:]
+        exists = hdfs.exists_many(partitions + ['/data/missing/part-00000',
+            '/data/logs_*/part-0000[0-1]', '/data/logs/'])
+        # the parent directories are listed, not every partition
+        self.assertEqual([r for r in self.fs.requests
+            if r[2].startswith('/data/logs/')], [])
+        self.assertTrue(all(exists[p] for p in partitions))
+        self.assertFalse(exists['/data/missing/part-00000'])
+        self.assertTrue(exists['/data/logs_*/part-0000[0-1]'])
+        self.assertTrue(exists['/data/logs/'])
+        statuses = hdfs.stat_many(['/data/logs', '/data/logs/part-00001',
+            '/data/nothing'])
+        self.assertTrue(statuses['/data/logs'].isdir)
+        self.assertEqual(statuses['/data/logs/part-00001'].size, 6)
+        self.assertEqual(statuses['/data/nothing'], None)
+
+        task = HDFSActionTask(operation='path_exists',
+                paths=partitions[:3] + ['/data/nothing', '/data/none'])
+        try:
+            task.execute()
+        except AssertionError, ex:
+            self.assertEqual(str(ex), 'path does not exists /data/nothing, '
+                    '/data/none')
+        else:
+            self.fail('missing paths not reported')
+
+        self.assertEqual(hdfs.rm_many(partitions[90:] + ['/data/nothing']),
+                partitions[90:])
+        self.assertFalse(hdfs.exists_many(partitions[90:])[partitions[95]])
+
+        hdfs.mkdir('/data/moved')
+        hdfs.mv_many([(p, p.replace('logs', 'moved')) for p in partitions[:3]]
+                + [('/data/logs_wip', '/data/done')])
+        self.assertEqual(hdfs.ls('/data/moved'),
+                [p.replace('logs', 'moved') for p in partitions[:3]])
+        self.assertTrue(hdfs.path_exists('/data/done/part-00000'))
+
+    def test_parallel_transfers(self):
+        for i in xrange(20):
+            self.fs.add('/data/parts/part-%05d' % i, 'part %d\n' % i)
+        self.fs.add('/data/parts/sub/part-00000', 'sub\n')
+        self.fs.failures[('OPEN', '/data/parts/part-00003')] = 2
+        reports = []
+        progress = lambda done, total, rate: reports.append((done, total))
+        hdfs.get_many(os.path.join(self.tmp, 'parts'), '/data/parts',
+                jobs=4, progress=progress)
+        local = os.path.join(self.tmp, 'parts')
+        self.assertEqual(len(os.listdir(local)), 21)
+        self.assertEqual(open(os.path.join(local, 'part-00003')).read(),
+                'part 3\n')
+        self.assertEqual(open(os.path.join(local, 'sub', 'part-00000')).read(),
+                'sub\n')
+        self.assertEqual(len(reports), 21)
+        self.assertEqual(reports[-1], (154, 154))
+
+        self.fs.failures[('OPEN', '/data/parts/part-00003')] = 3
+        self.assertRaises(CalledProcessError, hdfs.get_many,
+                os.path.join(self.tmp, 'failed'), '/data/parts/part-0000*')
+        self.assertRaises(IOError, hdfs.get_many, self.tmp, '/data/missing')
+
+        hdfs.put_many('/data/uploaded', local, os.path.join(self.tmp, 'part*'),
+                jobs=3)
+        self.assertEqual(self.fs.files['/data/uploaded/parts/sub/part-00000'],
+                'sub\n')
+        self.assertEqual(len(self.fs.children('/data/uploaded/parts')), 21)
+
+        # a slow file doesn't keep the other threads waiting
+        released = Event()
+        def copy(i):
+            if i == 0:
+                released.wait(10)
+            elif i == 9:
+                released.set()
+            return i
+        self.assertEqual(list(hdfs._unordered(copy, range(10), 2))[-1], 0)
+
+        contents = hdfs.cat_parallel('/data/parts/part-0001*', '/data/logs',
+                jobs=3)
+        self.assertEqual([c for _, c in contents],
+                ['part %d\n' % i for i in xrange(10, 20)] +
+                ['line1\nline2\n', 'line3\n'])
+
+    def test_metadata_cache(self):
+        hdfs.enable_cache(ttl=60)
+        requests = self.fs.requests
+        self.assertEqual(len(hdfs.ls('/data/logs')), 2)
+        count = len(requests)
+        self.assertTrue(hdfs.path_exists('/data/logs'))
+        self.assertTrue(hdfs.path_exists('/data/logs/part-00001'))
+        self.assertEqual(hdfs.ls('/data/logs'), hdfs.ls('/data/logs/'[:-1]))
+        self.assertEqual(len(requests), count)
+
+        self.assertEqual(len(hdfs.dus('/data/logs*')), 2)
+        count = len(requests)
+        self.assertEqual(len(hdfs.dus('/data/logs*')), 2)
+        self.assertEqual(len(requests), count)
+
+        # writes through the cache invalidate affected paths
+        hdfs.rmr('/data/logs_wip')
+        self.assertEqual(len(hdfs.dus('/data/logs*')), 1)
+        self.assertFalse(hdfs.path_exists('/data/logs_wip/part-00000'))
+        hdfs.mv('/data/logs_wip', '/data/logs')
+        self.assertFalse(hdfs.path_exists('/data/logs/part-00001'))
+        self.assertTrue(hdfs.path_exists('/data/logs_wip/part-00001'))
+
+        stats = hdfs.get_backend().stats()
+        self.assertEqual((stats['hits'], stats['misses']), (5, 6))
+
+        # streamed and recursive listings aren't kept
+        self.assertEqual(len(list(hdfs.ls('/data', iterator=True))), 1)
+        self.assertEqual(len(hdfs.lsr('/data')), 3)
+        self.assertEqual(hdfs.get_backend().stats()['entries'],
+                stats['entries'])
+
+        # outside changes are seen after invalidation or once expired
+        self.assertFalse(hdfs.path_exists('/data/other'))
+        self.fs.add('/data/other')
+        self.assertFalse(hdfs.path_exists('/data/other'))
+        hdfs.invalidate('/data/other')
+        self.assertTrue(hdfs.path_exists('/data/other'))
+
+        # relative paths are the same paths in the home directory
+        self.fs.add('/user/test/rel', 'x')
+        self.assertTrue(hdfs.path_exists('rel'))
+        hdfs.rm('/user/test/rel')
+        self.assertFalse(hdfs.path_exists('rel'))
+
+        # results computed across an invalidation aren't kept
+        class Racing(object):
+            def exists(self, path):
+                cache.invalidate(path)
+                return True
+        cache = hdfs.MetadataCache(Racing())
+        self.assertTrue(cache.exists('/data/racing'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+        # rows of one listed path don't tell that another one exists
+        self.assertEqual(len(hdfs.ls('/data/logs_wip', '/data/gone')), 2)
+        self.assertTrue(hdfs.path_exists('/data/logs_wip'))
+        self.assertFalse(hdfs.path_exists('/data/gone'))
+
+        # polling for removed outputs isn't answered by the cache
+        self.assertTrue(hdfs.dus('/data/logs_w*'))
+        for path in self.fs.subtree('/data/logs_wip'):
+            del self.fs.files[path]
+        self.assertTrue(hdfs.dus('/data/logs_w*'))
+        self.assertFalse(any_matches('/data/logs_w*'))
+        hdfs.disable_cache()
+        self.assertTrue(isinstance(hdfs.get_backend(), WebHDFS))
+        hdfs.enable_cache(ttl=0)
+        self.assertTrue(hdfs.path_exists('/data/other'))
+        del self.fs.files['/data/other']
+        self.assertFalse(hdfs.path_exists('/data/other'))
+
+    def test_keepalive(self):
+        for _ in xrange(20):
+            hdfs.path_exists('/data/logs')
+            hdfs.ls('/data/logs')
+        self.assertEqual(self.fs.connections, 1)
+        # a file closed before its end leaves its datanode connection unread
+        self.fs.add('/data/big', 'x' * (1 << 20))
+        f = hdfs.cat('/data/big')
+        self.assertEqual(f.read(10), 'x' * 10)
+        f.close()
+        self.assertEqual(hdfs.cat('/data/logs/part-00001').read(), 'line3\n')
+        self.assertEqual(self.fs.connections, 3)
+
+
+class FsShellTestCase(TestCase):
+    """FsShell backend running a fake hadoop command printing listings"""
+
+    def setUp(self):
+        self.tmp = mkdtemp()
+        hadoop = os.path.join(self.tmp, 'hadoop')
+        open(hadoop, 'w').write('#!%s\n' % sys.executable + '''if 1:
+            import sys, signal
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            cmd = sys.argv[2]
+            if cmd in ('-ls', '-lsr'):
+                print 'Found 20001 items'
+                print 'drwxr-xr-x   - root supergroup          0 2010-06-16 17:28 /data/logs'
+                for i in xrange(20000):
+                    print '-rw-r--r--   3 root supergroup       %d 2010-06-16 17:29 /data/logs/part %05d' % (i, i)
+            elif cmd == '-du':
+                print 'Found 2 items'
+                print '12          hdfs://namenode/data/logs/part-00000'
+                print '6           hdfs://namenode/data/logs/part-00001'
+            elif cmd == '-dus':
+                print 'hdfs://namenode/data/logs\t18'
+            elif cmd in ('-put', '-mv', '-test', '-rmr'):
+                import os, shutil
+                root = os.environ['FAKE_HDFS_ROOT']
+                local = lambda path: os.path.join(root, path.lstrip('/'))
+                if cmd == '-put':
+                    open(local(sys.argv[4]), 'w').write(sys.stdin.read())
+                elif cmd == '-mv':
+                    os.rename(local(sys.argv[3]), local(sys.argv[4]))
+                elif cmd == '-test':
+                    sys.exit(0 if os.path.exists(local(sys.argv[4])) else 1)
+                elif os.path.isdir(local(sys.argv[3])):
+                    shutil.rmtree(local(sys.argv[3]))
+                else:
+                    os.remove(local(sys.argv[3]))
+            elif cmd == '-cat':
+                if sys.argv[3] != '/data/logs/part-00000':
+                    print >> sys.stderr, 'cat: File does not exist'
+                    sys.exit(255)
+                print 'line1'
+                print 'line2'
+        ''')
+        os.chmod(hadoop, 0755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.tmp + os.pathsep + self.path
+        self.root = os.path.join(self.tmp, 'root')
+        os.makedirs(os.path.join(self.root, 'data'))
+        open(os.path.join(self.root, 'data', 'out'), 'w').write('old')
+        os.environ['FAKE_HDFS_ROOT'] = self.root
+        self.previous = hdfs.set_backend(hdfs.FsShell())
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        hdfs.set_backend(self.previous)
+        rmtree(self.tmp)
+
+    def test_ls(self):
+        statuses = hdfs.lsr('/data', iterator=True)
+        first = statuses.next()
+        self.assertEqual((first.path, first.isdir, first.replication),
+                ('/data/logs', True, None))
+        total = files = 0
+        for status in statuses:
+            files += 1
+            total += status.size
+        self.assertEqual((files, total), (20000, sum(xrange(20000))))
+        self.assertEqual(status.path, '/data/logs/part 19999')
+        self.assertEqual(status.mtime.strftime('%Y-%m-%d %H:%M'),
+                '2010-06-16 17:29')
+
+        # the listing can be abandoned before the command ends
+        statuses = hdfs.ls('/data', iterator=True)
+        statuses.next()
+        statuses.close()
+
+        row = hdfs.ls('/data', extended=True)[1]
+        self.assertEqual((row['replication'], row['size'], row['time']),
+                ('3', '0', '17:29'))
+
+    def test_cat(self):
+        self.assertEqual(list(hdfs.HDFSInputFile('/data/logs/part-00000')),
+                ['line1\n', 'line2\n'])
+        self.assertRaises(CalledProcessError, hdfs.cat('/data/missing').read)
+        self.assertRaises(CalledProcessError,
+                hdfs.HDFSInputFile('/data/missing').readline)
+
+    def test_output_file(self):
+        out = hdfs.HDFSOutputFile('/data/out')
+        out.write('new content')
+        out.close()
+        self.assertEqual(os.listdir(os.path.join(self.root, 'data')), ['out'])
+        self.assertEqual(open(os.path.join(self.root, 'data', 'out')).read(),
+                'new content')
+
+    def test_du(self):
+        self.assertEqual(hdfs.du('/data/logs'), [
+            {'path': 'hdfs://namenode/data/logs/part-00000', 'usage': '12'},
+            {'path': 'hdfs://namenode/data/logs/part-00001', 'usage': '6'}])
+        self.assertEqual([tuple(u) for u in hdfs.dus('/data/logs', iterator=True)],
+                [('hdfs://namenode/data/logs', 18)])
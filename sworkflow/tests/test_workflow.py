@@ -1,6 +1,18 @@
+import os
+import sys
+import logging
+from time import time
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event
+from subprocess import CalledProcessError
 from unittest import TestCase
 from sworkflow.tasks import Task, PythonTask
 from sworkflow.tasks.workflow import Workflow, walk, ExitWorkflow
+from sworkflow.tasks.workers import WorkerPool, set_pool
+from sworkflow.tasks.supervisor import ProcessTimeout
+from sworkflow.tasks.plans import PlanCache
+from sworkflow.ctl import WorkflowControl
 
 class TaskTestCase(TestCase):
 
@@ -59,6 +71,23 @@ class WalkTestCase(TestCase):
         t1.deps = [t2]
         self.assertRaises(AssertionError, list, walk(t1))
 
+    def test_deep_chain(self):
+        tasks = [Task(taskname=0)]
+        for i in xrange(1, 50000):
+            tasks.append(Task(taskname=i, deps=[tasks[-1]]))
+        self.assertEqual(list(walk(tasks[-1])), tasks)
+
+    def test_diamond_dependencies(self):
+        # every level doubles the number of paths to the first task
+        top = Task(taskname='T0')
+        for i in xrange(1, 60):
+            left = Task(taskname='L%d' % i, deps=[top])
+            right = Task(taskname='R%d' % i, deps=[top])
+            top = Task(taskname='T%d' % i, deps=[left, right])
+        names = [t.taskname for t in walk(top)]
+        self.assertEqual(len(names), 59 * 3 + 1)
+        self.assertEqual(names[:4], ['T0', 'R1', 'L1', 'T1'])
+
     def test_invalid_task(self):
         t1 = Task()
         t2 = Task(deps=[t1, None])
@@ -211,6 +240,594 @@ class WorkflowTestCase(TestCase):
 
 
 
+    def test_forked_pythontask(self):
+        tmp = mkdtemp()
+        self.addCleanup(rmtree, tmp)
+        open(os.path.join(tmp, 'forkedmod.py'), 'w').write(
+            'import os, sys, atexit\n'
+            'atexit.register(open, "exited", "w")\n'
+            'open("out", "w").write(repr((sys.argv[1:], os.environ.get("V"))))\n'
+            'if sys.argv[1] == "fail": raise ValueError\n'
+            'sys.exit(int(sys.argv[1]))\n')
+        class ForkedTask(PythonTask):
+            execmode = 'fork'
+            execcwd = tmp
+            execenv = {'V': 'value'}
+        cwd, argv = os.getcwd(), list(sys.argv)
+
+        ForkedTask(execargs=['forkedmod', '0']).execute()
+        self.assertEqual(open(os.path.join(tmp, 'out')).read(),
+                "(['0'], 'value')")
+        self.assertTrue(os.path.exists(os.path.join(tmp, 'exited')))
+        for status in (70, 75, 90):
+            try:
+                ForkedTask(execargs=['forkedmod', str(status)]).execute()
+            except ExitWorkflow, exc:
+                self.assertEqual(exc.status, status)
+            else:
+                self.fail('ExitWorkflow not raised')
+        try:
+            ForkedTask(execargs=['forkedmod', 'fail']).execute()
+        except CalledProcessError, exc:
+            self.assertEqual(exc.returncode, 1)
+        else:
+            self.fail('CalledProcessError not raised')
+        self.assertEqual((os.getcwd(), sys.argv, os.environ.get('V')),
+                (cwd, argv, None))
+
+        # other threads may hold locks the forked child would inherit
+        class Parallel(Workflow):
+            starttask = ForkedTask(execargs=['forkedmod', '0'])
+        self.assertRaises(ValueError, Parallel(jobs=2).execute)
+
+    def test_pooled_pythontask(self):
+        tmp = mkdtemp()
+        self.addCleanup(rmtree, tmp)
+        open(os.path.join(tmp, 'pooledmod.py'), 'w').write(
+            'import os, sys\n'
+            'open("out", "w").write(repr((os.getpid(), os.environ.get("V"))))\n'
+            'if sys.argv[1] == "exit": os._exit(3)\n'
+            'sys.exit(int(sys.argv[1]))\n')
+        pool = WorkerPool(size=1, maxtasks=2)
+        self.addCleanup(pool.close)
+        self.addCleanup(set_pool, set_pool(pool))
+        class PooledTask(PythonTask):
+            execmode = 'pool'
+            execcwd = tmp
+            execenv = {'V': 'value'}
+        def run(arg):
+            PooledTask(execargs=['pooledmod', arg]).execute()
+            pid, value = eval(open(os.path.join(tmp, 'out')).read())
+            self.assertEqual(value, 'value')
+            self.assertNotEqual(pid, os.getpid())
+            return pid
+        cwd = os.getcwd()
+
+        first = run('0')
+        self.assertEqual(run('0'), first)
+        # workers are replaced after maxtasks
+        self.assertNotEqual(run('0'), first)
+        for status in (70, 75, 90):
+            try:
+                run(str(status))
+            except ExitWorkflow, exc:
+                self.assertEqual(exc.status, status)
+            else:
+                self.fail('ExitWorkflow not raised')
+        self.assertRaises(CalledProcessError, run, 'exit')
+        self.assertTrue(run('0'))
+        self.assertEqual((os.getcwd(), os.environ.get('V')), (cwd, None))
+
+    def test_supervised_pythontask(self):
+        tmp = mkdtemp()
+        self.addCleanup(rmtree, tmp)
+        open(os.path.join(tmp, 'spawnedmod.py'), 'w').write(
+            'import sys, time\n'
+            'print "out", "x" * 20000\n'
+            'print >> sys.stderr, "err"\n'
+            'sys.stdout.flush()\n'
+            'time.sleep(float(sys.argv[1]))\n'
+            'sys.exit(int(sys.argv[2]))\n')
+        logged = []
+        class SpawnedTask(PythonTask):
+            execcwd = tmp
+            def log(self, msg, *args, **kwargs):
+                logged.append(msg % args)
+        lines = ['out ' + 'x' * 8188, 'x' * 8192, 'x' * 3620, 'err']
+
+        SpawnedTask(execargs=['spawnedmod', '0', '0']).execute()
+        # stdout and stderr lines are not ordered between them
+        self.assertEqual(sorted(logged[1:]), sorted(lines))
+        # without logoutput the program writes to the workflow stdout
+        output = open(os.path.join(tmp, 'output'), 'w+')
+        saved = os.dup(1), os.dup(2)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+        try:
+            SpawnedTask(execargs=['spawnedmod', '0', '0'],
+                    logoutput=False).execute()
+        finally:
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            map(os.close, saved)
+        self.assertEqual(len(logged), 6)
+        output.seek(0)
+        self.assertEqual(sorted(output.read().split('\n')),
+                sorted(['out ' + 'x' * 20000, 'err', '']))
+        try:
+            SpawnedTask(execargs=['spawnedmod', '0', '3']).execute()
+        except CalledProcessError, exc:
+            self.assertEqual(exc.returncode, 3)
+            self.assertEqual(sorted(exc.output.split('\n')), sorted(lines))
+        else:
+            self.fail('CalledProcessError not raised')
+
+        starttime = time()
+        self.assertRaises(ProcessTimeout, SpawnedTask(timeout=0.5,
+            execargs=['spawnedmod', '30', '0']).execute)
+        self.assertTrue(time() - starttime < 5)
+
+        # a task stopping the workflow terminates the running ones
+        errors = []
+        class RecordedTask(SpawnedTask):
+            def execute(self):
+                try:
+                    SpawnedTask.execute(self)
+                except Exception, exc:
+                    errors.append(exc)
+                    raise
+        st = Task(deps=[RecordedTask(execargs=['spawnedmod', '30', '0']),
+            RecordedTask(execargs=['spawnedmod', '30', '0']),
+            RecordedTask(execargs=['spawnedmod', '0.5', '75'])])
+        starttime = time()
+        wf = Workflow(starttask=st, jobs=3)
+        wf.execute()
+        self.assertTrue(time() - starttime < 5)
+        self.assertEqual(sorted(type(e).__name__ for e in errors),
+                ['ExitWorkflow', 'ProcessCancelled', 'ProcessCancelled'])
+
+    def test_streamed_pythontask(self):
+        tmp = mkdtemp()
+        self.addCleanup(rmtree, tmp)
+        open(os.path.join(tmp, 'producer.py'), 'w').write(
+            'import sys\n'
+            'for i in xrange(int(sys.argv[1])): print i\n')
+        open(os.path.join(tmp, 'consumer.py'), 'w').write(
+            'import sys\n'
+            'if sys.argv[1] != "0": sys.exit(int(sys.argv[1]))\n'
+            'open("out", "w").write(str(sum(int(l) for l in sys.stdin)))\n')
+        class Producer(PythonTask):
+            execcwd = tmp
+            execargs = ['producer', '1000000']
+        class Consumer(PythonTask):
+            execcwd = tmp
+            streaminput = True
+            deps = [Producer]
+        logged = []
+        class StreamWorkflow(Workflow):
+            def log(self, msg, *args, **kwargs):
+                logged.append(msg % args)
+
+        StreamWorkflow(starttask=Consumer(execargs=['consumer', '0'])).execute()
+        self.assertEqual(open(os.path.join(tmp, 'out')).read(),
+                str(sum(xrange(1000000))))
+        self.assertTrue('Task deferred, streams its output to 1-Consumer: '
+                '0-Producer' in logged)
+        self.assertTrue('Task succeed: 0-Producer in' in ' '.join(logged))
+
+        # streamed tasks run spawned whatever the default execmode
+        self.addCleanup(setattr, PythonTask, 'execmode', PythonTask.execmode)
+        PythonTask.execmode = 'fork'
+        os.remove(os.path.join(tmp, 'out'))
+        Workflow(starttask=Consumer(execargs=['consumer', '0']),
+                jobs=2).execute()
+        self.assertEqual(open(os.path.join(tmp, 'out')).read(),
+                str(sum(xrange(1000000))))
+
+        # the consumer exiting first isn't reported as a producer failure
+        wf = Workflow(starttask=Consumer(execargs=['consumer', '75']))
+        try:
+            wf._execute()
+        except ExitWorkflow, exc:
+            self.assertEqual((exc.task, exc.status), ('Consumer', 75))
+        else:
+            self.fail('ExitWorkflow not raised')
+
+        self.assertRaises(AssertionError, lambda: Workflow(
+                starttask=Task(deps=[Consumer, Producer])).tasks)
+
+    def test_fused_pythontask(self):
+        tmp = mkdtemp()
+        self.addCleanup(rmtree, tmp)
+        open(os.path.join(tmp, 'step.py'), 'w').write(
+            'import os, sys\n'
+            'print "step", sys.argv[1], os.environ.get("V")\n'
+            'open("out", "a").write("%d\\n" % os.getpid())\n'
+            'sys.exit(int(sys.argv[2]))\n')
+        logged = []
+        class Step(PythonTask):
+            execcwd = tmp
+            fuse = True
+            def log(self, msg, *args, **kwargs):
+                logged.append((str(self), msg % args))
+        class Step0(Step):
+            execargs = ['step', '0', '0']
+            execenv = {'V': 'value'}
+        class Step1(Step):
+            execargs = ['step', '1', '0']
+            deps = [Step0]
+        class Step2(Step):
+            execargs = ['step', '2', '0']
+            deps = [Step1]
+        class FusedWorkflow(Workflow):
+            def log(self, msg, *args, **kwargs):
+                logged.append(('Workflow', msg % args))
+
+        FusedWorkflow(starttask=Step2).execute()
+        self.assertEqual(len(set(open(os.path.join(tmp, 'out')))), 1)
+        self.assertTrue(('Step0', 'step 0 value') in logged)
+        self.assertTrue(('Step1', 'step 1 None') in logged)
+        self.assertTrue(('Step2', 'step 2 None') in logged)
+        started = [m for _, m in logged if m.startswith('Task started')]
+        self.assertEqual(started, ['Task started: 0-Step0',
+            'Task started: 1-Step1', 'Task started: 2-Step2'])
+        self.assertEqual(len([m for _, m in logged
+            if m.startswith('Task succeed')]), 3)
+
+        # chains are fused whatever the default execmode
+        self.addCleanup(setattr, PythonTask, 'execmode', PythonTask.execmode)
+        PythonTask.execmode = 'fork'
+        os.remove(os.path.join(tmp, 'out'))
+        FusedWorkflow(starttask=Step2, jobs=2).execute()
+        self.assertEqual(len(set(open(os.path.join(tmp, 'out')))), 1)
+
+        # the failing task stops the chain
+        del logged[:]
+        class FailStep1(Step1):
+            execargs = ['step', '1', '75']
+        class LastStep(Step2):
+            deps = [FailStep1]
+        wf = FusedWorkflow(starttask=LastStep)
+        try:
+            wf._execute()
+        except ExitWorkflow, exc:
+            self.assertEqual((exc.task, exc.status), ('FailStep1', 75))
+        else:
+            self.fail('ExitWorkflow not raised')
+        self.assertEqual([m for _, m in logged if m.startswith('Task ')
+            and 'deferred' not in m][-1][:25], 'Task failed: 1-FailStep1 ')
+        self.assertFalse([m for _, m in logged if 'LastStep' in m
+            and 'deferred' not in m])
+
+        # tasks aren't fused with a task streaming its output
+        del logged[:]
+        open(os.path.join(tmp, 'count.py'), 'w').write(
+            'import sys\n'
+            'open("count", "w").write(str(len(sys.stdin.readlines())))\n')
+        class Head(Step):
+            execargs = ['step', 'head', '0']
+        class Producer(Step):
+            execargs = ['step', 'producer', '0']
+            deps = [Head]
+        class Count(PythonTask):
+            execcwd = tmp
+            execargs = ['count']
+            streaminput = True
+            deps = [Producer]
+        FusedWorkflow(starttask=Count).execute()
+        self.assertTrue([m for _, m in logged
+            if m.startswith('Task succeed: 0-Head')])
+        self.assertEqual(open(os.path.join(tmp, 'count')).read(), '1')
+
+    def test_parallel_execution(self):
+        executed, started = self.executed, []
+        both_started = Event()
+        class WaitTask(self.MockTask):
+            def execute(self):
+                started.append(self)
+                if len(started) == 2:
+                    both_started.set()
+                # independent tasks must run at the same time
+                both_started.wait(5)
+                assert both_started.isSet()
+                executed.append(self)
+
+        t0 = self.MockTask()
+        t1 = WaitTask(deps=[t0])
+        t2 = WaitTask(deps=[t0])
+        st = self.MockTask(deps=[t1, t2])
+        wf = Workflow(starttask=st, jobs=2)
+        wf.execute()
+        self.assertEqual(self.executed[0], t0)
+        self.assertEqual(set(self.executed[1:3]), set([t1, t2]))
+        self.assertEqual(self.executed[3], st)
+
+    def test_parallel_skipped_tasks(self):
+        t1 = self.MockTask()
+        t2 = self.MockTask()
+        st = self.MockTask(deps=[t1, t2])
+        wf = Workflow(starttask=st, exclude_tasks=['0'], jobs=4)
+        wf.execute()
+        self.assertEqual(self.executed, [t1, st])
+
+    def test_parallel_failure(self):
+        class TaskFailed(Exception):
+            pass
+
+        class FailTask(self.MockTask):
+            def execute(self):
+                raise TaskFailed
+
+        t1 = self.MockTask()
+        t2 = FailTask()
+        st = self.MockTask(deps=[t1, t2])
+        wf = Workflow(starttask=st, jobs=2)
+        self.assertRaises(TaskFailed, wf.execute)
+        self.assertEqual(self.executed, [t1])
+
+        class ExitTask(Task):
+            def execute(self):
+                raise ExitWorkflow('ExitTask', ExitWorkflow.EXIT_FAILED)
+
+        wf = Workflow(starttask=self.MockTask(deps=[ExitTask, t1]), jobs=2)
+        self.assertRaises(ExitWorkflow, wf.execute)
+
+    def test_task_history(self):
+        statedir = mkdtemp()
+        try:
+            class MyWorkflow(Workflow):
+                starttask = self.MockTask
+            MyWorkflow(statedir=statedir).execute()
+            wf = MyWorkflow(statedir=statedir)
+            self.assertNotEqual(wf.history.estimate('MockTask'), None)
+            self.assertEqual(wf.history.estimate('Unknown'), None)
+        finally:
+            rmtree(statedir)
+
+    def test_resume(self):
+        class TaskFailed(Exception):
+            pass
+
+        executed, fail = self.executed, [True]
+        class T1(self.MockTask): pass
+        class T2(self.MockTask):
+            def execute(self):
+                if fail:
+                    raise TaskFailed
+                executed.append(self)
+        class T3(self.MockTask): deps = [T2, T1]
+        class MyWorkflow(Workflow):
+            starttask = T3
+            settings = {'day': '2010-06-16'}
+
+        statedir = mkdtemp()
+        try:
+            wf = MyWorkflow(statedir=statedir)
+            self.assertRaises(TaskFailed, wf.execute)
+            self.assertEqual(map(type, self.executed), [T1])
+
+            # tasks are not resumed from runs with different settings
+            del fail[:]
+            del self.executed[:]
+            MyWorkflow(statedir=statedir, resume=True,
+                    params={'day': '2010-06-17'}).execute()
+            self.assertEqual(map(type, self.executed), [T1, T2, T3])
+
+            del self.executed[:]
+            MyWorkflow(statedir=statedir, resume=True).execute()
+            self.assertEqual(map(type, self.executed), [T2, T3])
+
+            # a successful run is never resumed
+            del self.executed[:]
+            MyWorkflow(statedir=statedir, resume=True).execute()
+            self.assertEqual(map(type, self.executed), [T1, T2, T3])
+        finally:
+            rmtree(statedir)
+
+    def test_uptodate_outputs(self):
+        executed = self.executed
+        class Copy(Task):
+            inputs = ['$tmp/input']
+            outputs = ['$tmp/output']
+            def execute(self):
+                executed.append(self)
+                open(self.outputs[0], 'w').write(open(self.inputs[0]).read())
+
+        def write(path, content, age):
+            open(path, 'w').write(content)
+            os.utime(path, (time() - age, time() - age))
+
+        tmp = mkdtemp()
+        try:
+            class MyWorkflow(Workflow):
+                starttask = Copy
+                settings = {'tmp': tmp}
+            run = lambda: MyWorkflow(statedir=tmp).execute()
+            write(os.path.join(tmp, 'input'), 'v1', 60)
+            run()
+            self.assertEqual(len(executed), 1)
+            run()
+            self.assertEqual(len(executed), 1)
+            # newer input with the same content
+            write(os.path.join(tmp, 'input'), 'v1', -60)
+            run()
+            self.assertEqual(len(executed), 1)
+            write(os.path.join(tmp, 'input'), 'v2', -60)
+            run()
+            self.assertEqual(len(executed), 2)
+            os.remove(os.path.join(tmp, 'output'))
+            run()
+            self.assertEqual(len(executed), 3)
+
+            # instances of a task class keep their own input hashes
+            a, b = Copy(outputs=['$tmp/a']), Copy(outputs=['$tmp/b'])
+            class BothWorkflow(MyWorkflow):
+                starttask = Task(deps=[a, b])
+            BothWorkflow(statedir=tmp).execute()
+            self.assertEqual(executed[3:], [b, a])
+            write(os.path.join(tmp, 'input'), 'v3', -120)
+            BothWorkflow(statedir=tmp, include_tasks=['0']).execute()
+            self.assertEqual(executed[5:], [b])
+            BothWorkflow(statedir=tmp).execute()
+            self.assertEqual(executed[6:], [a])
+        finally:
+            rmtree(tmp)
+
+    def test_plan(self):
+        class A(Task): pass
+        class B(Task): pass
+        class C(Task): deps = [B]
+        class D(Task): deps = [A, C]
+        wf = Workflow(starttask=D, jobs=2)
+        for tid, seconds in [('A', 10), ('B', 5), ('C', 10), ('D', 1)]:
+            wf.history.add(tid, seconds)
+        path, seconds = wf.plan()
+        self.assertEqual([(type(t), s) for _, t, s in path],
+                [(B, 5), (C, 10), (D, 1)])
+        self.assertEqual(seconds, 16)
+
+        wf.jobs = 1
+        path, seconds = wf.plan()
+        self.assertEqual(seconds, 26)
+
+    def test_corrupt_state(self):
+        tmp = mkdtemp()
+        self.addCleanup(rmtree, tmp)
+        class A(Task): pass
+        class StateWorkflow(Workflow):
+            starttask = A
+            statedir = tmp
+        os.makedirs(os.path.join(tmp, 'history'))
+        open(os.path.join(tmp, 'history', 'StateWorkflow.json'),
+                'w').write('{"A": [1')
+        os.makedirs(os.path.join(tmp, 'stamps'))
+        open(os.path.join(tmp, 'stamps', 'StateWorkflow.json'), 'w').close()
+        wf = StateWorkflow()
+        self.assertEqual(wf.history.durations, {})
+        self.assertEqual(wf.stamps.hashes, {})
+
+    def test_plan_cache(self):
+        tmp = mkdtemp()
+        self.addCleanup(rmtree, tmp)
+        created = []
+        class A(Task):
+            def __init__(self, **kwargs):
+                created.append(self)
+                Task.__init__(self, **kwargs)
+        class B(Task): deps = [A]
+        class PlannedWorkflow(Workflow):
+            starttask = B
+            statedir = tmp
+            settings = {'a': '$b/a', 'b': 'b'}
+        outline = [(0, 'A', False, 'A', []), (1, 'B', True, 'B', [0])]
+
+        wf = PlannedWorkflow(exclude_tasks=['B'])
+        self.assertEqual(wf.outline(), outline)
+        self.assertEqual(len(created), 1)
+        wf = PlannedWorkflow(exclude_tasks=['B'])
+        self.assertEqual(wf.outline(), outline)
+        self.assertEqual(wf._cachedplan()['settings'], {'a': 'b/a', 'b': 'b'})
+        self.assertEqual(len(created), 1)
+        # other parameters have their own plan
+        wf = PlannedWorkflow(params={'b': 'c'})
+        self.assertEqual(wf.outline()[1][2], False)
+        self.assertEqual(wf._cachedplan()['settings']['a'], 'c/a')
+        self.assertEqual(len(created), 2)
+
+        # plans are valid while their sources don't change
+        source = os.path.join(tmp, 'source.py')
+        open(source, 'w').write('pass\n')
+        cache = PlanCache(os.path.join(tmp, 'plan.json'))
+        cache.store('key', {'tasks': [[0, 'A', False, 'A', []]]}, [source])
+        self.assertEqual(cache.load('key'),
+                {'tasks': [[0, 'A', False, 'A', []]]})
+        self.assertEqual(cache.load('other'), None)
+        open(source, 'a').write('pass\n')
+        self.assertEqual(cache.load('key'), None)
+
+    def test_workflow_control(self):
+        tmp = mkdtemp()
+        self.addCleanup(rmtree, tmp)
+        open(os.path.join(tmp, 'lazywf.py'), 'w').write(
+            'from sworkflow.tasks import Task, Workflow\n'
+            'class LazyWorkflow(Workflow):\n'
+            '    starttask = Task\n')
+        sys.path.insert(0, tmp)
+        self.addCleanup(sys.path.remove, tmp)
+        self.addCleanup(sys.modules.pop, 'lazywf', None)
+        class EntryPoint(object):
+            def load(self):
+                return Workflow
+        control = WorkflowControl({'lazy': 'lazywf:LazyWorkflow',
+            'eager': Workflow, 'ep': EntryPoint()})
+
+        self.assertEqual(sorted(control.list()), ['eager', 'ep', 'lazy'])
+        self.assertFalse('lazywf' in sys.modules)
+        wf = control.create('lazy', jobs=2)
+        self.assertEqual((type(wf).__name__, wf.jobs), ('LazyWorkflow', 2))
+        self.assertTrue(type(control.create('ep', starttask=Task)) is Workflow)
+        self.assertRaises(ValueError, control.create, 'unknown')
+
+    def test_pythontask_cache(self):
+        tmp = mkdtemp()
+        try:
+            open(os.path.join(tmp, 'upper.py'), 'w').write(
+                'import sys\n'
+                'open(sys.argv[3], "a").write("run\\n")\n'
+                'data = open(sys.argv[1]).read().upper()\n'
+                'open(sys.argv[2], "w").write(data)\n')
+            path = lambda name: os.path.join(tmp, name)
+            open(path('input'), 'w').write('data')
+            task = PythonTask(cache=True, cachedir=path('cache'), execcwd=tmp,
+                execargs=['upper', path('input'), path('output'), path('runs')],
+                inputs=[path('input')], outputs=[path('output')])
+            task.execute()
+            os.remove(path('output'))
+            task.execute()
+            self.assertEqual(open(path('output')).read(), 'DATA')
+            self.assertEqual(open(path('runs')).read(), 'run\n')
+            # writing a restored output in place leaves the cache alone
+            open(path('output'), 'w').write('changed')
+            os.remove(path('output'))
+            task.execute()
+            self.assertEqual(open(path('output')).read(), 'DATA')
+
+            open(path('input'), 'w').write('new data')
+            task.execute()
+            self.assertEqual(open(path('output')).read(), 'NEW DATA')
+            self.assertEqual(open(path('runs')).read(), 'run\nrun\n')
+
+            # directory outputs
+            open(os.path.join(tmp, 'split.py'), 'w').write(
+                'import os, sys\n'
+                'open(sys.argv[3], "a").write("split\\n")\n'
+                'os.mkdir(sys.argv[2])\n'
+                'open(os.path.join(sys.argv[2], "part-00000"), "w").write(\n'
+                '    open(sys.argv[1]).read())\n')
+            task = PythonTask(cache=True, cachedir=path('cache'), execcwd=tmp,
+                execargs=['split', path('input'), path('outdir'), path('runs')],
+                inputs=[path('input')], outputs=[path('outdir')])
+            task.execute()
+            rmtree(path('outdir'))
+            task.execute()
+            self.assertEqual(open(path('outdir/part-00000')).read(), 'new data')
+            self.assertEqual(open(path('runs')).read().count('split'), 1)
+
+            # a cache that can't be written doesn't fail the task
+            open(path('nocache'), 'w').close()
+            rmtree(path('outdir'))
+            task.cachedir = path('nocache')
+            levels = []
+            task.log = lambda msg, *args, **kwargs: levels.append(
+                    kwargs.get('level'))
+            task.execute()
+            self.assertEqual(open(path('runs')).read().count('split'), 2)
+            self.assertTrue(logging.WARNING in levels)
+        finally:
+            rmtree(tmp)
+
     def test_template_expansion(self):
         # settings and task attributes must be expanded on execute
         class MyTask(Task):
@@ -0,0 +1,503 @@
+"""
+WebHDFS backend for sworkflow.hdfs
+
+Sends filesystem operations to the WebHDFS REST API of the namenode through
+keep-alive HTTP connections instead of starting a "hadoop fs" JVM per call:
+
+    from sworkflow import hdfs
+    from sworkflow.webhdfs import WebHDFS
+    hdfs.set_backend(WebHDFS('http://namenode:50070', user='hadoop'))
+
+Results have the same shape as the ones parsed from "hadoop fs" output and
+failures are raised as CalledProcessError, like failed "hadoop fs" commands.
+Operations WebHDFS can't do (copies within HDFS and transfers of whole
+directories) are delegated to the FsShell backend.
+"""
+import io
+import os
+import socket
+import httplib
+import threading
+from fnmatch import fnmatchcase
+from posixpath import join, basename
+from subprocess import CalledProcessError
+from urllib import urlencode, quote
+from urlparse import urlsplit
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from sworkflow.hdfs import FsShell, DiskUsage, _filestatus, _rename_aside, \
+        _braces, _GLOB
+
+BLOCKSIZE = 64 * 1024
+
+
+class WebHDFSError(CalledProcessError):
+    """A WebHDFS operation failed
+
+    It is raised with the exit status of a failed "hadoop fs" command, so
+    callers handle failures of every backend in the same way.
+    """
+
+    def __init__(self, cmd, message, exception=None):
+        CalledProcessError.__init__(self, 255, cmd)
+        self.message = message
+        self.exception = exception
+
+    def __str__(self):
+        return '%s: %s' % (self.cmd, self.message)
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP connections by host, one per thread"""
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def get(self, netloc):
+        conns = self.local.__dict__.setdefault('conns', {})
+        conn = conns.get(netloc)
+        if conn is None:
+            conn = conns[netloc] = _HTTPConnection(netloc,
+                    timeout=self.timeout)
+        return conn
+
+    def discard(self, netloc):
+        conn = self.local.__dict__.get('conns', {}).pop(netloc, None)
+        if conn is not None:
+            conn.close()
+
+
+class _HTTPConnection(httplib.HTTPConnection):
+    """HTTP connection sending small requests without delay"""
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class WebHDFS(object):
+    """Backend using the WebHDFS REST API"""
+
+    def __init__(self, url='http://localhost:50070', user=None, timeout=60,
+            fallback=None):
+        parts = urlsplit(url if '://' in url else 'http://' + url)
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/') + '/webhdfs/v1'
+        self.user = user or os.environ.get('HADOOP_USER_NAME') \
+                or os.environ.get('USER')
+        self.pool = ConnectionPool(timeout)
+        self.fallback = fallback or FsShell()
+
+    ## FsShell backend interface
+
+    def ls(self, paths, recursive=False):
+        for pattern in paths:
+            for path, status in self._glob(pattern):
+                if status['type'] == 'DIRECTORY':
+                    for row in self._lsdir(path, recursive):
+                        yield row
+                else:
+                    yield _filestatus(path, status)
+
+    def du(self, paths):
+        for pattern in paths:
+            for path, status in self._glob(pattern):
+                if status['type'] == 'DIRECTORY':
+                    children = [(join(path, c['pathSuffix']), c)
+                            for c in self._liststatus(path)]
+                else:
+                    children = [(path, status)]
+                for p, s in children:
+                    yield DiskUsage(p, self._usage(p, s))
+
+    def dus(self, paths):
+        for pattern in paths:
+            for p, s in self._glob(pattern):
+                yield DiskUsage(p, self._usage(p, s))
+
+    def mv(self, dst, srcs):
+        sources = self._sources('mv', srcs)
+        dst = self._abspath(dst)
+        intodir = self._isdir(dst)
+        if len(sources) > 1 and not intodir:
+            raise WebHDFSError('mv', 'When moving multiple files, '
+                    'destination should be a directory.')
+        for src, _ in sources:
+            target = join(dst, basename(src)) if intodir else dst
+            self._rename(src, target)
+
+    def rename(self, src, dst, overwrite=False):
+        src, dst = self._abspath(src), self._abspath(dst)
+        if not overwrite:
+            return self._rename(src, dst)
+        result = self._call('PUT', src, 'RENAME', destination=dst,
+                renameoptions='OVERWRITE')
+        if result.get('boolean') is False:
+            # namenodes without rename options only rename to new paths
+            _rename_aside(self, src, dst)
+
+    def cp(self, dst, srcs):
+        self.fallback.cp(dst, srcs)
+
+    def rm(self, paths):
+        for path, status in self._sources('rm', paths):
+            if status['type'] == 'DIRECTORY':
+                raise WebHDFSError('rm', 'Cannot remove directory "%s", '
+                        'use -rmr instead' % path)
+            self._delete(path, recursive=False)
+
+    def rmr(self, paths):
+        for path, _ in self._sources('rmr', paths):
+            self._delete(path, recursive=True)
+
+    def put(self, dst, srcs, stdin=None):
+        if stdin is not None:
+            return self._create(self._abspath(dst), stdin)
+        if [s for s in srcs if os.path.isdir(s)]:
+            return self.fallback.put(dst, srcs)
+        dst = self._abspath(dst)
+        intodir = self._isdir(dst)
+        if len(srcs) > 1 and not intodir:
+            raise WebHDFSError('put', 'When copying multiple files, '
+                    'destination should be a directory.')
+        for src in srcs:
+            f = open(src, 'rb')
+            try:
+                self._create(join(dst, basename(src)) if intodir else dst, f)
+            finally:
+                f.close()
+
+    def create(self, path, overwrite=False):
+        return io.BufferedWriter(_CreateStream(self, self._abspath(path),
+            overwrite), BLOCKSIZE)
+
+    def get(self, dst, srcs):
+        sources = self._sources('get', srcs)
+        if [s for _, s in sources if s['type'] == 'DIRECTORY']:
+            return self.fallback.get(dst, srcs)
+        intodir = os.path.isdir(dst)
+        if len(sources) > 1 and not intodir:
+            raise WebHDFSError('get', 'When copying multiple files, '
+                    'destination should be a directory.')
+        for src, _ in sources:
+            target = os.path.join(dst, basename(src)) if intodir else dst
+            netloc, response = self._open(src)
+            try:
+                f = open(target, 'wb')
+                try:
+                    for block in iter(lambda: response.read(BLOCKSIZE), ''):
+                        f.write(block)
+                finally:
+                    f.close()
+            except:
+                # connection is left with unread data, don't reuse it
+                self.pool.discard(netloc)
+                raise
+
+    def cat(self, paths):
+        sources = [p for p, _ in self._sources('cat', paths)]
+        return io.BufferedReader(_CatStream(self, sources), BLOCKSIZE)
+
+    def mkdir(self, paths, fail_if_exists=False):
+        for path in paths:
+            path = self._abspath(path)
+            if fail_if_exists and self._status(path):
+                raise WebHDFSError('mkdir', 'cannot create directory %s: '
+                        'File exists' % path)
+            self._call('PUT', path, 'MKDIRS')
+
+    def touchz(self, paths):
+        for path in paths:
+            path = self._abspath(path)
+            status = self._status(path)
+            if status and status['length']:
+                raise WebHDFSError('touchz', '%s must be a zero-length file'
+                        % path)
+            self._create(path, io.BytesIO(), overwrite=True)
+
+    def mtime(self, path):
+        mtimes = [s['modificationTime'] for _, s in self._glob(path)]
+        return max(mtimes) / 1000.0 if mtimes else None
+
+    def exists(self, path):
+        return bool(self._glob(path))
+
+    ## WebHDFS operations
+
+    def _abspath(self, path):
+        """Returns the absolute path on HDFS of a path or hdfs: url
+
+        >>> fs = WebHDFS(user='hadoop')
+        >>> fs._abspath('hdfs://namenode:9000/data/logs/')
+        '/data/logs'
+        >>> fs._abspath('data')
+        '/user/hadoop/data'
+        >>> fs._abspath('hdfs:/data/logs')
+        '/data/logs'
+        """
+        if '://' in path:
+            path = urlsplit(path).path
+        elif path.startswith('hdfs:'):
+            path = path[len('hdfs:'):]
+        if not path.startswith('/'):
+            path = join('/user', self.user or '', path)
+        return path.rstrip('/') or '/'
+
+    def _url(self, path, op, **params):
+        params['op'] = op
+        if self.user:
+            params['user.name'] = self.user
+        return '%s%s?%s' % (self.prefix, quote(path), urlencode(params))
+
+    def _request(self, method, netloc, url, headers=None):
+        """Send a request through a pooled connection and return the response
+
+        A kept alive connection may have been closed by the server, requests
+        failing to be sent are retried once on a new connection. Requests
+        sent but not answered are only retried for GET, other methods may
+        have been applied already.
+        """
+        for retry in (False, True):
+            conn = self.pool.get(netloc)
+            sent = False
+            try:
+                conn.request(method, url, headers=headers or {})
+                sent = True
+                return conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                self.pool.discard(netloc)
+                if retry or (sent and method != 'GET'):
+                    raise
+
+    def _call(self, method, path, op, **params):
+        """Run op on path and return the decoded JSON response"""
+        response = self._request(method, self.netloc,
+                self._url(path, op, **params))
+        data = response.read()
+        if response.status >= 400:
+            raise _error(op, path, data)
+        return json.loads(data) if data else {}
+
+    def _status(self, path):
+        """Returns the FileStatus of path or None if it doesn't exist"""
+        response = self._request('GET', self.netloc,
+                self._url(path, 'GETFILESTATUS'))
+        data = response.read()
+        if response.status == 404:
+            return None
+        if response.status >= 400:
+            raise _error('GETFILESTATUS', path, data)
+        return json.loads(data)['FileStatus']
+
+    def _liststatus(self, path):
+        result = self._call('GET', path, 'LISTSTATUS')
+        return result['FileStatuses']['FileStatus']
+
+    def _isdir(self, path):
+        status = self._status(path)
+        return bool(status) and status['type'] == 'DIRECTORY'
+
+    def _glob(self, pattern):
+        """Returns the list of (path, status) matching the pattern
+
+        Patterns support the wildcards of fnmatch and {a,b} alternatives.
+        """
+        pattern = self._abspath(pattern)
+        if not _GLOB.search(pattern):
+            status = self._status(pattern)
+            return [(pattern, status)] if status else []
+
+        matches = [('/', None)]
+        for part in pattern.strip('/').split('/'):
+            found = []
+            for path, status in matches:
+                if status and status['type'] != 'DIRECTORY':
+                    continue
+                if _GLOB.search(part):
+                    alternatives = _braces(part)
+                    found.extend((join(path, c['pathSuffix']), c)
+                            for c in self._liststatus(path)
+                            if [a for a in alternatives
+                                if fnmatchcase(c['pathSuffix'], a)])
+                else:
+                    status = self._status(join(path, part))
+                    if status:
+                        found.append((join(path, part), status))
+            matches = found
+        return matches
+
+    def _sources(self, cmd, patterns):
+        """Returns (path, status) matching patterns, fail if one doesn't"""
+        sources = []
+        for pattern in patterns:
+            matches = self._glob(pattern)
+            if not matches:
+                raise WebHDFSError(cmd, '%s: No such file or directory'
+                        % pattern)
+            sources.extend(matches)
+        return sources
+
+    def _lsdir(self, path, recursive):
+        for child in self._liststatus(path):
+            childpath = join(path, child['pathSuffix'])
+            yield _filestatus(childpath, child)
+            if recursive and child['type'] == 'DIRECTORY':
+                for row in self._lsdir(childpath, recursive):
+                    yield row
+
+    def _usage(self, path, status):
+        if status['type'] != 'DIRECTORY':
+            return status['length']
+        summary = self._call('GET', path, 'GETCONTENTSUMMARY')
+        return summary['ContentSummary']['length']
+
+    def _rename(self, src, dst):
+        result = self._call('PUT', src, 'RENAME', destination=dst)
+        if not result.get('boolean'):
+            raise WebHDFSError('mv', 'Failed to rename %s to %s' % (src, dst))
+
+    def _delete(self, path, recursive):
+        result = self._call('DELETE', path, 'DELETE',
+                recursive=str(recursive).lower())
+        if not result.get('boolean'):
+            raise WebHDFSError('rm', 'Failed to delete %s' % path)
+
+    def _redirect(self, method, path, op, **params):
+        """Returns the datanode location a namenode redirects op to"""
+        response = self._request(method, self.netloc,
+                self._url(path, op, **params))
+        data = response.read()
+        if response.status >= 400:
+            raise _error(op, path, data)
+        return response.getheader('location')
+
+    def _open(self, path):
+        """Returns the response streaming the content of path and the netloc
+        of the connection it is read from"""
+        netloc = self.netloc
+        response = self._request('GET', netloc, self._url(path, 'OPEN'))
+        if response.status in (301, 302, 303, 307):
+            response.read()
+            location = urlsplit(response.getheader('location'))
+            netloc = location.netloc
+            response = self._request('GET', netloc,
+                    '%s?%s' % (location.path, location.query))
+        if response.status >= 400:
+            raise _error('OPEN', path, response.read())
+        return netloc, response
+
+    def _create(self, path, fileobj, overwrite=False):
+        """Upload the content read from fileobj to path"""
+        stream = _CreateStream(self, path, overwrite)
+        try:
+            for block in iter(lambda: fileobj.read(BLOCKSIZE), ''):
+                stream.write(block)
+        except:
+            stream.abort()
+            raise
+        stream.close()
+
+
+class _CreateStream(io.RawIOBase):
+    """Raw stream uploading what is written to a new file, the upload is
+    completed by close()"""
+
+    def __init__(self, fs, path, overwrite):
+        self.fs = fs
+        self.path = path
+        location = urlsplit(fs._redirect('PUT', path, 'CREATE',
+                overwrite=str(overwrite).lower()))
+        self.netloc = location.netloc
+        self.conn = fs.pool.get(self.netloc)
+        try:
+            self.conn.putrequest('PUT', '%s?%s'
+                    % (location.path, location.query))
+            self.conn.putheader('Content-Type', 'application/octet-stream')
+            self.conn.putheader('Transfer-Encoding', 'chunked')
+            self.conn.endheaders()
+        except:
+            fs.pool.discard(self.netloc)
+            raise
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        block = memoryview(b).tobytes()
+        if block:
+            try:
+                self.conn.send('%x\r\n%s\r\n' % (len(block), block))
+            except:
+                self.abort()
+                raise
+        return len(block)
+
+    def abort(self):
+        """Give up the upload, its connection can't be reused"""
+        if not self.closed:
+            self.fs.pool.discard(self.netloc)
+            io.RawIOBase.close(self)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.conn.send('0\r\n\r\n')
+            response = self.conn.getresponse()
+            data = response.read()
+        except:
+            self.abort()
+            raise
+        io.RawIOBase.close(self)
+        if response.status >= 400:
+            raise _error('CREATE', self.path, data)
+
+
+class _CatStream(io.RawIOBase):
+    """Raw stream with the content of a list of files"""
+
+    def __init__(self, fs, paths):
+        self.fs = fs
+        self.paths = list(paths)
+        self.netloc = None
+        self.response = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            if self.response is None:
+                if not self.paths:
+                    return 0
+                self.netloc, self.response = self.fs._open(
+                        self.paths.pop(0))
+            data = self.response.read(len(b))
+            if data:
+                b[:len(data)] = data
+                return len(data)
+            self.response = None
+
+    def close(self):
+        if self.response is not None:
+            # connection is left with unread data, don't reuse it
+            self.response.close()
+            self.fs.pool.discard(self.netloc)
+            self.response = None
+        io.RawIOBase.close(self)
+
+
+def _error(op, path, data):
+    """Returns the WebHDFSError for an error response"""
+    try:
+        remote = json.loads(data)['RemoteException']
+        return WebHDFSError(op, '%s: %s' % (path, remote['message']),
+                remote.get('exception'))
+    except (ValueError, KeyError, TypeError):
+        return WebHDFSError(op, '%s: %s' % (path, data))